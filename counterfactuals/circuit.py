@@ -0,0 +1,621 @@
+"""
+Circuit module providing compiled circuits that are kept in memory and can be evaluated repeatedly.
+"""
+
+import os
+import heapq
+import logging
+
+import numpy as np
+
+from aspmc.compile.circuit import Circuit
+from aspmc.util import *
+
+import aspmc.signal_handling as my_signals
+
+import counterfactuals.deadline as deadline
+
+logger = logging.getLogger("WhatIf")
+
+# approximate number of bytes python uses per node and per edge of a circuit in memory
+NODE_BYTES = 80
+EDGE_BYTES = 8
+
+class LiteralWeights(list):
+    """The weights of the literals for one batched evaluation, where most literals have the same weight in every column.
+
+    Each entry is either a single value that is shared by all the columns of the batch, 
+    or an array with one value per column if the weight of the literal varies across the batch.
+    Memory therefore only grows with the batch for the literals that vary, such as those of queries.
+    Shared values must not be changed in place, since they may be shared between literals; use `override` instead.
+
+    Args:
+        weights (list): The weights of the literals. The weight for literal `v` is in `weights[2*(v-1)]`,
+            the one for `-v` is in `weights[2*(v-1)+1]`.
+        batch (:obj:`int`): The number of columns of the batch.
+        dtype (:obj:`type`, optional): The type of the weights. Defaults to `float`.
+        value_shape (:obj:`tuple`, optional): The shape of a single weight. Defaults to `()`.
+
+    Attributes:
+        batch (:obj:`int`): The number of columns of the batch.
+        dtype (:obj:`type`): The type of the weights.
+        value_shape (tuple): The shape of a single weight.
+    """
+    def __init__(self, weights, batch, dtype = float, value_shape = ()):
+        list.__init__(self, weights)
+        self.batch = batch
+        self.dtype = dtype
+        self.value_shape = tuple(value_shape)
+
+    def is_shared(self, pos):
+        """Checks whether the weight at position `pos` is the same for all the columns of the batch."""
+        return np.ndim(self[pos]) == len(self.value_shape)
+
+    def override(self, pos, columns, value):
+        """Sets the weight at position `pos` for some of the columns of the batch.
+
+        Args:
+            pos (:obj:`int`): The position of the literal.
+            columns (:obj:`object`): The columns to set, as an index or a slice into the batch.
+            value (:obj:`object`): The weight.
+        Returns:
+            None
+        """
+        if self.is_shared(pos):
+            self[pos] = np.full((self.batch, ) + self.value_shape, self[pos], dtype = self.dtype)
+        self[pos][columns] = value
+
+    def column(self, idx):
+        """Gets the weights of a single column of the batch.
+
+        Args:
+            idx (:obj:`int`): The column.
+        Returns:
+            list: The weight of each literal in the column.
+        """
+        return [ np.asarray(w)[()] if np.ndim(w) == len(self.value_shape) else w[idx] for w in self ]
+
+def select_columns(weights, columns):
+    """Gets the weights of some of the columns of a batch of literal weights.
+
+    Args:
+        weights (list): The weights of the literals, either a `LiteralWeights` or a list of arrays of the same length.
+        columns (:obj:`np.array`): The indices of the columns.
+    Returns:
+        :obj:`LiteralWeights`: The weights of the columns, where shared weights stay shared.
+    """
+    if isinstance(weights, LiteralWeights):
+        selected = [ w if weights.is_shared(pos) else w[columns] for pos, w in enumerate(weights) ]
+        return LiteralWeights(selected, len(columns), dtype = weights.dtype, value_shape = weights.value_shape)
+    return LiteralWeights([ np.asarray(w)[columns] for w in weights ], len(columns))
+
+def batch_size(weights):
+    """Gets the number of columns of a batch of literal weights.
+
+    Args:
+        weights (list): The weights of the literals, either a `LiteralWeights` or a list of arrays of the same length.
+    Returns:
+        int: The number of columns.
+    """
+    if isinstance(weights, LiteralWeights):
+        return weights.batch
+    return np.shape(weights[0])[0]
+
+class CompiledCircuit(object):
+    """A smooth sd-DNNF held in memory, such that it does not need to be parsed again for each evaluation.
+
+    The nodes are stored in topological order, that is, the children of a node always come before it
+    and the last node is the root.
+    Circuits in the format of c2d and sharpsat-td are stored as they are.
+    Circuits in the format of d4 are converted by replacing every edge that carries literals or free variables
+    by an and node over the child, the literals and an or node `v | -v` for every free variable `v`.
+
+    Attributes:
+        types (list): For each node its type, one of `LITERAL`, `AND` and `OR`.
+        literals (list): For each node its literal if it is a literal node and `0` otherwise.
+        children (list): For each node the list of the indices of its children.
+    """
+    LITERAL = 0
+    AND = 1
+    OR = 2
+
+    def __init__(self):
+        self.types = []
+        self.literals = []
+        self.children = []
+        self._literal_nodes = {}
+        self._free_nodes = {}
+
+    def size(self):
+        """Gets the number of nodes of the circuit.
+
+        Returns:
+            int: The number of nodes, which is the number of batch vectors that are alive during evaluation.
+        """
+        return len(self.types)
+
+    def memory(self):
+        """Estimates the memory of the circuit.
+
+        Returns:
+            int: The approximate number of bytes of the lists that hold the circuit, without the values of an evaluation.
+        """
+        return len(self.types)*NODE_BYTES + sum(len(children) for children in self.children)*EDGE_BYTES
+
+    def close(self):
+        """Releases the resources of the circuit. Nothing needs to be done for circuits in memory.
+
+        Returns:
+            None
+        """
+        pass
+
+    def _add(self, type, literal = 0, children = []):
+        self.types.append(type)
+        self.literals.append(literal)
+        self.children.append(children)
+        return len(self.types) - 1
+
+    def _literal(self, literal):
+        if literal not in self._literal_nodes:
+            self._literal_nodes[literal] = self._add(CompiledCircuit.LITERAL, literal = literal)
+        return self._literal_nodes[literal]
+
+    def _free(self, var):
+        if var not in self._free_nodes:
+            self._free_nodes[var] = self._add(CompiledCircuit.OR, children = [ self._literal(var), self._literal(-var) ])
+        return self._free_nodes[var]
+
+    @staticmethod
+    def parse(lines, solver = "c2d"):
+        """Parses a circuit while it is being read.
+
+        Args:
+            lines (iterable): The lines of the circuit, e.g. an open file or pipe in text mode.
+            solver (:obj:`string`, optional): Which knowledge compiler the circuit is from.
+                `c2d`, `sharpsat-td` and `d4` are supported. Defaults to `c2d`.
+        Returns:
+            :obj:`CompiledCircuit`: The parsed circuit.
+        """
+        if solver == "d4":
+            return CompiledCircuit._parse_d4(lines)
+        if solver not in [ "c2d", "sharpsat-td" ]:
+            raise Exception(f"Can not keep circuits of {solver} in memory.")
+        circuit = CompiledCircuit()
+        index = []
+        for line in lines:
+            line = line.split()
+            if len(line) == 0 or line[0] in [ "c", "nnf" ]:
+                continue
+            if line[0] == 'L':
+                index.append(circuit._literal(int(line[1])))
+            elif line[0] == 'A':
+                index.append(circuit._add(CompiledCircuit.AND, children = [ index[int(x)] for x in line[2:] ]))
+            elif line[0] == 'O':
+                index.append(circuit._add(CompiledCircuit.OR, children = [ index[int(x)] for x in line[3:] ]))
+        if len(index) == 0:
+            raise Exception("The circuit is empty.")
+        # make sure that the root is the last node
+        circuit._add(CompiledCircuit.AND, children = [ index[-1] ])
+        return circuit
+
+    @staticmethod
+    def _parse_d4(lines):
+        kinds = {}
+        edges = {}
+        for line in lines:
+            line = line.split()
+            if len(line) == 0 or line[0] == "c":
+                continue
+            if line[0] in "tfao":
+                kinds[int(line[1])] = line[0]
+                edges[int(line[1])] = []
+            else:
+                line = [ int(x) for x in line ]
+                idx = line.index(0, 2)
+                edges[line[0]].append((line[1], line[2:idx], line[idx + 1:-1]))
+        if 1 not in kinds:
+            raise Exception("The circuit is empty.")
+
+        # add the nodes in topological order, starting from the root 1
+        circuit = CompiledCircuit()
+        index = {}
+        stack = [ (1, False) ]
+        while len(stack) > 0:
+            node, expanded = stack.pop()
+            if node in index:
+                continue
+            if not expanded:
+                stack.append((node, True))
+                stack.extend((child, False) for child, _, _ in edges[node] if child not in index)
+                continue
+            children = []
+            for child, literals, free in edges[node]:
+                parts = [ index[child] ] + [ circuit._literal(l) for l in literals ] + [ circuit._free(v) for v in free ]
+                if len(parts) == 1:
+                    children.append(parts[0])
+                else:
+                    children.append(circuit._add(CompiledCircuit.AND, children = parts))
+            if kinds[node] in "ta":
+                index[node] = circuit._add(CompiledCircuit.AND, children = children)
+            else:
+                index[node] = circuit._add(CompiledCircuit.OR, children = children)
+        return circuit
+
+    @staticmethod
+    def load(path, solver = "c2d"):
+        """Reads a circuit from a file.
+
+        Args:
+            path (:obj:`string`): The path to the file that contains the circuit.
+            solver (:obj:`string`, optional): Which knowledge compiler the circuit is from. Defaults to `c2d`.
+        Returns:
+            :obj:`CompiledCircuit`: The parsed circuit.
+        """
+        with open(path) as in_file:
+            return CompiledCircuit.parse(in_file, solver = solver)
+
+    def evaluate(self, weights, zero = 0.0, one = 1.0, dtype = float, log_space = False):
+        """Performs algebraic model counting over the circuit.
+
+        Nodes whose value is the same for every column of the batch keep a single value,
+        so only the part of the circuit above literals whose weights vary across the batch holds a value per column.
+
+        Args:
+            weights (list): The weights of the literals. The weight for literal `v` is in `weights[2*(v-1)]`,
+                the one for `-v` is in `weights[2*(v-1)+1]`. Either a `LiteralWeights` or a list of arrays of the same length.
+            zero (:obj:`object`, optional): The neutral element of addition. Defaults to `0.0`.
+            one (:obj:`object`, optional): The neutral element of multiplication. Defaults to `1.0`.
+            dtype (:obj:`type`, optional): Which type the numpy arrays used to store the weights should have. Defaults to `float`.
+            log_space (:obj:`bool`, optional): Whether the weights are logarithms of probabilities,
+                such that products are computed as sums and sums with `np.logaddexp`. Defaults to `False`.
+        Returns:
+            (:obj:`object`): The algebraic model count.
+        """
+        shape = (batch_size(weights), ) + np.shape(one)
+        mem = []
+        for idx in range(len(self.types)):
+            if idx % 1024 == 0:
+                # give up at the deadline of the current thread
+                deadline.check()
+            mem.append(self._value(idx, mem, weights, zero, one, dtype, log_space))
+        return self._broadcast(mem[-1], shape)
+
+    @staticmethod
+    def _broadcast(val, shape):
+        if np.ndim(val) < len(shape):
+            return np.array(np.broadcast_to(val, shape))
+        return val
+
+    def _value(self, idx, mem, weights, zero, one, dtype, log_space = False):
+        if self.types[idx] == CompiledCircuit.LITERAL:
+            return np.asarray(weights[to_pos(self.literals[idx])], dtype = dtype)
+        if self.types[idx] == CompiledCircuit.AND:
+            val = np.array(one, dtype = dtype)
+            op = np.add if log_space else np.multiply
+        else:
+            val = np.array(zero, dtype = dtype)
+            op = np.logaddexp if log_space else np.add
+        for x in self.children[idx]:
+            if np.broadcast_shapes(val.shape, np.shape(mem[x])) != val.shape:
+                # the value varies across the batch from here on
+                val = op(val, mem[x])
+            else:
+                op(val, mem[x], out = val)
+        return val
+
+    def rounding_error(self, unit):
+        """Bounds the relative rounding error of evaluating the circuit with nonnegative weights to first order.
+
+        Every weight is rounded once. The relative errors of the children of an and node add up,
+        while those of an or node are at most their maximum, since all the summands are nonnegative.
+        Each node then adds one rounding per child but the first.
+
+        Args:
+            unit (:obj:`float`): The unit roundoff of the floating point type.
+        Returns:
+            :obj:`float`: The bound on the relative error of the count.
+        """
+        errors = []
+        for type, children in zip(self.types, self.children):
+            if type == CompiledCircuit.LITERAL:
+                errors.append(unit)
+                continue
+            if type == CompiledCircuit.AND:
+                error = sum(errors[x] for x in children)
+            else:
+                error = max((errors[x] for x in children), default = 0.0)
+            errors.append(error + max(len(children) - 1, 0)*unit)
+        return errors[-1]
+
+    def simplify(self, constants = None):
+        """Gets an equivalent circuit with fewer nodes.
+
+        Literals with a constant weight are replaced by the constants, which are then propagated:
+        an and node with a zero child becomes zero, and children that are one or zero are dropped from and nodes or or nodes, respectively.
+        Nodes with a single child are replaced by the child, structurally equal nodes are merged,
+        and nodes that are no longer reachable from the root are removed.
+        The constant one is an and node without children and the constant zero is an or node without children.
+
+        Args:
+            constants (:obj:`dict`, optional): A dictionary mapping literals whose weight is the same for every evaluation
+                to `True` if the weight is one and to `False` if it is zero. Defaults to `None`.
+        Returns:
+            :obj:`CompiledCircuit`: The simplified circuit. The literals of the remaining nodes are the same,
+                so it can be evaluated with the same weights as this circuit.
+        """
+        if constants is None:
+            constants = {}
+        types = []
+        literals = []
+        children = []
+        nodes = {}
+        def add(type, literal = 0, node_children = ()):
+            key = (type, literal, node_children)
+            if key not in nodes:
+                nodes[key] = len(types)
+                types.append(type)
+                literals.append(literal)
+                children.append(node_children)
+            return nodes[key]
+        one = add(CompiledCircuit.AND)
+        zero = add(CompiledCircuit.OR)
+
+        index = []
+        for type, literal, old_children in zip(self.types, self.literals, self.children):
+            if type == CompiledCircuit.LITERAL:
+                if literal in constants:
+                    index.append(one if constants[literal] else zero)
+                else:
+                    index.append(add(CompiledCircuit.LITERAL, literal = literal))
+                continue
+            new_children = [ index[x] for x in old_children ]
+            if type == CompiledCircuit.AND:
+                if zero in new_children:
+                    index.append(zero)
+                    continue
+                new_children = [ x for x in new_children if x != one ]
+            else:
+                new_children = [ x for x in new_children if x != zero ]
+            if len(new_children) == 1:
+                index.append(new_children[0])
+            else:
+                index.append(add(type, node_children = tuple(sorted(new_children))))
+
+        # keep only the nodes below the root, which is the last of them since children always come first
+        root = index[-1]
+        reachable = [ False for _ in types ]
+        reachable[root] = True
+        for node in range(root, -1, -1):
+            if reachable[node]:
+                for x in children[node]:
+                    reachable[x] = True
+        circuit = CompiledCircuit()
+        new_index = {}
+        for node in range(root + 1):
+            if reachable[node]:
+                if types[node] == CompiledCircuit.LITERAL:
+                    new_index[node] = circuit._literal(literals[node])
+                else:
+                    new_index[node] = circuit._add(types[node], children = [ new_index[x] for x in children[node] ])
+        logger.debug(f"Simplified circuit from {self.size()} to {circuit.size()} nodes")
+        return circuit
+
+    def max_product(self, weights):
+        """Computes the model with the maximal product of literal weights.
+
+        Replaces the sums of `evaluate` by maxima and traces the maximizing children back from the root.
+
+        Args:
+            weights (list): The weights of the literals as scalars. The weight for literal `v` is in `weights[2*(v-1)]`,
+                the one for `-v` is in `weights[2*(v-1)+1]`.
+        Returns:
+            tuple: The maximal product and the set of literals of a model that attains it.
+        """
+        mem = []
+        best = []
+        for type, literal, children in zip(self.types, self.literals, self.children):
+            choice = -1
+            if type == CompiledCircuit.LITERAL:
+                val = weights[to_pos(literal)]
+            elif type == CompiledCircuit.AND:
+                val = 1.0
+                for x in children:
+                    val *= mem[x]
+            else:
+                val = 0.0
+                for x in children:
+                    if choice == -1 or mem[x] > val:
+                        val = mem[x]
+                        choice = x
+            mem.append(val)
+            best.append(choice)
+
+        literals = set()
+        visited = set()
+        stack = [ len(self.types) - 1 ]
+        while len(stack) > 0:
+            cur = stack.pop()
+            if cur in visited:
+                continue
+            visited.add(cur)
+            if self.types[cur] == CompiledCircuit.LITERAL:
+                literals.add(self.literals[cur])
+            elif self.types[cur] == CompiledCircuit.AND:
+                stack.extend(self.children[cur])
+            elif best[cur] != -1:
+                stack.append(best[cur])
+        return mem[-1], literals
+
+class IncrementalEvaluator(object):
+    """Evaluates circuits repeatedly while keeping the values of their nodes from the previous evaluation.
+
+    If the same circuit is evaluated again with weights of the same shape, 
+    only the literal nodes whose weights changed are marked as dirty, 
+    and the dirty nodes are recomputed in topological order.
+    Their parents only become dirty if the value of the node actually changed,
+    so the time of the evaluation is proportional to the part of the circuit that is affected by the change.
+    This pays off for streams of scenarios that differ in only a few evidence or intervention literals.
+
+    An evaluator keeps state between evaluations, so every thread needs its own.
+    Circuits that are not kept in memory are evaluated as usual.
+
+    Attributes:
+        updated (:obj:`int`): The number of nodes that were computed in the last evaluation.
+    """
+    def __init__(self):
+        self.updated = 0
+        self.reset()
+
+    def reset(self):
+        """Forgets the values of the previous evaluation, such that the next one evaluates the whole circuit.
+
+        Returns:
+            None
+        """
+        self._circuit = None
+        self._key = None
+        self._weights = None
+        self._mem = None
+
+    def _setup(self, circuit):
+        self._circuit = circuit
+        self._parents = [ [] for _ in circuit.types ]
+        self._literal_nodes = {}
+        for idx, (type, literal, children) in enumerate(zip(circuit.types, circuit.literals, circuit.children)):
+            if type == CompiledCircuit.LITERAL:
+                self._literal_nodes.setdefault(to_pos(literal), []).append(idx)
+            for x in children:
+                self._parents[x].append(idx)
+
+    def evaluate(self, circuit, weights, zero = 0.0, one = 1.0, dtype = float, log_space = False):
+        """Performs algebraic model counting over the circuit, reusing the values of the previous evaluation where possible.
+
+        See `CompiledCircuit.evaluate` for the arguments and the return value.
+        """
+        if not isinstance(circuit, CompiledCircuit):
+            return circuit.evaluate(weights, zero = zero, one = one, dtype = dtype, log_space = log_space)
+        shape = (batch_size(weights), ) + np.shape(one)
+        key = (shape, np.dtype(dtype), np.asarray(zero).tobytes(), np.asarray(one).tobytes(), log_space)
+        weights = [ np.array(w, dtype = dtype) for w in weights ]
+        try:
+            if self._circuit is not circuit or self._key != key:
+                if self._circuit is not circuit:
+                    self._setup(circuit)
+                self._mem = []
+                for idx in range(circuit.size()):
+                    if idx % 1024 == 0:
+                        deadline.check()
+                    self._mem.append(circuit._value(idx, self._mem, weights, zero, one, dtype, log_space))
+                self.updated = circuit.size()
+            else:
+                dirty = [ idx for pos, nodes in self._literal_nodes.items() 
+                    if not np.array_equal(weights[pos], self._weights[pos]) for idx in nodes ]
+                queued = set(dirty)
+                heapq.heapify(dirty)
+                self.updated = 0
+                while len(dirty) > 0:
+                    idx = heapq.heappop(dirty)
+                    if self.updated % 1024 == 0:
+                        deadline.check()
+                    self.updated += 1
+                    val = circuit._value(idx, self._mem, weights, zero, one, dtype, log_space)
+                    if np.array_equal(val, self._mem[idx]):
+                        continue
+                    self._mem[idx] = val
+                    for parent in self._parents[idx]:
+                        if parent not in queued:
+                            queued.add(parent)
+                            heapq.heappush(dirty, parent)
+        except BaseException:
+            # the values may be half updated
+            self.reset()
+            raise
+        self._key = key
+        self._weights = weights
+        logger.debug(f"Incremental evaluation computed {self.updated} of {circuit.size()} nodes")
+        return CompiledCircuit._broadcast(self._mem[-1], shape)
+
+class NNFFile(object):
+    """A compiled circuit that stays in a file and is parsed again for each evaluation.
+
+    This is used for the circuits of miniC2D, whose smoothing depends on the vtree.
+
+    Args:
+        path (:obj:`string`): The path to the file that contains the circuit.
+        solver (:obj:`string`): Which knowledge compiler the circuit is from.
+        vtree (:obj:`aspmc.compile.vtree.Vtree`, optional): The vtree of the circuit. Defaults to `None`.
+    """
+    def __init__(self, path, solver, vtree = None):
+        self.path = path
+        self.solver = solver
+        self.vtree = vtree
+        self._size = None
+
+    def size(self):
+        """Gets the number of nodes of the circuit.
+
+        Returns:
+            int: The number of nodes, which is the number of batch vectors that are alive during evaluation.
+        """
+        if self._size is None:
+            with open(self.path) as nnf:
+                self._size = int(nnf.readline().split()[1])
+        return self._size
+
+    def memory(self):
+        """Estimates the memory of the circuit, which is nothing since it stays in its file.
+
+        Returns:
+            int: `0`.
+        """
+        return 0
+
+    def __getstate__(self):
+        # the file is only valid as long as the circuit is, so its contents go along
+        state = dict(self.__dict__)
+        with open(self.path) as nnf:
+            state["contents"] = nnf.read()
+        return state
+
+    def __setstate__(self, state):
+        contents = state.pop("contents")
+        self.__dict__.update(state)
+        # imported here, since compilation builds on this module
+        import counterfactuals.compilation as compilation
+        fd, self.path = compilation.mkstemp()
+        with os.fdopen(fd, "w") as nnf:
+            nnf.write(contents)
+
+    def close(self):
+        """Removes the file of the circuit.
+
+        Returns:
+            None
+        """
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        my_signals.tempfiles.discard(self.path)
+
+    def evaluate(self, weights, zero = 0.0, one = 1.0, dtype = float, log_space = False):
+        """Performs algebraic model counting over the circuit. See `CompiledCircuit.evaluate`."""
+        if log_space:
+            raise Exception(f"Evaluation in log space is not supported for circuits of {self.solver}.")
+        if isinstance(weights, LiteralWeights):
+            # aspmc takes the size of the batch from the first weight and broadcasts all the others
+            shape = (weights.batch, ) + np.shape(one)
+            weights = list(weights)
+            weights[0] = np.broadcast_to(weights[0], shape)
+        return Circuit.parse_wmc(self.path, weights, zero = zero, one = one, dtype = dtype, solver = self.solver, vtree = self.vtree)
+
+    def rounding_error(self, unit):
+        """Not known, since the circuit is not kept in memory. Returns `None`."""
+        return None
+
+    def simplify(self, constants = None):
+        """Not supported, since the circuit is not kept in memory. Returns the circuit itself."""
+        return self
+
+    def max_product(self, weights):
+        """Not supported, since the smoothing of the circuit depends on the vtree."""
+        raise Exception(f"Maximization is not supported for circuits of {self.solver}.")
@@ -0,0 +1,446 @@
+"""
+Compilation module providing access to the knowledge compilers and a portfolio that races them.
+"""
+
+import logging
+import tempfile
+import subprocess
+import json
+import time
+import os
+import threading
+
+import psutil
+
+from aspmc.compile.cnf import src_path
+from aspmc.compile.vtree import TD_vtree
+from aspmc.compile.dtree import TD_dtree
+
+from aspmc.config import config
+
+import aspmc.signal_handling as my_signals
+
+from counterfactuals.circuit import CompiledCircuit, NNFFile
+from counterfactuals.tddp import TDCounter
+from counterfactuals.exceptions import DeadlineExceeded
+import counterfactuals.deadline as deadline
+
+logger = logging.getLogger("WhatIf")
+
+KNOWLEDGE_COMPILERS = [ "sharpsat-td", "d4", "c2d", "miniC2D" ]
+"""The knowledge compilers that compile a CNF top down to sd-DNNF."""
+
+TOP_DOWN_STRATEGIES = KNOWLEDGE_COMPILERS + [ "td-dp", "portfolio" ]
+"""The strategies that count the CNF of the Clark completion, including the built-in counter `td-dp` and the `portfolio`."""
+
+portfolio_config = {
+    "compilers" : [ "sharpsat-td", "d4", "c2d", "miniC2D" ],
+    "timeouts" : {},
+    "max_parallel" : None,
+    "stats_file" : None,
+}
+"""The configuration of the portfolio strategy.
+
+* `compilers`: the knowledge compilers that are raced against each other.
+* `timeouts`: a dictionary from knowledge compilers to the number of seconds after which they are given up.
+* `max_parallel`: how many knowledge compilers may run at the same time. `None` means all of them.
+* `stats_file`: a json file in which the number of wins of each knowledge compiler is stored across runs.
+"""
+
+io_config = {
+    "tmpdir" : None,
+    "pipes" : True,
+}
+"""The configuration of the input and output of the knowledge compilers.
+
+* `tmpdir`: the directory for the temporary files, e.g. a tmpfs mount. `None` means the default of `tempfile`.
+* `pipes`: whether the CNF and the circuit should be streamed over pipes for the knowledge compilers that support it.
+"""
+
+PIPE_COMPILERS = [ "sharpsat-td", "d4" ]
+"""The knowledge compilers that read the CNF from stdin and write the circuit to a named pipe."""
+
+_wins = None
+_wins_lock = threading.Lock()
+
+def mkstemp():
+    """Creates a temporary file in the configured directory and registers it for removal on signals.
+
+    Returns:
+        tuple: An open file descriptor and the path of the temporary file.
+    """
+    fd, path = tempfile.mkstemp(dir = io_config["tmpdir"])
+    my_signals.tempfiles.add(path)
+    return fd, path
+
+def write_cnf(cnf, stream, knowledge_compiler):
+    """Writes the CNF in the format the knowledge compiler expects.
+
+    Args:
+        cnf (:obj:`aspmc.compile.cnf.CNF`): The CNF to write.
+        stream (stream): The stream the CNF should be written to. Must accept binary encoding.
+        knowledge_compiler (:obj:`string`): The knowledge compiler to write the CNF for.
+    Returns:
+        None
+    """
+    if knowledge_compiler == "sharpsat-td":
+        cnf.write_kc_cnf(stream)
+    else:
+        cnf.to_stream(stream)
+
+def prepare(cnf, knowledge_compiler):
+    """Writes the CNF and the extra input files that the knowledge compiler needs to temporary files.
+
+    Args:
+        cnf (:obj:`aspmc.compile.cnf.CNF`): The CNF to compile.
+        knowledge_compiler (:obj:`string`): The knowledge compiler to prepare for.
+    Returns:
+        tuple: The path of the temporary CNF file and the vtree if the knowledge compiler is `miniC2D` or `None` otherwise.
+    """
+    cnf_fd, cnf_tmp = mkstemp()
+    vtree = None
+    if knowledge_compiler not in KNOWLEDGE_COMPILERS:
+        os.close(cnf_fd)
+        cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+        raise Exception(f"Unknown knowledge compiler {knowledge_compiler}.")
+    with os.fdopen(cnf_fd, 'wb') as cnf_file:
+        write_cnf(cnf, cnf_file, knowledge_compiler)
+    try:
+        if knowledge_compiler == "c2d":
+            with deadline.decomposition_timeout():
+                d3 = TD_dtree(cnf, solver = config["decos"], timeout = config["decot"])
+            d3.write(cnf_tmp + '.dtree')
+            my_signals.tempfiles.add(cnf_tmp + '.dtree')
+        elif knowledge_compiler == "miniC2D":
+            with deadline.decomposition_timeout():
+                vtree = TD_vtree(cnf, solver = config["decos"], timeout = config["decot"])
+            vtree.write(cnf_tmp + ".vtree")
+            my_signals.tempfiles.add(cnf_tmp + '.vtree')
+    except DeadlineExceeded:
+        cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+        raise
+    return cnf_tmp, vtree
+
+def cleanup(cnf_tmp, knowledge_compiler, keep_nnf = True):
+    """Removes the temporary files created by `prepare` and the knowledge compiler.
+
+    Args:
+        cnf_tmp (:obj:`string`): The path of the temporary CNF file.
+        knowledge_compiler (:obj:`string`): The knowledge compiler the files were prepared for.
+        keep_nnf (:obj:`bool`, optional): Whether the compiled circuit should be kept. Defaults to `True`.
+    Returns:
+        None
+    """
+    to_remove = [ cnf_tmp ]
+    if knowledge_compiler == "c2d":
+        to_remove.append(cnf_tmp + ".dtree")
+    elif knowledge_compiler == "miniC2D":
+        to_remove.append(cnf_tmp + ".vtree")
+    if not keep_nnf:
+        to_remove.append(cnf_tmp + ".nnf")
+    for path in to_remove:
+        if os.path.isfile(path):
+            os.remove(path)
+        my_signals.tempfiles.discard(path)
+
+def compile_cnf(cnf, knowledge_compiler):
+    """Compiles a CNF with a single knowledge compiler.
+
+    If `io_config["pipes"]` is set and the knowledge compiler supports it, the CNF is streamed to the knowledge compiler
+    and the circuit is parsed while the knowledge compiler writes it, such that neither of them touches the disk.
+    Otherwise, the files are written to `io_config["tmpdir"]`.
+    If the deadline of the current thread passes, the knowledge compiler is killed, its temporary files are removed
+    and `DeadlineExceeded` is raised.
+
+    Args:
+        cnf (:obj:`aspmc.compile.cnf.CNF`): The CNF to compile.
+        knowledge_compiler (:obj:`string`): The knowledge compiler to use. One of `KNOWLEDGE_COMPILERS` or `td-dp`.
+    Returns:
+        :obj:`counterfactuals.circuit.CompiledCircuit`: The compiled circuit. 
+            For `miniC2D` a `counterfactuals.circuit.NNFFile` is returned instead,
+            and for `td-dp` a `counterfactuals.tddp.TDCounter`, which needs no external knowledge compiler.
+    """
+    deadline.check()
+    if knowledge_compiler == "td-dp":
+        return TDCounter.from_cnf(cnf)
+    if io_config["pipes"] and knowledge_compiler in PIPE_COMPILERS:
+        return _compile_piped(cnf, knowledge_compiler)
+    cnf_tmp, vtree = prepare(cnf, knowledge_compiler)
+    my_signals.tempfiles.add(cnf_tmp + '.nnf')
+    args, cwd = command(cnf_tmp, knowledge_compiler, _memory())
+    try:
+        p = subprocess.Popen(args, cwd = cwd, stdout = subprocess.PIPE)
+        _log_output(p)
+    except:
+        cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+        raise
+    if p.returncode != 0:
+        cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+        raise Exception(f"Knowledge compilation failed with exit code {p.returncode}.")
+    cleanup(cnf_tmp, knowledge_compiler)
+    return load(cnf_tmp + ".nnf", knowledge_compiler, vtree = vtree)
+
+def _compile_piped(cnf, knowledge_compiler):
+    """Compiles a CNF by writing it to the stdin of the knowledge compiler and reading the circuit from a named pipe."""
+    fd, base = mkstemp()
+    os.close(fd)
+    fifo = base + ".nnf"
+    os.mkfifo(fifo)
+    my_signals.tempfiles.add(fifo)
+
+    result = {}
+    def read():
+        try:
+            with open(fifo) as nnf:
+                result["circuit"] = CompiledCircuit.parse(nnf, solver = knowledge_compiler)
+        except Exception as e:
+            result["error"] = e
+    reader = threading.Thread(target = read, daemon = True)
+    reader.start()
+
+    args, cwd = command("/dev/stdin", knowledge_compiler, _memory(), nnf_name = fifo)
+    try:
+        p = subprocess.Popen(args, cwd = cwd, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+        # the output has to be drained while the CNF is written, otherwise both sides may block on a full pipe
+        output = _start_output_logging(p)
+        try:
+            write_cnf(cnf, p.stdin, knowledge_compiler)
+            p.stdin.close()
+        except BrokenPipeError:
+            # the knowledge compiler failed, which is reported below
+            pass
+        except:
+            _kill(p)
+            output.join()
+            p.stdout.close()
+            raise
+        _log_output(p, output)
+    finally:
+        # if the knowledge compiler never opened the pipe, the reader is still waiting for it
+        while reader.is_alive():
+            try:
+                os.close(os.open(fifo, os.O_WRONLY | os.O_NONBLOCK))
+            except OSError:
+                pass
+            reader.join(0.01)
+        for path in [ base, fifo ]:
+            os.remove(path)
+            my_signals.tempfiles.discard(path)
+
+    if p.returncode != 0:
+        raise Exception(f"Knowledge compilation failed with exit code {p.returncode}.")
+    if "error" in result:
+        raise result["error"]
+    return result["circuit"]
+
+def _start_output_logging(p):
+    """Starts a thread that logs the output of a knowledge compiler until it closes its stdout."""
+    def log():
+        logger.debug("Knowledge compiler output:")
+        for line in iter(p.stdout.readline, b''):
+            logger.debug(line.decode()[:-1])
+    reader = threading.Thread(target = log, daemon = True)
+    reader.start()
+    return reader
+
+def _log_output(p, reader = None):
+    """Logs the output of a knowledge compiler while waiting for it and kills it if the deadline of the current thread passes.
+
+    If the output is already logged by the thread `reader` from `_start_output_logging`, no other thread is started.
+    """
+    if reader is None:
+        reader = _start_output_logging(p)
+    try:
+        p.wait(timeout = deadline.remaining())
+    except subprocess.TimeoutExpired:
+        _kill(p)
+        raise DeadlineExceeded("The knowledge compiler was stopped at the deadline of the query.")
+    finally:
+        reader.join()
+        p.stdout.close()
+
+def _memory():
+    # the same cache size as in CNF.compile_single
+    return max(psutil.virtual_memory().available//1024**2 - 125, 1000)
+
+def load(path, knowledge_compiler, vtree = None):
+    """Loads a compiled circuit from a file.
+
+    The file is removed afterwards unless the circuit needs to stay in it, which is the case for `miniC2D`.
+
+    Args:
+        path (:obj:`string`): The path to the file that contains the circuit.
+        knowledge_compiler (:obj:`string`): The knowledge compiler the circuit is from.
+        vtree (:obj:`aspmc.compile.vtree.Vtree`, optional): The vtree if the knowledge compiler is `miniC2D`. Defaults to `None`.
+    Returns:
+        :obj:`counterfactuals.circuit.CompiledCircuit`: The compiled circuit. 
+            For `miniC2D` a `counterfactuals.circuit.NNFFile` is returned instead.
+    """
+    if knowledge_compiler == "miniC2D":
+        return NNFFile(path, knowledge_compiler, vtree = vtree)
+    try:
+        return CompiledCircuit.load(path, solver = knowledge_compiler)
+    finally:
+        os.remove(path)
+        my_signals.tempfiles.discard(path)
+
+def command(file_name, knowledge_compiler, memory, nnf_name = None):
+    """Gets the command that runs a knowledge compiler in the same way as `CNF.compile_single`.
+
+    Args:
+        file_name (:obj:`string`): The path of the CNF file prepared by `prepare`.
+        knowledge_compiler (:obj:`string`): The knowledge compiler to use.
+        memory (:obj:`int`): The number of megabytes the knowledge compiler may use for its cache.
+        nnf_name (:obj:`string`, optional): Where the circuit should be written to. 
+            Only supported for the knowledge compilers in `PIPE_COMPILERS`. Defaults to `file_name + ".nnf"`.
+    Returns:
+        tuple: The list of arguments and the working directory of the knowledge compiler.
+    """
+    if nnf_name is None:
+        nnf_name = file_name + ".nnf"
+    if knowledge_compiler == "c2d":
+        return [ os.path.join(src_path, "c2d/bin/c2d_linux"), "-smooth_all", "-reduce", "-in", file_name, "-dt_in", file_name + ".dtree", "-cache_size", str(memory) ], None
+    elif knowledge_compiler == "miniC2D":
+        return [ os.path.join(src_path, "miniC2D/bin/linux/miniC2D"), "-c", file_name, "-v", file_name + ".vtree", "-s" , str(memory) ], None
+    elif knowledge_compiler == "sharpsat-td":
+        decot = max(float(config["decot"]), 0.1)
+        if deadline.remaining() is not None:
+            decot = min(decot, max(deadline.remaining(), 0.1))
+        tmpdir = os.path.join(io_config["tmpdir"] or tempfile.gettempdir(), "")
+        return [ "./sharpSAT", "-dDNNF", "-decot", str(decot), "-decow", "100", "-tmpdir", tmpdir, "-cs", str(memory//2), file_name, "-dDNNF_out", nnf_name ], os.path.join(src_path, "sharpsat-td/bin/")
+    elif knowledge_compiler == "d4":
+        return [ os.path.join(src_path, "d4/d4_static"), file_name, "-dDNNF", f"-out={nnf_name}", "-smooth" ], None
+    raise Exception(f"Unknown knowledge compiler {knowledge_compiler}.")
+
+def _kill(process):
+    try:
+        for child in psutil.Process(process.pid).children(recursive = True):
+            child.kill()
+        process.kill()
+    except psutil.NoSuchProcess:
+        pass
+    process.wait()
+
+def wins():
+    """Gets how often each knowledge compiler won a portfolio race.
+
+    Returns:
+        dict: A dictionary from knowledge compilers to their number of wins.
+    """
+    with _wins_lock:
+        return dict(_load_wins())
+
+def _load_wins():
+    """Gets the wins, which are read from the stats file the first time. Must be called with `_wins_lock` held."""
+    global _wins
+    if _wins is None:
+        _wins = {}
+        stats_file = portfolio_config["stats_file"]
+        if stats_file is not None and os.path.isfile(stats_file):
+            try:
+                with open(stats_file) as in_file:
+                    _wins = dict(json.load(in_file))
+            except (OSError, ValueError, TypeError) as e:
+                # the stats only order the knowledge compilers, so an unreadable file counts as empty
+                logger.warning(f"Could not read the portfolio stats from {stats_file}: {e}")
+    return _wins
+
+def record_win(knowledge_compiler):
+    """Records that a knowledge compiler won a portfolio race.
+
+    Args:
+        knowledge_compiler (:obj:`string`): The knowledge compiler that won.
+    Returns:
+        None
+    """
+    with _wins_lock:
+        current = _load_wins()
+        current[knowledge_compiler] = current.get(knowledge_compiler, 0) + 1
+        stats_file = portfolio_config["stats_file"]
+        if stats_file is not None:
+            # write to a temporary file in the same directory first, 
+            # such that other processes never read a half written file
+            fd, tmp_path = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(stats_file)))
+            try:
+                with os.fdopen(fd, 'w') as out_file:
+                    json.dump(current, out_file)
+                os.replace(tmp_path, stats_file)
+            except:
+                os.remove(tmp_path)
+                raise
+
+def compile_portfolio(cnf, compilers = None, timeouts = None, max_parallel = None):
+    """Compiles a CNF by racing several knowledge compilers and keeping the first circuit.
+
+    The knowledge compilers are started in the order of their previous wins.
+    If at most `max_parallel` may run at the same time, the others are started when one of the running ones fails.
+    As soon as one knowledge compiler succeeds all the others are killed and their temporary files are removed.
+    The same happens if the deadline of the current thread passes, after which `DeadlineExceeded` is raised.
+
+    Args:
+        cnf (:obj:`aspmc.compile.cnf.CNF`): The CNF to compile.
+        compilers (:obj:`list`, optional): The knowledge compilers to race. Defaults to `portfolio_config["compilers"]`.
+        timeouts (:obj:`dict`, optional): A dictionary from knowledge compilers to the number of seconds after which they are given up.
+            Defaults to `portfolio_config["timeouts"]`.
+        max_parallel (:obj:`int`, optional): How many knowledge compilers may run at the same time.
+            Defaults to `portfolio_config["max_parallel"]`.
+    Returns:
+        tuple: The knowledge compiler that won and the compiled circuit as returned by `compile_cnf`.
+    """
+    if compilers is None:
+        compilers = portfolio_config["compilers"]
+    if timeouts is None:
+        timeouts = portfolio_config["timeouts"]
+    if max_parallel is None:
+        max_parallel = portfolio_config["max_parallel"]
+    if max_parallel is None:
+        max_parallel = len(compilers)
+    # prefer the knowledge compilers that won most often in the past
+    current_wins = wins()
+    waiting = sorted(compilers, key = lambda c: -current_wins.get(c, 0))
+    memory = _memory()//max_parallel
+
+    running = {}
+    winner = None
+    try:
+        while winner is None and (len(waiting) > 0 or len(running) > 0):
+            while len(waiting) > 0 and len(running) < max_parallel:
+                knowledge_compiler = waiting.pop(0)
+                cnf_tmp, vtree = prepare(cnf, knowledge_compiler)
+                my_signals.tempfiles.add(cnf_tmp + '.nnf')
+                args, cwd = command(cnf_tmp, knowledge_compiler, memory)
+                try:
+                    p = subprocess.Popen(args, cwd = cwd, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+                except OSError as e:
+                    logger.warning(f"Could not start knowledge compiler {knowledge_compiler}: {e}")
+                    cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+                    continue
+                running[knowledge_compiler] = (p, cnf_tmp, vtree, time.time())
+
+            time.sleep(0.01)
+            deadline.check()
+            for knowledge_compiler, (p, cnf_tmp, vtree, start) in list(running.items()):
+                if p.poll() is not None:
+                    del running[knowledge_compiler]
+                    if p.returncode == 0 and os.path.isfile(cnf_tmp + ".nnf"):
+                        winner = (knowledge_compiler, cnf_tmp, vtree)
+                        logger.info(f"Portfolio won by {knowledge_compiler} after {time.time() - start} seconds")
+                        break
+                    logger.warning(f"Knowledge compiler {knowledge_compiler} failed with exit code {p.returncode}.")
+                    cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+                elif knowledge_compiler in timeouts and time.time() - start > timeouts[knowledge_compiler]:
+                    del running[knowledge_compiler]
+                    logger.warning(f"Knowledge compiler {knowledge_compiler} timed out.")
+                    _kill(p)
+                    cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+    finally:
+        for knowledge_compiler, (p, cnf_tmp, vtree, start) in running.items():
+            _kill(p)
+            cleanup(cnf_tmp, knowledge_compiler, keep_nnf = False)
+
+    if winner is None:
+        raise Exception("All knowledge compilers of the portfolio failed.")
+    knowledge_compiler, cnf_tmp, vtree = winner
+    record_win(knowledge_compiler)
+    cleanup(cnf_tmp, knowledge_compiler)
+    return knowledge_compiler, load(cnf_tmp + ".nnf", knowledge_compiler, vtree = vtree)
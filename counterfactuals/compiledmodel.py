@@ -0,0 +1,557 @@
+"""
+Compiled model module providing an immutable compiled program that can be queried from many threads at once.
+"""
+
+import os
+import heapq
+import pickle
+import logging
+import importlib
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+
+import numpy as np
+
+from aspmc.util import *
+
+from counterfactuals.circuit import LiteralWeights, batch_size, select_columns
+from counterfactuals.precision import Precision
+from counterfactuals.exceptions import ContradictoryEvidence
+
+logger = logging.getLogger("WhatIf")
+
+class _SpecializationCache(object):
+    """The specialized circuits of a model, which are shared by all the models with the same circuit."""
+    def __init__(self, size):
+        self.size = size
+        self.circuits = OrderedDict()
+        self.lock = threading.Lock()
+
+class CompiledModel(object):
+    """A compiled top down circuit together with everything that is needed to answer counterfactual queries on it.
+
+    A model is produced once by `CounterfactualProgram.compile` and never changes afterwards.
+    Every query builds its literal weights and the intermediate values of the circuit locally,
+    so one model can be evaluated by many threads at the same time.
+    Changing the probabilities of facts gives a new model that shares the circuit, see `with_weights`.
+
+    For interventions that are queried often, the model can keep a smaller circuit in which the weights
+    of the intervention conditioners are fixed, see `specialize`.
+    The interventions that make a query most likely can be searched for with `top_k_interventions`.
+
+    Args:
+        circuit (:obj:`CompiledCircuit`): The compiled circuit, or an `NNFFile`.
+        semiring (:obj:`module`): The semiring the circuit is evaluated in.
+        weights (dict): A dictionary mapping the names of the weighted atoms to their weights.
+        facts (list): The names of the probabilistic facts.
+        var_map (dict): A dictionary mapping the names of the weighted atoms to their variables.
+        intervention_atoms (dict): A dictionary mapping names to their atoms in the intervention part.
+        evidence_atoms (dict): A dictionary mapping names to their atoms in the evidence part.
+        conditioners (dict): A dictionary mapping atoms in the intervention part to the pair of variables
+            that intervene on them positively and negatively.
+        max_var (:obj:`int`): The largest variable of the program.
+        aux_weights (list): The weights of the literals of the auxilliary variables of the CNF,
+            that is, of the variables larger than `max_var`.
+        specialization_cache_size (:obj:`int`, optional): How many specialized circuits are kept. Defaults to `16`.
+        fingerprint (:obj:`string`, optional): A fingerprint of the rules of the program the circuit was compiled from. 
+            Defaults to `None`.
+
+    Attributes:
+        circuit (:obj:`CompiledCircuit`): The compiled circuit.
+        semiring (:obj:`module`): The semiring the circuit is evaluated in.
+        weights (:obj:`mappingproxy`): A read-only dictionary mapping the names of the weighted atoms to their weights.
+        facts (tuple): The names of the probabilistic facts.
+        fingerprint (:obj:`string`): A fingerprint of the rules of the program the circuit was compiled from, or `None`.
+    """
+    def __init__(self, circuit, semiring, weights, facts, var_map, intervention_atoms, evidence_atoms, conditioners, max_var, aux_weights, specialization_cache_size = 16, fingerprint = None):
+        self.circuit = circuit
+        self.semiring = semiring
+        self.weights = MappingProxyType(dict(weights))
+        self.facts = tuple(facts)
+        self._var_map = MappingProxyType(dict(var_map))
+        self._intervention_atoms = MappingProxyType(dict(intervention_atoms))
+        self._evidence_atoms = MappingProxyType(dict(evidence_atoms))
+        self._conditioners = MappingProxyType(dict(conditioners))
+        self._max = max_var
+        # the CNF keeps the weights as batches of size one, but they are the same for every column
+        self._aux_weights = tuple(np.asarray(w).reshape(np.shape(semiring.one())) for w in aux_weights)
+        self._specialized = _SpecializationCache(specialization_cache_size)
+        self.fingerprint = fingerprint
+
+    def with_weights(self, weights):
+        """Gets a model with different probabilities of some facts that shares the circuit with this one.
+
+        Args:
+            weights (dict): A dictionary mapping names of facts to their new probabilities.
+        Returns:
+            :obj:`CompiledModel`: The new model.
+        """
+        for name, weight in weights.items():
+            if name not in self.facts:
+                raise Exception(f"Unknown fact {name}.")
+            if weight < 0.0 or weight > 1.0:
+                raise Exception(f"Invalid probability {weight} for fact {name}.")
+        new_weights = dict(self.weights)
+        new_weights.update(weights)
+        model = CompiledModel(self.circuit, self.semiring, new_weights, self.facts, self._var_map,
+            self._intervention_atoms, self._evidence_atoms, self._conditioners, self._max, self._aux_weights, 
+            fingerprint = self.fingerprint)
+        # the specialized circuits do not depend on the weights of the facts
+        model._specialized = self._specialized
+        return model
+
+    def simplified(self):
+        """Gets a model with the same weights whose circuit is simplified.
+
+        The literals of auxilliary variables whose weights are always one or zero are propagated through the circuit,
+        and structurally equal nodes are merged. See `CompiledCircuit.simplify`.
+
+        Returns:
+            :obj:`CompiledModel`: The new model.
+        """
+        return CompiledModel(self.circuit.simplify(self._constants()), self.semiring, self.weights, self.facts, self._var_map,
+            self._intervention_atoms, self._evidence_atoms, self._conditioners, self._max, self._aux_weights, 
+            specialization_cache_size = self._specialized.size, fingerprint = self.fingerprint)
+
+    def _constants(self, interventions = None):
+        """Gets the literals whose weights are one or zero for every query, or for every query with the given interventions.
+
+        Args:
+            interventions (:obj:`dict`, optional): A dictionary mapping names to phases as in `query`.
+                If it is given, the weights of the intervention conditioners are fixed as well. Defaults to `None`.
+        Returns:
+            dict: A dictionary mapping literals to `True` if their weight is one and to `False` if it is zero.
+        """
+        constants = {}
+        def add(v, weight):
+            if np.all(weight == self.semiring.one()):
+                constants[to_dimacs(v)] = True
+            elif np.all(weight == self.semiring.zero()):
+                constants[to_dimacs(v)] = False
+        for i, weight in enumerate(self._aux_weights):
+            add(self._max*2 + i, weight)
+        if interventions is not None:
+            weight_list = self.literal_weights(interventions, {}, [ {} ])
+            for pos_var, neg_var in self._conditioners.values():
+                for var in [ pos_var, neg_var ]:
+                    add(to_pos(var), weight_list[to_pos(var)])
+                    add(neg(to_pos(var)), weight_list[neg(to_pos(var))])
+        return constants
+
+    @staticmethod
+    def _intervention_key(interventions):
+        return frozenset((name, bool(phase)) for name, phase in interventions.items())
+
+    def specialize(self, interventions):
+        """Prepares a circuit that is specialized to the given interventions.
+
+        The weights of all the intervention conditioners are fixed by the interventions,
+        so they can be propagated through the circuit, which usually makes it much smaller.
+        Afterwards, all queries with exactly these interventions are evaluated on the specialized circuit.
+        The specialized circuits are shared with the models created by `with_weights`,
+        and the least recently used one is dropped if there are too many.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `query`.
+        Returns:
+            int: The number of nodes of the specialized circuit.
+        """
+        key = self._intervention_key(interventions)
+        cache = self._specialized
+        with cache.lock:
+            if key in cache.circuits:
+                cache.circuits.move_to_end(key)
+                return cache.circuits[key].size()
+        circuit = self.circuit.simplify(self._constants(interventions))
+        with cache.lock:
+            cache.circuits[key] = circuit
+            while len(cache.circuits) > cache.size:
+                cache.circuits.popitem(last = False)
+        logger.debug(f"Specialized circuit for {dict(key)} has {circuit.size()} nodes")
+        return circuit.size()
+
+    def _circuit_for(self, interventions):
+        """Gets the specialized circuit for the interventions if there is one and the full circuit otherwise."""
+        if interventions is None:
+            return self.circuit
+        key = self._intervention_key(interventions)
+        cache = self._specialized
+        with cache.lock:
+            if key in cache.circuits:
+                cache.circuits.move_to_end(key)
+                return cache.circuits[key]
+        return self.circuit
+
+    def size(self):
+        """Counts the nodes of the circuit.
+
+        Returns:
+            int: The number of nodes, which is the number of batch vectors that are alive during counting.
+        """
+        return self.circuit.size()
+
+    def memory(self):
+        """Estimates the memory of the circuit and the specialized circuits of the model.
+
+        Returns:
+            int: The approximate number of bytes.
+        """
+        with self._specialized.lock:
+            specialized = list(self._specialized.circuits.values())
+        return self.circuit.memory() + sum(circuit.memory() for circuit in specialized)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        # the semiring is a module, and the specialized circuits are rebuilt when they are needed
+        state["semiring"] = self.semiring.__name__
+        for key in [ "weights", "_var_map", "_intervention_atoms", "_evidence_atoms", "_conditioners" ]:
+            state[key] = dict(state[key])
+        state["_specialized"] = self._specialized.size
+        return state
+
+    def __setstate__(self, state):
+        # snapshots of older versions have no fingerprint
+        state.setdefault("fingerprint", None)
+        self.__dict__.update(state)
+        self.semiring = importlib.import_module(state["semiring"])
+        for key in [ "weights", "_var_map", "_intervention_atoms", "_evidence_atoms", "_conditioners" ]:
+            setattr(self, key, MappingProxyType(state[key]))
+        self._specialized = _SpecializationCache(state["_specialized"])
+
+    def save(self, path):
+        """Saves a snapshot of the model, from which it can be loaded without compiling it again.
+
+        The specialized circuits are not saved.
+        Circuits that stay in a file are saved with the contents of the file.
+
+        Args:
+            path (:obj:`string`): The path of the snapshot.
+        Returns:
+            None
+        """
+        # write to a temporary file first, such that a snapshot is never half written
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as snapshot:
+            pickle.dump(self, snapshot, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path):
+        """Loads a snapshot of a model that was saved with `save`.
+
+        Args:
+            path (:obj:`string`): The path of the snapshot.
+        Returns:
+            :obj:`CompiledModel`: The model.
+        """
+        with open(path, "rb") as snapshot:
+            return pickle.load(snapshot)
+
+    def close(self):
+        """Releases the resources of the circuit.
+
+        Afterwards neither this model nor the models that share its circuit can be queried.
+
+        Returns:
+            None
+        """
+        self.circuit.close()
+
+    def fact_var(self, name):
+        """Gets the variable of a probabilistic fact.
+
+        Args:
+            name (:obj:`string`): The name of the fact.
+        Returns:
+            int: The variable. Its weights are in `2*(var-1)` and `2*(var-1)+1` of the weights of `literal_weights`.
+        """
+        return self._var_map[name]
+
+    def can_intervene(self, interventions):
+        """Checks whether the circuit has conditioners for all the intervened atoms.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `query`.
+        Returns:
+            bool: `True` if the interventions can be evaluated on this model.
+        """
+        return all(self._intervention_atoms.get(name) in self._conditioners for name in interventions)
+
+    def literal_weights(self, interventions, evidence, conjunctions, repeat = 1):
+        """Prepares the literal weights for one batched pass over the circuit.
+
+        The batch has `len(conjunctions)*repeat` columns.
+        Column `r*len(conjunctions) + i` corresponds to the query `conjunctions[i]` in repetition `r`.
+        Only the weights of the literals in the conjunctions have one value per column, 
+        all the others are shared by the whole batch.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `query`.
+            evidence (dict): A dictionary mapping names to phases as in `query`.
+            conjunctions (list): For each query a dictionary mapping names to phases of the atoms in the intervention part
+                that must hold. The empty dictionary gives the probability of the evidence.
+            repeat (:obj:`int`, optional): How often the queries should be repeated along the batch axis. Defaults to `1`.
+        Returns:
+            :obj:`LiteralWeights`: The weights of the literals of all the variables of the circuit.
+                The weight for literal `v` is in `weights[2*(v-1)]`, the one for `-v` is in `weights[2*(v-1)+1]`.
+        """
+        query_cnt = len(conjunctions)
+        batch_cnt = query_cnt*repeat
+        dtype = self.semiring.dtype
+        one = np.array(self.semiring.one(), dtype=dtype)
+        one.setflags(write = False)
+        weight_list = LiteralWeights([ one for _ in range(self._max*2) ], batch_cnt, dtype = dtype, value_shape = np.shape(one))
+        for name, weight in self.weights.items():
+            weight_list[to_pos(self._var_map[name])] = np.array(weight, dtype=dtype)
+            weight_list[neg(to_pos(self._var_map[name]))] = np.array(self.semiring.negate(weight), dtype=dtype)
+        for i, conjunction in enumerate(conjunctions):
+            for name, phase in conjunction.items():
+                if phase:
+                    weight_list.override(to_pos(self._intervention_atoms[name]), slice(i, None, query_cnt), self.semiring.zero())
+                else:
+                    weight_list.override(neg(to_pos(self._intervention_atoms[name])), slice(i, None, query_cnt), self.semiring.zero())
+
+        for name, phase in interventions.items():
+            intervention_atom = self._intervention_atoms[name]
+            if intervention_atom not in self._conditioners:
+                raise Exception(f"Can not intervene on {name}, since it was not declared intervenable.")
+            if phase:
+                conditioner_atom = self._conditioners[intervention_atom][1]
+            else:
+                conditioner_atom = self._conditioners[intervention_atom][0]
+            weight_list[to_pos(conditioner_atom)] = np.array(1.0, dtype=dtype)
+            weight_list[neg(to_pos(conditioner_atom))] = np.array(0.0, dtype=dtype)
+
+        for name, phase in evidence.items():
+            evidence_atom = self._evidence_atoms[name]
+            if phase:
+                weight_list[to_pos(evidence_atom)] = np.array(0.0, dtype=dtype)
+            else:
+                weight_list[neg(to_pos(evidence_atom))] = np.array(0.0, dtype=dtype)
+        weight_list.extend(self._aux_weights)
+        return weight_list
+
+    def count(self, weight_list, interventions = None, evaluator = None, precision = None):
+        """Performs one batched counting pass over the circuit.
+
+        Args:
+            weight_list (list): The weights of the literals as returned by `literal_weights`.
+            interventions (:obj:`dict`, optional): The interventions the weights were prepared for.
+                If they are given and were specialized, the specialized circuit is used. Defaults to `None`.
+            evaluator (:obj:`IncrementalEvaluator`, optional): An evaluator that only recomputes the nodes
+                affected by the weights that changed since its last evaluation. It must not be shared between threads.
+                Defaults to `None`, which evaluates the whole circuit.
+            precision (:obj:`Precision`, optional): The floating point type and space to count in. 
+                Its report is updated with the accuracy of the counts. Defaults to `None`, which counts in the semiring.
+        Returns:
+            :obj:`np.array`: The weighted model counts for each column of the batch. 
+                If the precision is in log space, these are the logarithms of the counts.
+        """
+        circuit = self._circuit_for(interventions)
+        if precision is None:
+            zero, one, dtype, log_space = self.semiring.zero(), self.semiring.one(), self.semiring.dtype, False
+            converted = weight_list
+        else:
+            if np.dtype(self.semiring.dtype).kind != "f" or np.ndim(self.semiring.one()) > 0:
+                raise Exception("Reduced precision is only supported for semirings of floating point numbers.")
+            zero, one, dtype, log_space = precision.zero(), precision.one(), precision.dtype, precision.log_space
+            converted = LiteralWeights([ precision.convert(w) for w in weight_list ], batch_size(weight_list), dtype = dtype)
+        if evaluator is not None:
+            counts = evaluator.evaluate(circuit, converted, zero = zero, one = one, dtype = dtype, log_space = log_space)
+        else:
+            counts = circuit.evaluate(converted, zero = zero, one = one, dtype = dtype, log_space = log_space)
+        if precision is not None:
+            self._check_precision(circuit, weight_list, counts, precision)
+        return counts
+
+    def _check_precision(self, circuit, weight_list, counts, precision):
+        """Reports the accuracy of counts that were computed with reduced precision.
+
+        Args:
+            circuit (:obj:`CompiledCircuit`): The circuit that computed the counts.
+            weight_list (list): The weights of the literals before they were converted.
+            counts (:obj:`np.array`): The counts.
+            precision (:obj:`Precision`): The precision of the counts.
+        Returns:
+            None
+        """
+        error_bound = None
+        if not precision.log_space:
+            error_bound = circuit.rounding_error(precision.unit_roundoff())
+        checked = min(precision.check_samples, len(counts))
+        max_deviation = None
+        if checked > 0:
+            columns = np.random.default_rng().choice(len(counts), size = checked, replace = False)
+            exact = Precision(np.float64, log_space = precision.log_space)
+            selected = select_columns(weight_list, columns)
+            converted = LiteralWeights([ exact.convert(w) for w in selected ], checked, dtype = exact.dtype)
+            exact_counts = circuit.evaluate(converted, zero = exact.zero(), one = exact.one(), dtype = exact.dtype, log_space = exact.log_space)
+            max_deviation = precision.deviation(counts[columns], exact_counts)
+        precision.record(error_bound, checked, max_deviation)
+
+    def max_product(self, weight_list, interventions = None):
+        """Computes the model of the circuit with the maximal product of literal weights for the first column of the batch.
+
+        Args:
+            weight_list (list): The weights of the literals as returned by `literal_weights`.
+            interventions (:obj:`dict`, optional): The interventions the weights were prepared for, as for `count`.
+                Defaults to `None`.
+        Returns:
+            tuple: The maximal product and the set of literals of a model that attains it.
+        """
+        return self._circuit_for(interventions).max_product(weight_list.column(0))
+
+    def query(self, interventions, evidence, queries):
+        """Evaluates counterfactual queries on the model.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases,
+                indicating that the atom with name `name` should be intervened positively (phase == False) or negatively.
+            evidence (dict): A dictionary mapping names to phases,
+                indicating that the atom with name `name` must have been true (phase == False) or false.
+            queries (list): A list of strings, indicating that we want to query the probabilities of the atoms
+                under the given interventions and evidence.
+        Returns:
+            list: A list containing the results of the counterfactual queries in the order they were given in `queries`.
+        """
+        return self.conjunctive_query(interventions, evidence, [ { query : False } for query in queries ])
+
+    def conjunctive_query(self, interventions, evidence, conjunctions, evaluator = None, precision = None):
+        """Evaluates the probabilities of conjunctions of atoms in the intervention part on the model.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `query`.
+            evidence (dict): A dictionary mapping names to phases as in `query`.
+            conjunctions (list): A list of dictionaries mapping names to phases,
+                indicating that we want to query the probability that all the atoms with name `name`
+                are true (phase == False) or false, respectively, under the given interventions and evidence.
+            evaluator (:obj:`IncrementalEvaluator`, optional): The evaluator to count with, see `count`. Defaults to `None`.
+            precision (:obj:`Precision`, optional): The precision to count with, see `count`. Defaults to `None`.
+        Returns:
+            list: A list containing the results of the conjunctive queries in the order they were given in `conjunctions`.
+        """
+        weight_list = self.literal_weights(interventions, evidence, [ {} ] + list(conjunctions))
+        results = self.count(weight_list, interventions = interventions, evaluator = evaluator, precision = precision)
+        if precision is not None:
+            if precision.is_zero(results[0]):
+                raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
+            return list(precision.ratio(results[1:], results[0]))
+        if results[0] <= 0.0:
+            raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
+        return [ result/results[0] for result in results[1:] ]
+
+    def _search_weights(self, evidence, conjunction, columns):
+        """Prepares the literal weights for scoring many interventions in one batched pass over the circuit.
+
+        Column `0` gives the probability of the evidence, column `i + 1` the probability of the evidence and the conjunction
+        under the interventions `columns[i][0]`, where the atoms in `columns[i][1]` are free.
+        For a free atom the weights of both its conditioners are `1` for both literals,
+        so that the count sums up over not intervening on it and intervening on it positively and negatively.
+
+        Args:
+            evidence (dict): A dictionary mapping names to phases as in `query`.
+            conjunction (dict): A dictionary mapping names to phases of the atoms in the intervention part that must hold.
+            columns (list): A list of pairs of interventions as in `query` and lists of names of free atoms.
+        Returns:
+            list: The weights of the literals of all the variables of the circuit as for `literal_weights`.
+        """
+        weight_list = self.literal_weights({}, evidence, [ {} ] + [ conjunction ]*len(columns))
+        for i, (interventions, free) in enumerate(columns, 1):
+            for name, phase in interventions.items():
+                conditioner_atom = self._conditioners[self._intervention_atoms[name]][1 if phase else 0]
+                weight_list.override(to_pos(conditioner_atom), i, 1.0)
+                weight_list.override(neg(to_pos(conditioner_atom)), i, 0.0)
+            for name in free:
+                for conditioner_atom in self._conditioners[self._intervention_atoms[name]]:
+                    weight_list.override(to_pos(conditioner_atom), i, 1.0)
+                    weight_list.override(neg(to_pos(conditioner_atom)), i, 1.0)
+        return weight_list
+
+    def top_k_interventions(self, evidence, query, k = 1, max_size = 1, candidates = None, batch_size = 1024):
+        """Searches for the interventions under which a query is most likely given the evidence.
+
+        The intervention sets are searched by branch and bound, level by level in the number of intervened atoms.
+        All the sets of one level are scored in batched passes over the circuit by setting the conditioner weights per column.
+        Each set that can still be extended also gets a column in which all the atoms it can be extended with are free.
+        This sums up over all the ways to intervene on them and is therefore an upper bound for all its extensions,
+        which are pruned if the bound is not larger than the `k`-th best probability found so far.
+
+        Args:
+            evidence (dict): A dictionary mapping names to phases,
+                indicating that the atom with name `name` must have been true (phase == False) or false.
+            query (:obj:`string` or dict): The name of the atom to maximize the probability of,
+                or a dictionary mapping names to phases for a conjunction as in `conjunctive_query`.
+            k (:obj:`int`, optional): How many interventions should be returned. Defaults to `1`.
+            max_size (:obj:`int`, optional): The largest number of atoms that are intervened on at once. Defaults to `1`.
+            candidates (:obj:`list`, optional): The names of the atoms that may be intervened on.
+                Defaults to `None`, which means all the atoms that can be intervened on.
+            batch_size (:obj:`int`, optional): The largest number of columns per pass over the circuit. Defaults to `1024`.
+        Returns:
+            list: A list of at most `k` pairs of interventions, given as dictionaries mapping names to phases as in `query`,
+                and the probability of the query under them, ordered by decreasing probability.
+        """
+        if k < 1:
+            raise Exception(f"Can not search for the best {k} interventions.")
+        if candidates is None:
+            candidates = [ name for name, atom in self._intervention_atoms.items() if atom in self._conditioners ]
+        candidates = list(candidates)
+        for name in candidates:
+            if self._intervention_atoms[name] not in self._conditioners:
+                raise Exception(f"Can not intervene on {name}, since it was not declared intervenable.")
+        if isinstance(query, str):
+            conjunction = { query : False }
+        else:
+            conjunction = dict(query)
+
+        # the best interventions so far as a heap of (count, position, interventions)
+        best = []
+        found = 0
+        evidence_count = None
+        # the intervention sets of the current level as pairs of the chosen (index, phase) pairs 
+        # and the first index of the candidates they may be extended with
+        frontier = [ ((), 0) ]
+        while len(frontier) > 0:
+            columns = []
+            for chosen, start in frontier:
+                interventions = { candidates[i] : phase for i, phase in chosen }
+                if len(chosen) > 0:
+                    columns.append((interventions, ()))
+                if len(chosen) < max_size and start < len(candidates):
+                    columns.append((interventions, candidates[start:]))
+            results = []
+            for i in range(0, len(columns), batch_size):
+                counts = self.count(self._search_weights(evidence, conjunction, columns[i:i + batch_size]))
+                evidence_count = counts[0]
+                results.extend(counts[1:])
+            if evidence_count <= 0.0:
+                raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
+
+            # first use the exact counts, so that the bounds of the same level are compared to them
+            bounds = []
+            position = 0
+            for chosen, start in frontier:
+                if len(chosen) > 0:
+                    entry = (results[position], found, columns[position][0])
+                    found += 1
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    elif entry[0] > best[0][0]:
+                        heapq.heapreplace(best, entry)
+                    position += 1
+                if len(chosen) < max_size and start < len(candidates):
+                    bounds.append((chosen, start, results[position]))
+                    position += 1
+
+            frontier = []
+            pruned = 0
+            for chosen, start, bound in bounds:
+                if len(best) == k and bound <= best[0][0]:
+                    pruned += 1
+                    continue
+                for j in range(start, len(candidates)):
+                    for phase in [ False, True ]:
+                        frontier.append((chosen + ((j, phase), ), j + 1))
+            logger.debug(f"Intervention search scored {len(columns)} columns and pruned {pruned} of {len(bounds)} intervention sets.")
+
+        return [ (interventions, count/evidence_count) for count, _, interventions in sorted(best, key = lambda entry: (-entry[0], entry[1])) ]
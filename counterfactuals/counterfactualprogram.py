@@ -7,8 +7,10 @@ Program module providing the algebraic progam class.
 import logging
 
 
-import tempfile
 import os 
+import hashlib
+import itertools
+from collections import OrderedDict
 
 import networkx as nx
 
@@ -18,12 +20,12 @@ from array import array
 
 from aspmc.programs.program import Rule
 
+from lark import Lark
+from aspmc.parsing.lark_parser import GRAMMAR, ProblogTransformer
+
 import aspmc.graph.treedecomposition as treedecomposition
-from aspmc.compile.vtree import TD_to_vtree, TD_vtree
-from aspmc.compile.dtree import TD_dtree
+from aspmc.compile.vtree import TD_to_vtree
 from pysdd.sdd import SddManager, Vtree, WmcManager
-from aspmc.compile.cnf import CNF
-from aspmc.compile.circuit import Circuit
 
 from aspmc.config import config
 from aspmc.util import *
@@ -32,8 +34,29 @@ from aspmc.programs.naming import *
 
 import aspmc.signal_handling as my_signals
 
+import counterfactuals.compilation as compilation
+import counterfactuals.scheduler as scheduler
+import counterfactuals.deadline as deadline
+from counterfactuals.compiledmodel import CompiledModel
+from counterfactuals.circuit import IncrementalEvaluator
+from counterfactuals.simplification import simplify_program
+from counterfactuals.decomposition import independent_components, count_programs, decomposition_config
+from counterfactuals.exceptions import ContradictoryEvidence, DeadlineExceeded
+
 logger = logging.getLogger("WhatIf")
 
+# how many sets of intervened atoms the atoms that depend on them and the independent components are cached for in the bottom up case
+MAX_CACHED_CONES = 256
+
+# approximate number of bytes the sdd library uses per node and per element
+SDD_NODE_BYTES = 80
+SDD_ELEMENT_BYTES = 16
+
+# approximate number of bytes python uses per rule, per literal of a rule and per entry of a cache
+RULE_BYTES = 200
+LITERAL_BYTES = 8
+CACHE_ENTRY_BYTES = 200
+
 class SDDOperation(object):
     AND = 0
     OR = 1
@@ -67,12 +90,16 @@ class CounterfactualProgram(ProblogProgram):
         May be the empty string.
         program_files (:obj:`list`): A list of string that are paths to files which contain programs in 
         ProbLog syntax that should be included. May be an empty list.
+        intervenable (:obj:`list`, optional): The names of the atoms that may be intervened on in the top down multi-query case.
+        Only these atoms get conditioners in the compiled circuit, which keeps it small.
+        Queries that intervene on other atoms fall back to `single_query`. Defaults to `None`, meaning all derived atoms.
 
     Attributes:
         weights (:obj:`dict`): The dictionary from atom names to their weight.
         queries (:obj:`list`): The list of atoms to be queries in their string representation.
+        facts (:obj:`list`): The names of the probabilistic facts of the program.
     """
-    def __init__(self, program_str, program_files):
+    def __init__(self, program_str, program_files, intervenable = None):
         # initialize the superclass
         ProblogProgram.__init__(self, program_str, program_files)
         if len(self.queries) > 0:
@@ -83,26 +110,57 @@ class CounterfactualProgram(ProblogProgram):
         self._sdd_manager = None
         self._topological_ordering = None
         self._applyCache = {}
+        # the sdds of the guessed atoms, and those of the other atoms and rules without interventions
+        self._sdd_vars = {}
+        self._sdd_memo = {}
+        self._sdd_index = None
+        self._sdd_memory_options = {
+            "auto_gc_and_minimize" : False,
+            "dead_node_threshold" : None,
+            "live_node_threshold" : None,
+            "memory_threshold" : None,
+            "minimize_time_limit" : None,
+        }
         # attributes for the top down multi-query case
-        self._nnf = None
+        self._model = None
         self._intervention_conditioners = {}
-        self._vtree = None
+
+        # attributes for the result cache
+        self._result_cache = OrderedDict()
+        self._result_cache_size = 4096
+        self._result_cache_entries = 0
+
+        # the evaluator that keeps the node values between top down multi-queries, if enabled
+        self._evaluator = None
+        # the precision of batched evaluation, if it is not the one of the semiring
+        self._precision = None
+
+        # what the simplification of the last single query removed
+        self._simplification_stats = {}
+
+        # the counts of small independent components of single queries and how the last single query was decomposed
+        self._component_cache = OrderedDict()
+        self._decomposition_stats = {}
+
+        # remember the facts before any conditioners are added for the top down case
+        self.facts = list(self.weights)
 
         # duplicate the program such that we obtain an evidence part and a part for the intervention
         self.evidence_atoms = {}
         self.intervention_atoms = { self._external_name(var) : var for var in self._deriv }
+        if intervenable is not None:
+            for name in intervenable:
+                if name not in self.intervention_atoms:
+                    raise Exception(f"Can not intervene on {name}, since it is not a derived atom.")
+            self._intervenable = set(intervenable)
+        else:
+            self._intervenable = None
 
         def to_external(atom, postfix):
             assert(atom in self._deriv)
             cur_name = self._external_name(atom)
             if cur_name not in self.evidence_atoms:
-                idx = cur_name.find("(")
-                if idx == -1:
-                    idx = len(cur_name)
-                new_name = cur_name[:idx]
-                new_name += "_" + postfix
-                new_name += cur_name[idx:]
-                new_var = self._new_var(new_name) 
+                new_var = self._new_var(self._world_name(cur_name, postfix)) 
                 self.evidence_atoms[cur_name] = new_var
                 self._deriv.add(new_var)
             else:
@@ -134,13 +192,7 @@ class CounterfactualProgram(ProblogProgram):
 
         # now we can change the names of the intervention atoms
         for original_name, atom in self.intervention_atoms.items():
-            idx = original_name.find("(")
-            if idx == -1:
-                idx = len(original_name)
-            new_name = original_name[:idx]
-            new_name += "_i"
-            new_name += original_name[idx:]
-            self._nameMap[atom] = new_name
+            self._nameMap[atom] = self._world_name(original_name, "i")
 
         # make sure there is always an atom true that is true
         self.true = self._new_var("true")
@@ -149,8 +201,224 @@ class CounterfactualProgram(ProblogProgram):
 
         self._program = new_program
 
+    @staticmethod
+    def _world_name(name, postfix):
+        """Gets the name of the copy of an atom in the evidence (`postfix == "e"`) or intervention (`postfix == "i"`) part."""
+        idx = name.find("(")
+        if idx == -1:
+            idx = len(name)
+        return name[:idx] + "_" + postfix + name[idx:]
+
+    def update_weights(self, weights):
+        """Changes the probabilities of some facts.
+
+        The compiled circuits and SDDs do not depend on the probabilities, so nothing needs to be recompiled.
+
+        Args:
+            weights (dict): A dictionary mapping names of facts to their new probabilities.
+        Returns:
+            None
+        """
+        for name, weight in weights.items():
+            if name not in self.facts:
+                raise Exception(f"Unknown fact {name}.")
+            if weight < 0.0 or weight > 1.0:
+                raise Exception(f"Invalid probability {weight} for fact {name}.")
+        self.weights.update(weights)
+        if self._model is not None:
+            self._model = self._model.with_weights(weights)
+        self.clear_result_cache()
+
+    def add_rules(self, rules):
+        """Adds ground rules to the program.
+
+        The rules are added to both the evidence and the intervention part of the program.
+        Atoms that did not occur in the program before are added as derived atoms.
+        If the bottom up multi-query case was set up, the topological ordering is updated locally 
+        and the SDDs of the affected atoms are rebuilt when they are needed next.
+        If the top down multi-query case was set up, the circuit is recompiled before the next query.
+
+        Args:
+            rules (:obj:`string`): The rules in ProbLog syntax. They must be ground and may not have probabilities.
+        Returns:
+            None
+        """
+        new_rules = []
+        for head, body in self._parse_ground_rules(rules):
+            for postfix in [ "i", "e" ]:
+                new_rules.append(self._world_rule(head, body, postfix, create = True))
+        self._program += new_rules
+
+        if self._topological_ordering is not None:
+            self._insert_topological(new_rules)
+        self._invalidate_bottom_up_memo(new_rules)
+        self._invalidate_top_down()
+        self.clear_result_cache()
+
+    def remove_rules(self, rules):
+        """Removes ground rules from the program.
+
+        The rules are removed from both the evidence and the intervention part of the program.
+        The atoms of the rules stay in the program, even if they can no longer be derived.
 
-    def single_query(self, interventions, evidence, queries, strategy="sharpsat-td"):
+        Args:
+            rules (:obj:`string`): The rules in ProbLog syntax. They must occur in the program as given.
+        Returns:
+            None
+        """
+        to_remove = set()
+        for head, body in self._parse_ground_rules(rules):
+            for postfix in [ "i", "e" ]:
+                rule = self._world_rule(head, body, postfix, create = False)
+                to_remove.add((tuple(rule.head), frozenset(rule.body)))
+        found = set()
+        new_program = []
+        removed = set()
+        for rule in self._program:
+            key = (tuple(rule.head), frozenset(rule.body))
+            if key in to_remove:
+                found.add(key)
+                removed.add(rule)
+            else:
+                new_program.append(rule)
+        if len(found) != len(to_remove):
+            raise Exception("Can only remove rules that are in the program.")
+        self._program = new_program
+
+        if self._topological_ordering is not None:
+            self._topological_ordering = [ v for v in self._topological_ordering if v not in removed ]
+        self._invalidate_bottom_up_memo(removed)
+        self._invalidate_top_down()
+        self.clear_result_cache()
+
+    def _parse_ground_rules(self, rules):
+        """Parses ground rules without probabilities.
+
+        Args:
+            rules (:obj:`string`): The rules in ProbLog syntax.
+        Returns:
+            list: A list of pairs `(head, body)`, where `head` is the name of the head atom 
+                and `body` is a list of pairs `(name, negated)`.
+        """
+        my_grammar = GRAMMAR + f"%override weight : /{self.semiring.pattern}/ | variable\n"
+        parser = Lark(my_grammar, start='program', parser='lalr', transformer=ProblogTransformer())
+        result = []
+        for r in parser.parse(rules):
+            if isinstance(r, str) or r.weights is not None:
+                raise Exception(f"Only rules without probabilities can be changed: {r}")
+            if r.head is None or len(r.head) != 1:
+                raise Exception(f"Only rules with exactly one head atom can be changed: {r}")
+            atoms = r.head + r.body
+            if any(len(a.get_variables()) > 0 for a in atoms):
+                raise Exception(f"Only ground rules can be changed: {r}")
+            def name(a):
+                if len(a.inputs) == 0:
+                    return str(a.predicate)
+                return f"{a.predicate}({','.join(str(x) for x in a.inputs)})"
+            head = name(r.head[0])
+            if head in self.weights or head == "true":
+                raise Exception(f"The atom {head} can not be derived by a rule.")
+            result.append((head, [ (name(a), a.negated) for a in r.body ]))
+        return result
+
+    def _world_rule(self, head, body, postfix, create = False):
+        """Translates a parsed rule to a rule in the evidence (`postfix == "e"`) or intervention (`postfix == "i"`) part.
+
+        Args:
+            head (:obj:`string`): The name of the head atom.
+            body (list): A list of pairs `(name, negated)`.
+            postfix (:obj:`string`): Which part of the program the rule should be in.
+            create (:obj:`bool`, optional): Whether unknown atoms should be added as derived atoms. Defaults to `False`.
+        Returns:
+            :obj:`Rule`: The translated rule.
+        """
+        varMap = { name : var for var, name in self._nameMap.items() }
+        def get_atom(name):
+            if name in self.weights:
+                return varMap[name]
+            if name not in self.intervention_atoms:
+                if not create:
+                    raise Exception(f"Unknown atom {name}.")
+                atom = self._new_var(self._world_name(name, "i"))
+                self._deriv.add(atom)
+                self.intervention_atoms[name] = atom
+                copy = self._new_var(self._world_name(name, "e"))
+                self._deriv.add(copy)
+                self.evidence_atoms[name] = copy
+            if postfix == "i":
+                return self.intervention_atoms[name]
+            return self.evidence_atoms[name]
+        return Rule([ get_atom(head) ], [ -get_atom(name) if negated else get_atom(name) for name, negated in body ])
+
+    def _insert_topological(self, new_rules):
+        """Inserts new rules into the topological ordering of the bottom up case.
+
+        Falls back to computing a new topological ordering only if the new rules can not be inserted locally.
+
+        Args:
+            new_rules (list): The rules that were added to the program.
+        Returns:
+            None
+        """
+        position = { v : i for i, v in enumerate(self._topological_ordering) }
+        # atoms that were not in the ordering yet have no predecessors and go to the front
+        # rules for atoms that were not in the ordering yet go to the back together with their head
+        front = []
+        back = []
+        before = {}
+        for rule in new_rules:
+            head = rule.head[0]
+            for atom in rule.body:
+                if abs(atom) not in position:
+                    front.append(abs(atom))
+                    position[abs(atom)] = -1
+            if head not in position:
+                back += [ rule, head ]
+                position[head] = len(self._topological_ordering) + len(back)
+                continue
+            if max([ position[abs(atom)] for atom in rule.body ], default = -1) >= position[head]:
+                # the new rule does not fit into the ordering, so we need a new one
+                self._setup_topological_ordering()
+                return
+            if position[head] < len(self._topological_ordering):
+                before.setdefault(position[head], []).append(rule)
+            else:
+                back.insert(back.index(head), rule)
+        new_ordering = front
+        for i, v in enumerate(self._topological_ordering):
+            new_ordering += before.get(i, [])
+            new_ordering.append(v)
+        self._topological_ordering = new_ordering + back
+
+    def _invalidate_bottom_up_memo(self, changed):
+        """Drops the memoized SDDs of the bottom up case that depend on rules that were added or removed.
+
+        The SDDs of the heads of the changed rules and of everything that depends on them are dropped, 
+        all other memoized SDDs stay valid. The index of the rules is rebuilt for the changed program.
+
+        Args:
+            changed (iterable): The rules that were added to or removed from the program.
+        Returns:
+            None
+        """
+        heads = set()
+        for rule in changed:
+            self._sdd_memo.pop(rule, None)
+            if len(rule.head) > 0:
+                heads.add(rule.head[0])
+        self._sdd_index = None
+        if len(self._sdd_memo) > 0:
+            self._setup_sdd_index()
+            for node in self._intervention_cone(frozenset(heads)):
+                self._sdd_memo.pop(node, None)
+
+    def _invalidate_top_down(self):
+        """Drops the compiled model of the top down case such that it is recompiled before the next query."""
+        if self._model is not None:
+            self._model.close()
+            self._model = None
+
+    def single_query(self, interventions, evidence, queries, strategy="sharpsat-td", timeout = None):
         """Evaluates a single counterfactual query using the given strategy.
 
         Args:
@@ -165,11 +433,26 @@ class CounterfactualProgram(ProblogProgram):
                 * `c2d` for top down compilation to sd-DNNF with c2d,
                 * `miniC2D` for top down compilation to sd-DNNF with miniC2D,
                 * `d4` for top down compilation to sd-DNNF with d4,
-                * `sharpsat-td` for top down compilation to sd-DNNF with sharpsat-td.
+                * `sharpsat-td` for top down compilation to sd-DNNF with sharpsat-td,
+                * `td-dp` for dynamic programming over a tree decomposition of the CNF without an external knowledge compiler,
+                * `portfolio` for top down compilation to sd-DNNF with the first of several knowledge compilers that finishes
+                    (see `counterfactuals.compilation.portfolio_config`).
                 Defaults to `sharpsat-td`.
+            timeout (:obj:`float`, optional): The number of seconds after which decomposition, compilation and counting are given up.
+                The results are then computed as configured in `counterfactuals.deadline.fallback_config`
+                and returned as `counterfactuals.deadline.ApproximateResults`. Defaults to `None`, meaning no timeout.
         Returns:
             list: A list containing the results of the counterfactual queries in the order they were given in `queries`.
         """
+        return self._with_timeout(timeout, interventions, evidence, queries, 
+            lambda: self._cached_query(interventions, evidence, queries, 
+                lambda missing: self._single_query(interventions, evidence, missing, strategy=strategy)))
+
+    def _single_query(self, interventions, evidence, queries, strategy="sharpsat-td"):
+        """Evaluates a single counterfactual query using the given strategy without using the result cache.
+
+        See `single_query` for the arguments and the return value.
+        """
         tmp_program = [ ]
         atom_interventions = { self.intervention_atoms[name] : phase for name, phase in interventions.items() }
         for rule in self._program:
@@ -193,9 +476,18 @@ class CounterfactualProgram(ProblogProgram):
                 atom = self.intervention_atoms[name]
                 tmp_program.append(Rule([ atom ], []))
 
-        
+        # simplify the program before it is translated
+        varMap = { name : var for var, name in self._nameMap.items() }
+        true_atoms = [ varMap[name] for name, weight in self.weights.items() if weight == 1.0 ]
+        false_atoms = [ varMap[name] for name, weight in self.weights.items() if weight == 0.0 ]
+        protected = set([ self.true ])
+        protected.update(self.intervention_atoms[name] for name in queries)
+        protected.update(self.evidence_atoms[name] for name in evidence)
+        tmp_program, self._simplification_stats = simplify_program(tmp_program, self._guess, true_atoms, false_atoms, protected)
+        logger.info(f"Simplification removed {self._simplification_stats['rules'] - self._simplification_stats['remaining']} of {self._simplification_stats['rules']} rules")
+
         # evaluate the query using the given strategy
-        if strategy in ['c2d', 'miniC2D', 'd4', 'sharpsat-td']:
+        if strategy in compilation.TOP_DOWN_STRATEGIES:
             # reduce the program to the relevant part
             # set up the and/or graph
             graph = nx.DiGraph()
@@ -216,44 +508,41 @@ class CounterfactualProgram(ProblogProgram):
                 relevant.update(nx.ancestors(graph, self.evidence_atoms[atom]))
 
             tmp_program = [ r for r in tmp_program if r in relevant ]
-            tmp_program.append(Rule([self.true], []))
 
-            # finalize the program with the evidence and the queries
+            # split the relevant part into components that share no atoms, 
+            # such that the probability of a query given the evidence only depends on the evidence in its component
+            components = independent_components(tmp_program)
+            parts = OrderedDict()
+            def part(atom):
+                return parts.setdefault(components.get(atom, atom), ([], {}, []))
             for name, phase in evidence.items():
-                atom = self.evidence_atoms[name]
-                if phase:
-                    body = [ atom ]
-                else:
-                    body = [ -atom ]
-                tmp_program.append(Rule([],body))
-
-            self.queries = [ "true" ]
-            self.queries += [ self._external_name(self.intervention_atoms[name]) for name in queries ]
-            program_string = self._prog_string(tmp_program)
-            # create a new probabilistic program for inference
-            inference_program = ProblogProgram(program_string, [])
-            # perform CNF conversion, followed by top down knowledge compilation
-            inference_program.td_guided_both_clark_completion(adaptive = False, latest = True)
-            cnf = inference_program.get_cnf()
-            result = cnf.evaluate(strategy = "compilation")
-            # reorder the query results
-            other_queries = inference_program.get_queries()
-            to_idx = { query : idx for idx, query in enumerate(other_queries) }
-            sorted_result = [ ]
-            for query in self.queries:
-                if query in to_idx:
-                    sorted_result.append(result[to_idx[query]])
-                else:
-                    sorted_result.append(0.0)
-            if sorted_result[0] <= 0.0:
-                raise Exception("Contradictory evidence! Probablity given evidence is zero.")
-            final_results = [ value/sorted_result[0] for value in sorted_result[1:] ] 
+                part(self.evidence_atoms[name])[1][name] = phase
+            for name in queries:
+                part(self.intervention_atoms[name])[2].append(name)
+            for r in tmp_program:
+                # all the relevant rules have a head, since constraints are not ancestors of anything
+                part(r.head[0])[0].append(r)
+
+            tasks = [ self._component_program(rules, part_evidence, part_queries) + (len(rules), ) 
+                for rules, part_evidence, part_queries in parts.values() ]
+            counts = self._count_components(tasks, strategy)
+            results = {}
+            for (_, part_evidence, part_queries), part_counts in zip(parts.values(), counts):
+                evidence_count = part_counts[0] if len(part_evidence) > 0 else 1.0
+                if evidence_count <= 0.0:
+                    raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
+                for name, count in zip(part_queries, part_counts[1:]):
+                    results[name] = count/evidence_count
+            final_results = [ results[name] for name in queries ]
         elif strategy == 'pysdd':
             # perform bottom up compilation using pysdd
             # set up the sdd manager
-            sdd = self.setup_sdd_manager(tmp_program)
+            # the simplification may have removed facts, e.g. those with probability 0 or 1, 
+            # so only the facts that still occur get a variable
+            occurring = set(abs(atom) for r in tmp_program for atom in r.body)
+            guesses = [ v for v in self._guess if v in occurring ]
+            sdd = self.setup_sdd_manager(tmp_program, guesses)
             vars = list(sdd.vars)
-            guesses = list(self._guess)
             vertex_to_sdd = { v : vars[i] for i,v in enumerate(guesses) }
 
             # set up the and/or graph
@@ -277,6 +566,7 @@ class CounterfactualProgram(ProblogProgram):
             # build the relevant sdds by traversing the graph in topological order
             ts = nx.topological_sort(graph)
             for cur in ts:
+                deadline.check()
                 if isinstance(cur, Rule):
                     new_sdd = sdd.true()
                     for b in cur.body:
@@ -291,47 +581,357 @@ class CounterfactualProgram(ProblogProgram):
                         new_sdd = new_sdd | vertex_to_sdd[r[0]]
                     vertex_to_sdd[cur] = new_sdd
             
-            # conjoin all the evidence atoms
-            conjoined_evidence = sdd.true()
+            # conjoin the evidence atoms of each component, since a query only depends on the evidence in its component
+            components = independent_components(tmp_program)
+            evidence_sdds = OrderedDict()
             for name, phase in evidence.items():
+                atom = self.evidence_atoms[name]
+                component = components.get(atom, atom)
+                evidence_sdd = evidence_sdds.get(component, sdd.true())
                 if phase:
-                    conjoined_evidence = conjoined_evidence & ~vertex_to_sdd[self.evidence_atoms[name]]
+                    evidence_sdds[component] = evidence_sdd & ~vertex_to_sdd[atom]
                 else:
-                    conjoined_evidence = conjoined_evidence & vertex_to_sdd[self.evidence_atoms[name]]
+                    evidence_sdds[component] = evidence_sdd & vertex_to_sdd[atom]
 
-            # get all the query sdds and conjoin them with the evidence
-            query_sdds = [ vertex_to_sdd[self.intervention_atoms[query]] for query in queries ]
-            query_sdds = [ query_sdd & conjoined_evidence for query_sdd in query_sdds ]
+            # get all the query sdds and conjoin them with the evidence of their component
+            query_components = [ components.get(self.intervention_atoms[query], self.intervention_atoms[query]) for query in queries ]
+            query_sdds = [ vertex_to_sdd[self.intervention_atoms[query]] & evidence_sdds.get(component, sdd.true()) 
+                for query, component in zip(queries, query_components) ]
 
             # compute the actual probabilities
-            # first the probability of the evidence
-            evidence_manager = WmcManager(conjoined_evidence, log_mode = False)
-            weights = [ 1.0 for _ in range(2*len(self._guess)) ]
+            # first the probability of the evidence of each component
+            weights = [ 1.0 for _ in range(2*len(guesses)) ]
             varMap = { name : var for var, name in self._nameMap.items() }
-            rev_mapping = { guesses[i] : i + 1 for i in range(len(self._guess)) }
+            rev_mapping = { guesses[i] : i + 1 for i in range(len(guesses)) }
             for name in self.weights:
+                if varMap[name] not in rev_mapping:
+                    continue
                 sdd_var = rev_mapping[varMap[name]]
-                weights[len(self._guess) + sdd_var - 1] = self.weights[name]
-                weights[len(self._guess) - sdd_var] = 1 - self.weights[name]
+                weights[len(guesses) + sdd_var - 1] = self.weights[name]
+                weights[len(guesses) - sdd_var] = 1 - self.weights[name]
             python_array = np.array(weights)
             c_weights = array('d', python_array.astype('float'))
-            evidence_manager.set_literal_weights_from_array(c_weights)
-            evidence_weight = evidence_manager.propagate()
-            if evidence_weight <= 0.0:
-                raise Exception("Contradictory evidence! Probablity given evidence is zero.")
+            evidence_weights = {}
+            for component, evidence_sdd in evidence_sdds.items():
+                evidence_manager = WmcManager(evidence_sdd, log_mode = False)
+                evidence_manager.set_literal_weights_from_array(c_weights)
+                evidence_weights[component] = evidence_manager.propagate()
+                if evidence_weights[component] <= 0.0:
+                    raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
             
             # then the probabilities of the queries given the evidence
             final_results = []
-            for query_sdd in query_sdds:
+            for query_sdd, component in zip(query_sdds, query_components):
                 query_manager = WmcManager(query_sdd, log_mode = False)
                 query_manager.set_literal_weights_from_array(c_weights)
                 query_weight = query_manager.propagate()
-                final_results.append(query_weight/evidence_weight)
+                final_results.append(query_weight/evidence_weights.get(component, 1.0))
 
-        self.queries = []
         return final_results
 
+    def _component_program(self, rules, evidence, queries):
+        """Gets the inference program of a component with its probabilistic facts, its evidence and its queries.
+
+        Instead of constraints, the evidence is the body of a rule for an atom `given(e)`, where `e` is the first evidence atom,
+        and each query `q` is conjoined with it in a rule for `given(e,q)`.
+        Thus, the names of the queries only depend on the component, which can be counted together with other components.
+
+        Args:
+            rules (list): The rules of the component.
+            evidence (dict): The evidence on the atoms of the component as in `single_query`.
+            queries (list): The names of the atoms of the component that are queried.
+        Returns:
+            tuple: The program string and the names of its queries, 
+                the first of which is for the probability of the evidence and the others for the queries conjoined with it.
+                Without evidence the first is `true`, which is not queried.
+        """
+        atoms = set(abs(atom) for r in rules for atom in r.head + r.body)
+        program_string = "".join(f"{self.weights[self._internal_name(v)]}::{self._external_name(v)}.\n" for v in sorted(atoms & self._guess))
+        for r in rules:
+            program_string += ";".join([ self._external_name(v) for v in r.head ])
+            if len(r.body) > 0:
+                program_string += ":-"
+                program_string += ",".join([ ("\\+ " if v < 0 else "") + self._external_name(abs(v)) for v in r.body ])
+            program_string += ".\n"
+
+        # queries for atoms that the simplification made false are answered without asking for them
+        query_names = [ "true" ]
+        query_names += [ self._external_name(self.intervention_atoms[name]) for name in queries ]
+        derived = set(self._external_name(r.head[0]) for r in rules if len(r.head) > 0)
+        queried = [ query for query in query_names[1:] if query in derived ]
+        if len(evidence) > 0:
+            first = self._external_name(self.evidence_atoms[min(evidence)])
+            literals = [ ("\\+ " if phase else "") + self._external_name(self.evidence_atoms[name]) for name, phase in sorted(evidence.items()) ]
+            program_string += f"given({first}):-{','.join(literals)}.\n"
+            program_string += "".join(f"given({first},{query}):-{query},given({first}).\n" for query in queried)
+            query_names = [ f"given({first})" ] + [ f"given({first},{query})" for query in query_names[1:] ]
+            queried = [ f"given({first})" ] + [ f"given({first},{query})" for query in queried ]
+        # the queries only go into the inference program, such that this program is not changed
+        program_string += "".join(f"query({query}).\n" for query in queried)
+        return program_string, query_names
+
+    def _count_components(self, tasks, strategy):
+        """Counts the inference programs of the components, using the cached counts of small components.
+
+        Args:
+            tasks (list): A list of triples `(program_string, query_names, size)` as for `counterfactuals.decomposition.count_programs`.
+            strategy (:obj:`string`): The knowledge compiler to use.
+        Returns:
+            list: The counts of the queries of each component.
+        """
+        counts = [ None for _ in tasks ]
+        missing = []
+        for idx, (program_string, query_names, _) in enumerate(tasks):
+            key = (program_string, tuple(query_names))
+            if key in self._component_cache:
+                self._component_cache.move_to_end(key)
+                counts[idx] = self._component_cache[key]
+            else:
+                missing.append(idx)
+        self._decomposition_stats = { "components" : len(tasks), "cached" : len(tasks) - len(missing),
+            "rules" : [ size for _, _, size in tasks ] }
+        logger.info(f"Counting {len(missing)} of {len(tasks)} independent components")
+
+        for idx, result in zip(missing, count_programs([ tasks[idx] for idx in missing ], strategy)):
+            counts[idx] = result
+            program_string, query_names, size = tasks[idx]
+            if size <= decomposition_config["cache_max_rules"] and decomposition_config["cache_size"] > 0:
+                self._component_cache[(program_string, tuple(query_names))] = result
+                while len(self._component_cache) > decomposition_config["cache_size"]:
+                    self._component_cache.popitem(last = False)
+        return counts
+
     def _setup_multiquery_bottom_up(self):
+        self._setup_topological_ordering()
+        self._sdd_manager = self.setup_sdd_manager(self._program)
+        self._apply_sdd_memory_options()
+        vars = list(self._sdd_manager.vars)
+        self._sdd_vars = { v : vars[i] for i, v in enumerate(self._guess) }
+        # nothing is memoized before the manager exists, but the index depends on the new topological ordering
+        self._sdd_index = None
+
+    def _setup_sdd_index(self):
+        """Indexes the rules of the program for the bottom up case.
+
+        Sets up the rules of each atom, the rules each atom occurs in, the positions in the topological ordering
+        and empty caches for the atoms and rules that depend on sets of intervened atoms 
+        and for the independent components under sets of intervened atoms.
+        """
+        rules_of = {}
+        occurrences = {}
+        for rule in self._program:
+            if len(rule.head) > 0:
+                rules_of.setdefault(rule.head[0], []).append(rule)
+            for atom in rule.body:
+                occurrences.setdefault(abs(atom), []).append(rule)
+        position = { v : i for i, v in enumerate(self._topological_ordering) }
+        self._sdd_index = (rules_of, occurrences, position, OrderedDict(), OrderedDict())
+
+    def _intervention_cone(self, atoms):
+        """Gets the atoms and rules whose SDDs change if the given atoms are intervened on.
+
+        Args:
+            atoms (:obj:`frozenset`): The atoms that are intervened on.
+        Returns:
+            set: The atoms themselves and everything that depends on them.
+        """
+        _, occurrences, _, cones, _ = self._sdd_index
+        if atoms in cones:
+            cones.move_to_end(atoms)
+            return cones[atoms]
+        cone = set(atoms)
+        stack = list(atoms)
+        while len(stack) > 0:
+            atom = stack.pop()
+            for rule in occurrences.get(atom, []):
+                if rule not in cone:
+                    cone.add(rule)
+                    if len(rule.head) > 0 and rule.head[0] not in cone:
+                        cone.add(rule.head[0])
+                        stack.append(rule.head[0])
+        cones[atoms] = cone
+        if len(cones) > MAX_CACHED_CONES:
+            cones.popitem(last = False)
+        return cone
+
+    def _intervention_components(self, atoms):
+        """Gets the independent components of the program if the given atoms are intervened on.
+
+        Args:
+            atoms (:obj:`frozenset`): The atoms that are intervened on.
+        Returns:
+            dict: A dictionary from atoms to the representative of their component as in `counterfactuals.decomposition.independent_components`.
+        """
+        if self._sdd_index is None:
+            self._setup_sdd_index()
+        components = self._sdd_index[4]
+        if atoms in components:
+            components.move_to_end(atoms)
+            return components[atoms]
+        components[atoms] = independent_components(self._program, stop = atoms)
+        if len(components) > MAX_CACHED_CONES:
+            components.popitem(last = False)
+        return components[atoms]
+
+    def set_sdd_memory_limits(self, auto_gc_and_minimize = False, dead_node_threshold = None, live_node_threshold = None, memory_threshold = None, minimize_time_limit = None):
+        """Configures the memory management of the SDD manager used for bottom up multi-query inference.
+
+        The thresholds are checked after each query. 
+        If there are more dead nodes than `dead_node_threshold` they are garbage collected.
+        If there are more live nodes than `live_node_threshold` or the SDD nodes use more than `memory_threshold` bytes,
+        the apply cache is cleared, all nodes that are no longer needed are garbage collected and
+        the vtree is minimized.
+
+        Args:
+            auto_gc_and_minimize (:obj:`bool`, optional): Whether pysdd should automatically garbage collect and minimize the vtree
+                during compilation. Defaults to `False`.
+            dead_node_threshold (:obj:`int`, optional): The number of dead nodes that triggers garbage collection. 
+                Defaults to `None`, meaning no limit.
+            live_node_threshold (:obj:`int`, optional): The number of live nodes that triggers clearing the caches. 
+                Defaults to `None`, meaning no limit.
+            memory_threshold (:obj:`int`, optional): The approximate number of bytes of SDD nodes that triggers clearing the caches. 
+                Defaults to `None`, meaning no limit.
+            minimize_time_limit (:obj:`float`, optional): The time limit in seconds for the vtree search. 
+                Defaults to `None`, meaning the defaults of pysdd.
+        Returns:
+            None
+        """
+        self._sdd_memory_options = {
+            "auto_gc_and_minimize" : auto_gc_and_minimize,
+            "dead_node_threshold" : dead_node_threshold,
+            "live_node_threshold" : live_node_threshold,
+            "memory_threshold" : memory_threshold,
+            "minimize_time_limit" : minimize_time_limit,
+        }
+        if self._sdd_manager is not None:
+            self._apply_sdd_memory_options()
+
+    def _apply_sdd_memory_options(self):
+        if self._sdd_memory_options["auto_gc_and_minimize"]:
+            self._sdd_manager.auto_gc_and_minimize_on()
+        else:
+            self._sdd_manager.auto_gc_and_minimize_off()
+        if self._sdd_memory_options["minimize_time_limit"] is not None:
+            self._sdd_manager.set_vtree_search_time_limit(self._sdd_memory_options["minimize_time_limit"])
+
+    def sdd_memory_stats(self):
+        """Reports the memory usage of the SDD manager used for bottom up multi-query inference.
+
+        Returns:
+            dict: A dictionary with the number and size of live and dead SDD nodes, the approximate number of bytes they use,
+                the number of nodes in the vtree, the number of entries in the apply cache
+                and the number of atoms and rules whose SDDs are memoized across queries.
+                Empty if the bottom up case was not set up yet.
+        """
+        if self._sdd_manager is None:
+            return {}
+        return {
+            "live_count" : self._sdd_manager.live_count(),
+            "dead_count" : self._sdd_manager.dead_count(),
+            "live_size" : self._sdd_manager.live_size(),
+            "dead_size" : self._sdd_manager.dead_size(),
+            "memory" : self._sdd_memory(),
+            "vtree_nodes" : 2*self._sdd_manager.var_count() - 1,
+            "apply_cache" : len(self._applyCache),
+            "memoized" : len(self._sdd_memo),
+        }
+
+    def memory_usage(self):
+        """Estimates the memory that the program uses.
+
+        Returns:
+            dict: A dictionary with the approximate number of bytes of the `rules`, 
+                the compiled `circuit` of the top down case including its specialized circuits,
+                the `sdd` nodes of the bottom up case, the `caches` of results, applies, memoized SDDs and component counts,
+                and the `total` of them.
+        """
+        usage = {
+            "rules" : len(self._program)*RULE_BYTES + sum(len(r.head) + len(r.body) for r in self._program)*LITERAL_BYTES,
+            "circuit" : 0 if self._model is None else self._model.memory(),
+            "sdd" : 0 if self._sdd_manager is None else self._sdd_memory(),
+            "caches" : (self._result_cache_entries + len(self._applyCache) + len(self._sdd_memo) + len(self._component_cache))*CACHE_ENTRY_BYTES
+                + sum(len(program_string) for program_string, _ in self._component_cache),
+        }
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def use_model(self, model):
+        """Uses a model that was compiled before for the top down multi-query case, e.g. one loaded from a snapshot.
+
+        The model must have been compiled from a program with the same rules.
+        It is evaluated with the current probabilities of the facts of this program, not with the ones it was saved with.
+
+        Args:
+            model (:obj:`CompiledModel`): The compiled model.
+        Returns:
+            None
+        """
+        if model.fingerprint != self._rules_fingerprint() \
+                or dict(model._intervention_atoms) != self.intervention_atoms or dict(model._evidence_atoms) != self.evidence_atoms \
+                or set(model.facts) != set(self.facts):
+            raise Exception("The model was not compiled from this program.")
+        self._model = model.with_weights({ name : self.weights[name] for name in self.facts })
+        self.clear_result_cache()
+
+    def _rules_fingerprint(self):
+        """Gets a fingerprint of the ground rules and the facts of the program, which identifies the circuits compiled from it.
+
+        Returns:
+            :obj:`string`: The hex digest of a hash of the sorted rules.
+        """
+        varMap = { name : var for var, name in self._nameMap.items() }
+        rules = sorted((tuple(rule.head), tuple(sorted(rule.body))) for rule in self._program)
+        facts = sorted((name, varMap[name]) for name in self.facts)
+        return hashlib.sha256(repr((rules, facts)).encode()).hexdigest()
+
+    def simplification_stats(self):
+        """Reports how much the simplification of the program removed for the last single query.
+
+        The program is simplified by propagating facts with probability zero or one and the interventions,
+        dropping the rules that can no longer be applied, collapsing chains of rules and removing duplicates.
+        See `counterfactuals.simplification.simplify_program`.
+
+        Returns:
+            dict: A dictionary with the number of rules before and after the simplification,
+                the number of atoms that were fixed, of rules that were dropped, of chains that were collapsed and of duplicates.
+                Empty if no single query was evaluated yet.
+        """
+        return dict(self._simplification_stats)
+
+    def decomposition_stats(self):
+        """Reports how the last single query was split into independent components.
+
+        The relevant part of the program is split into components that share no atoms.
+        Each component is compiled and counted on its own, the large ones in parallel in worker processes,
+        and the counts of small components are cached across queries.
+        See `counterfactuals.decomposition.decomposition_config`.
+
+        Returns:
+            dict: A dictionary with the number of `components`, the number of them that were `cached`
+                and the number of `rules` of each component. Empty if no single query was evaluated yet.
+        """
+        return dict(self._decomposition_stats)
+
+    def _sdd_memory(self):
+        # approximate sizes of nodes and elements in the sdd library
+        return self._sdd_manager.count()*SDD_NODE_BYTES + self._sdd_manager.size()*SDD_ELEMENT_BYTES
+
+    def _manage_sdd_memory(self):
+        """Enforces the limits set by `set_sdd_memory_limits` after a query."""
+        options = self._sdd_memory_options
+        over_nodes = options["live_node_threshold"] is not None and self._sdd_manager.live_count() > options["live_node_threshold"]
+        over_memory = options["memory_threshold"] is not None and self._sdd_memory() > options["memory_threshold"]
+        if over_nodes or over_memory:
+            logger.debug(f"SDD limits exceeded with {self._sdd_manager.live_count()} live nodes, clearing the caches")
+            # the nodes are only referenced by the python objects in the caches
+            self._applyCache = {}
+            self._sdd_memo = {}
+            self._sdd_manager.minimize()
+            logger.debug(f"SDD manager has {self._sdd_manager.live_count()} live nodes after minimization")
+        elif options["dead_node_threshold"] is not None and self._sdd_manager.dead_count() > options["dead_node_threshold"]:
+            self._sdd_manager.garbage_collect()
+
+    def _setup_topological_ordering(self):
         graph = nx.DiGraph()
         for r in self._program:
             for atom in r.head:
@@ -340,11 +940,15 @@ class CounterfactualProgram(ProblogProgram):
                 graph.add_edge(abs(atom), r)
         
         self._topological_ordering = list(nx.topological_sort(graph))
-        self._sdd_manager = self.setup_sdd_manager(self._program)
 
     def _setup_multiquery_top_down(self, strategy = "sharpsat-td"):
         # create the atoms to condition on for interventions
-        for original_name, atom in self.intervention_atoms.items():
+        intervenable = { name : atom for name, atom in self.intervention_atoms.items() 
+            if self._intervenable is None or name in self._intervenable }
+        for original_name, atom in intervenable.items():
+            if atom in self._intervention_conditioners:
+                # the conditioners are kept when we recompile
+                continue
             pos_var = self._new_var(f"do({original_name})")
             neg_var = self._new_var(f"dont({original_name})")
             self._intervention_conditioners[atom] = (pos_var, neg_var)
@@ -354,54 +958,78 @@ class CounterfactualProgram(ProblogProgram):
             self.weights[f"dont({original_name})"] = 0.0
 
         # change the rules
-        interventions = set(self.intervention_atoms.values())
+        # we only change a copy so that the program can still be changed and recompiled
+        interventions = set(intervenable.values())
         
+        conditioned_program = []
         for rule in self._program:
             if len(rule.head) > 0:
                 if rule.head[0] in interventions:
-                    rule.body.append(-self._intervention_conditioners[rule.head[0]][1])
+                    rule = Rule(rule.head, rule.body + [ -self._intervention_conditioners[rule.head[0]][1] ])
+            conditioned_program.append(rule)
         
         # TODO: see what happens if we put this be for the other rule changes
         for atom in interventions:
-            self._program.append(Rule([ atom ], [ self._intervention_conditioners[atom][0] ]))
-
-        self.td_guided_both_clark_completion(adaptive=False, latest=True)
-        cnf_fd, cnf_tmp = tempfile.mkstemp()
-        my_signals.tempfiles.add(cnf_tmp)
-        
-        # prepare everything for the compilation
-        if strategy == "c2d":
-            with os.fdopen(cnf_fd, 'wb') as cnf_file:
-                self._cnf.to_stream(cnf_file)
-            d3 = TD_dtree(self._cnf, solver = config["decos"], timeout = config["decot"])
-            d3.write(cnf_tmp + '.dtree')
-            my_signals.tempfiles.add(cnf_tmp + '.dtree')
-        elif strategy == "miniC2D":            
-            with os.fdopen(cnf_fd, 'wb') as cnf_file:
-                self._cnf.to_stream(cnf_file)
-            self._vtree = TD_vtree(self._cnf, solver = config["decos"], timeout = config["decot"])
-            self._vtree.write(cnf_tmp + ".vtree")
-            my_signals.tempfiles.add(cnf_tmp + '.vtree')
-        elif strategy == "sharpsat-td":
-            with os.fdopen(cnf_fd, 'wb') as cnf_file:
-                self._cnf.write_kc_cnf(cnf_file)
-        elif strategy == "d4":
-            with os.fdopen(cnf_fd, 'wb') as cnf_file:
-                self._cnf.to_stream(cnf_file)
-                
+            conditioned_program.append(Rule([ atom ], [ self._intervention_conditioners[atom][0] ]))
+
+        original_program = self._program
+        self._program = conditioned_program
+        try:
+            with deadline.decomposition_timeout():
+                self.td_guided_both_clark_completion(adaptive=False, latest=True)
+        finally:
+            self._program = original_program
+        # the weights of all the atoms of the program change between queries, 
+        # so none of them may be projected away by the knowledge compiler
+        self._cnf.auxilliary.difference_update(range(1, self._max + 1))
         # perform the actual compilation
-        CNF.compile_single(cnf_tmp, knowledge_compiler = strategy)
-        
-        # remove the temporary files
-        os.remove(cnf_tmp)
-        my_signals.tempfiles.remove(cnf_tmp)
-        self._nnf = cnf_tmp + ".nnf"
-        if strategy == "c2d":
-            os.remove(cnf_tmp + ".dtree")
-            my_signals.tempfiles.remove(cnf_tmp + '.dtree')
-        elif strategy == "miniC2D":
-            os.remove(cnf_tmp + ".vtree")
-            my_signals.tempfiles.remove(cnf_tmp + '.vtree')
+        if strategy == "portfolio":
+            _, circuit = compilation.compile_portfolio(self._cnf)
+        else:
+            circuit = compilation.compile_cnf(self._cnf, strategy)
+        varMap = { name : var for var, name in self._nameMap.items() }
+        aux_weights = [ self._cnf.weights[to_dimacs(v)] for v in range(self._max*2, self._cnf.nr_vars*2) ]
+        model = CompiledModel(circuit, self.semiring, self.weights, self.facts, varMap, 
+            self.intervention_atoms, self.evidence_atoms, self._intervention_conditioners, self._max, aux_weights,
+            fingerprint = self._rules_fingerprint())
+        self._model = model.simplified()
+        logger.info(f"Circuit size:             {circuit.size()} (simplified {self._model.size()})")
+
+    def compile(self, strategy="sharpsat-td"):
+        """Compiles the program for the top down multi-query case.
+
+        The compiled model does not change when the program is changed afterwards, 
+        and it can be queried from many threads at the same time.
+        The circuit is only compiled again if the rules of the program were changed.
+        Circuits of miniC2D stay in a file, which is removed at that point.
+
+        Args:
+            strategy (:obj:`string`, optional): The knowledge compiler to use. 
+                See `multi_query` for possible values except `pysdd`. Defaults to `sharpsat-td`.
+        Returns:
+            :obj:`CompiledModel`: The compiled model with the current probabilities of the facts.
+        """
+        if strategy not in compilation.TOP_DOWN_STRATEGIES:
+            raise Exception(f"Unknown compilation strategy {strategy}.")
+        if self._model is None:
+            self._setup_multiquery_top_down(strategy=strategy)
+        return self._model
+
+    def specialize(self, interventions, strategy="sharpsat-td"):
+        """Specializes the compiled circuit of the top down case to interventions that are queried often.
+
+        Queries with exactly these interventions are then evaluated on a smaller circuit,
+        in which the intervention conditioners are replaced by constants. See `CompiledModel.specialize`.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` should be intervened positively (phase == False) or negatively.
+            strategy (:obj:`string`, optional): The knowledge compiler to use if the program was not compiled yet. 
+                See `compile` for possible values. Defaults to `sharpsat-td`.
+        Returns:
+            int: The number of nodes of the specialized circuit.
+        """
+        return self.compile(strategy=strategy).specialize(interventions)
         
     def _cached_apply(self, node1, node2, operation):
         if not (node1, node2, operation) in self._applyCache:
@@ -414,7 +1042,7 @@ class CounterfactualProgram(ProblogProgram):
                 self._applyCache[(node1, node2, operation)] = ~node1
         return self._applyCache[(node1, node2, operation)]
 
-    def multi_query(self, interventions, evidence, queries, strategy="sharpsat-td"):
+    def multi_query(self, interventions, evidence, queries, strategy="sharpsat-td", timeout = None):
         """Evaluates one of many single counterfactual queries using the given strategy.
 
         Args:
@@ -429,18 +1057,456 @@ class CounterfactualProgram(ProblogProgram):
                 * `c2d` for top down compilation to sd-DNNF with c2d,
                 * `miniC2D` for top down compilation to sd-DNNF with miniC2D,
                 * `d4` for top down compilation to sd-DNNF with d4,
-                * `sharpsat-td` for top down compilation to sd-DNNF with sharpsat-td.
+                * `sharpsat-td` for top down compilation to sd-DNNF with sharpsat-td,
+                * `td-dp` for dynamic programming over a tree decomposition of the CNF without an external knowledge compiler,
+                * `portfolio` for top down compilation to sd-DNNF with the first of several knowledge compilers that finishes
+                    (see `counterfactuals.compilation.portfolio_config`).
                 Defaults to `sharpsat-td`.
+            timeout (:obj:`float`, optional): The number of seconds after which decomposition, compilation and counting are given up.
+                The results are then computed as configured in `counterfactuals.deadline.fallback_config`
+                and returned as `counterfactuals.deadline.ApproximateResults`. Defaults to `None`, meaning no timeout.
         Returns:
             list: A list containing the results of the counterfactual queries in the order they were given in `queries`.
         """
-        if strategy in ['c2d', 'miniC2D', 'd4', 'sharpsat-td']:
-            return self._multi_query_top_down(interventions, evidence, queries, strategy=strategy)
+        evaluate = self._multi_query_evaluator(interventions, evidence, strategy)
+        return self._with_timeout(timeout, interventions, evidence, queries, 
+            lambda: self._cached_query(interventions, evidence, queries, evaluate))
+
+    def _with_timeout(self, timeout, interventions, evidence, queries, evaluate):
+        """Evaluates queries with a deadline and falls back to the configured cheaper method if it passes.
+
+        Args:
+            timeout (:obj:`float`): The number of seconds until the deadline or `None`.
+            interventions (dict): A dictionary mapping names to phases as in `multi_query`.
+            evidence (dict): A dictionary mapping names to phases as in `multi_query`.
+            queries (list): The queries as in `multi_query`.
+            evaluate (function): A function without arguments that evaluates the queries exactly.
+        Returns:
+            list: The exact results or `counterfactuals.deadline.ApproximateResults` if the deadline passed.
+        """
+        if timeout is None:
+            return evaluate()
+        try:
+            with deadline.limit(timeout):
+                return evaluate()
+        except DeadlineExceeded:
+            method = deadline.fallback_config["method"]
+            if method is None:
+                raise
+            logger.warning(f"The query did not finish within {timeout} seconds. Falling back to {method}.")
+
+        # use the exact results that are known
+        cached = self._result_cache.get(self._result_key(interventions, evidence), {})
+        if isinstance(cached, ContradictoryEvidence):
+            raise ContradictoryEvidence(str(cached))
+        missing = list(dict.fromkeys(query for query in queries if query not in cached))
+        if len(missing) == 0:
+            return [ cached[query] for query in queries ]
+        if method == "sampling":
+            results, accepted = self._sample_query(interventions, evidence, missing, deadline.fallback_config["samples"])
+        else:
+            raise Exception(f"Unknown fallback method {method}.")
+        results = dict(zip(missing, results))
+        results.update(cached)
+        return deadline.ApproximateResults([ results[query] for query in queries ], method, samples = accepted)
+
+    def _sample_query(self, interventions, evidence, queries, samples):
+        """Estimates the results of counterfactual queries by forward sampling of the facts.
+
+        All samples are evaluated at once by propagating boolean vectors through the rules of both parts of the program,
+        component by component in topological order. 
+        Samples that are not consistent with the evidence are rejected.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `multi_query`.
+            evidence (dict): A dictionary mapping names to phases as in `multi_query`.
+            queries (list): A list of strings, indicating the atoms that should be queried, 
+                or dictionaries mapping names to phases for conjunctions as in `conjunctive_query`.
+            samples (:obj:`int`): The number of samples.
+        Returns:
+            tuple: The list of estimated results, which are `nan` if no sample is consistent with the evidence, 
+                and the number of samples that are consistent with the evidence.
+        """
+        rng = np.random.default_rng()
+        # numpy only draws single or double precision
+        dtype = np.float32 if self._precision is not None and self._precision.dtype == np.float32 else np.float64
+        false = np.zeros(samples, dtype = bool)
+        varMap = { name : var for var, name in self._nameMap.items() }
+        values = {}
+        for name in self.facts:
+            values[varMap[name]] = rng.random(samples, dtype = dtype) < self.weights[name]
+
+        # atoms that are intervened on are fixed and lose their rules
+        atom_interventions = { self.intervention_atoms[name] : phase for name, phase in interventions.items() }
+        for atom, phase in atom_interventions.items():
+            values[atom] = np.full(samples, not phase)
+        rules = {}
+        for rule in self._program:
+            if len(rule.head) > 0 and rule.head[0] not in atom_interventions:
+                rules.setdefault(rule.head[0], []).append(rule.body)
+
+        def value(literal):
+            if literal < 0:
+                return ~values.get(-literal, false)
+            return values.get(literal, false)
+
+        # the program is stratified, so negation only refers to earlier components
+        graph = nx.DiGraph()
+        graph.add_nodes_from(rules)
+        for head, bodies in rules.items():
+            for body in bodies:
+                for atom in body:
+                    if abs(atom) in rules:
+                        graph.add_edge(abs(atom), head)
+        components = nx.condensation(graph)
+        for component in nx.topological_sort(components):
+            atoms = components.nodes[component]["members"]
+            for atom in atoms:
+                values[atom] = false
+            changed = True
+            while changed:
+                changed = False
+                for atom in atoms:
+                    new_value = values[atom].copy()
+                    for body in rules[atom]:
+                        satisfied = np.ones(samples, dtype = bool)
+                        for literal in body:
+                            satisfied &= value(literal)
+                        new_value |= satisfied
+                    if (new_value != values[atom]).any():
+                        values[atom] = new_value
+                        changed = True
+
+        consistent = np.ones(samples, dtype = bool)
+        for name, phase in evidence.items():
+            consistent &= value(-self.evidence_atoms[name] if phase else self.evidence_atoms[name])
+        accepted = int(consistent.sum())
+        results = []
+        for conjunction in self._conjunctions(queries):
+            satisfied = consistent.copy()
+            for name, phase in conjunction.items():
+                satisfied &= value(-self.intervention_atoms[name] if phase else self.intervention_atoms[name])
+            results.append(satisfied.sum()/accepted if accepted > 0 else float("nan"))
+        return results, accepted
+
+    def conjunctive_query(self, interventions, evidence, conjunctions, strategy="sharpsat-td"):
+        """Evaluates the probabilities of conjunctions of atoms in the intervention part using the given strategy.
+
+        All the conjunctions are evaluated in one batched pass over the same compiled circuit or SDDs as `multi_query`.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` should be intervened positively (phase == False) or negatively.
+            evidence (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` must have been true (phase == False) or false.
+            conjunctions (list): A list of dictionaries mapping names to phases,
+                indicating that we want to query the probability that all the atoms with name `name` 
+                are true (phase == False) or false, respectively, under the given interventions and evidence.
+            strategy (:obj:`string`, optional): The knowledge compiler to use. See `multi_query` for possible values.
+                Defaults to `sharpsat-td`.
+        Returns:
+            list: A list containing the results of the conjunctive queries in the order they were given in `conjunctions`.
+        """
+        keys = [ frozenset((name, bool(phase)) for name, phase in conjunction.items()) for conjunction in conjunctions ]
+        evaluate = self._multi_query_evaluator(interventions, evidence, strategy)
+        return self._cached_query(interventions, evidence, keys, lambda missing: evaluate([ dict(key) for key in missing ]))
+
+    def joint_query(self, interventions, evidence, atoms, strategy="sharpsat-td"):
+        """Evaluates the joint distribution of some atoms in the intervention part using the given strategy.
+
+        The `2**len(atoms)` assignments are evaluated as conjunctions in one batched pass, see `conjunctive_query`.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` should be intervened positively (phase == False) or negatively.
+            evidence (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` must have been true (phase == False) or false.
+            atoms (list): A list of strings, indicating the atoms whose joint distribution we want to know.
+            strategy (:obj:`string`, optional): The knowledge compiler to use. See `multi_query` for possible values.
+                Defaults to `sharpsat-td`.
+        Returns:
+            :obj:`np.array`: An array with `len(atoms)` axes of length two, 
+                where entry `[p_1, ..., p_k]` is the probability that each atom `atoms[i]` is true (p_i == 0) or false (p_i == 1).
+        """
+        assignments = list(itertools.product([ False, True ], repeat = len(atoms)))
+        conjunctions = [ dict(zip(atoms, phases)) for phases in assignments ]
+        results = self.conjunctive_query(interventions, evidence, conjunctions, strategy=strategy)
+        return np.array(results, dtype=self.semiring.dtype).reshape((2, )*len(atoms))
+
+    def top_k_interventions(self, evidence, query, k = 1, max_size = 1, candidates = None, strategy="sharpsat-td"):
+        """Searches for the interventions under which a query is most likely given the evidence.
+
+        Only interventions on atoms that can be intervened on are considered.
+        The candidate interventions are scored in batched passes over the compiled circuit and pruned with upper bounds,
+        see `CompiledModel.top_k_interventions`.
+
+        Args:
+            evidence (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` must have been true (phase == False) or false.
+            query (:obj:`string` or dict): The name of the atom whose probability should be maximized,
+                or a dictionary mapping names to phases for a conjunction as in `conjunctive_query`.
+            k (:obj:`int`, optional): How many interventions should be returned. Defaults to `1`.
+            max_size (:obj:`int`, optional): The largest number of atoms that are intervened on at once. Defaults to `1`.
+            candidates (:obj:`list`, optional): The names of the atoms that may be intervened on.
+                Defaults to `None`, which means all the atoms that can be intervened on.
+            strategy (:obj:`string`, optional): The knowledge compiler to use. 
+                See `compile` for possible values. Defaults to `sharpsat-td`.
+        Returns:
+            list: A list of at most `k` pairs of interventions, given as dictionaries mapping names to phases,
+                and the probability of the query under them, ordered by decreasing probability.
+        """
+        return self.compile(strategy=strategy).top_k_interventions(evidence, query, k = k, max_size = max_size, candidates = candidates)
+
+    def mpe_query(self, interventions, evidence, outcome = None, strategy="sharpsat-td"):
+        """Finds the most probable assignment to the facts that explains the evidence and leads to the outcome.
+
+        Performs one max-product pass with back-tracing over the circuit or SDDs that `multi_query` uses.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases,
+                indicating that the atom with name `name` should be intervened positively (phase == False) or negatively.
+            evidence (dict): A dictionary mapping names to phases,
+                indicating that the atom with name `name` must have been true (phase == False) or false.
+            outcome (:obj:`dict`, optional): A dictionary mapping names to phases,
+                indicating that the atom with name `name` must be true (phase == False) or false under the interventions.
+                Defaults to no restriction.
+            strategy (:obj:`string`, optional): The knowledge compiler to use. See `multi_query` for possible values.
+                Defaults to `sharpsat-td`.
+        Returns:
+            tuple: A dictionary mapping the names of all facts to phases,
+                indicating that the fact is true (phase == False) or false in the most probable assignment,
+                and the probability of this assignment.
+        """
+        if outcome is None:
+            outcome = {}
+        if strategy in compilation.TOP_DOWN_STRATEGIES:
+            model = self.compile(strategy=strategy)
+            probability, literals = model.max_product(model.literal_weights(interventions, evidence, [ outcome ]), interventions = interventions)
         elif strategy == "pysdd":
-            return self._multi_query_bottom_up(interventions, evidence, queries, strategy=strategy)
+            _, query_sdds = self._bottom_up_sdds(interventions, evidence, [ outcome ])
+            guesses = list(self._guess)
+            literals = set()
+            probability, sdd_literals = self._sdd_max_product(query_sdds[0], self.weights)
+            for literal in sdd_literals:
+                literals.add(guesses[abs(literal) - 1] if literal > 0 else -guesses[abs(literal) - 1])
+            del query_sdds
+            self._manage_sdd_memory()
         else:
             raise Exception(f"Unknown compilation strategy {strategy}.")
 
+        if probability <= 0.0:
+            raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
+
+        varMap = { name : var for var, name in self._nameMap.items() }
+        assignment = {}
+        for name in self.facts:
+            var = varMap[name]
+            if var in literals:
+                assignment[name] = False
+            elif -var in literals:
+                assignment[name] = True
+            else:
+                # the fact does not occur in the circuit, so we take its more likely phase
+                assignment[name] = self.weights[name] < 0.5
+                probability *= max(self.weights[name], 1 - self.weights[name])
+        return assignment, probability
+
+    def _sdd_max_product(self, node, weights):
+        """Computes the model of an SDD with the maximal product of the probabilities of the facts.
+
+        Variables that an element of a decision node does not mention are set to their more likely phase.
+
+        Args:
+            node (:obj:`SddNode`): The SDD.
+            weights (dict): The dictionary from fact names to their probability.
+        Returns:
+            tuple: The maximal product and the set of SDD literals of a model that attains it.
+        """
+        guesses = list(self._guess)
+        lit_weights = {}
+        for i, atom in enumerate(guesses):
+            name = self._external_name(atom)
+            if name in weights and name in self.facts:
+                lit_weights[i + 1] = weights[name]
+                lit_weights[-(i + 1)] = 1 - weights[name]
+            else:
+                lit_weights[i + 1] = 1.0
+                lit_weights[-(i + 1)] = 1.0
+
+        # the product of the best weights of the variables below each vtree node
+        free = {}
+        stack = [ (self._sdd_manager.vtree(), False) ]
+        while len(stack) > 0:
+            vtree, expanded = stack.pop()
+            if vtree.is_leaf():
+                free[vtree.position()] = max(lit_weights[vtree.var()], lit_weights[-vtree.var()])
+            elif not expanded:
+                stack.append((vtree, True))
+                stack.append((vtree.left(), False))
+                stack.append((vtree.right(), False))
+            else:
+                free[vtree.position()] = free[vtree.left().position()]*free[vtree.right().position()]
+
+        def gap(outer, inner):
+            # the weight of the best assignment to the variables in outer that do not occur in inner
+            if inner.is_true():
+                return free[outer.position()]
+            return free[outer.position()]/free[inner.vtree().position()]
+
+        # the max-product pass over the sdd in topological order
+        value = {}
+        best = {}
+        elements = {}
+        stack = [ (node, False) ]
+        while len(stack) > 0:
+            cur, expanded = stack.pop()
+            if cur.id in value:
+                continue
+            if cur.is_false():
+                value[cur.id] = 0.0
+            elif cur.is_true():
+                value[cur.id] = 1.0
+            elif cur.is_literal():
+                value[cur.id] = lit_weights[cur.literal]
+            elif not expanded:
+                elements[cur.id] = list(cur.elements())
+                stack.append((cur, True))
+                for prime, sub in elements[cur.id]:
+                    stack.append((prime, False))
+                    stack.append((sub, False))
+            else:
+                vtree = cur.vtree()
+                value[cur.id] = 0.0
+                for prime, sub in elements[cur.id]:
+                    if prime.is_false() or sub.is_false():
+                        continue
+                    val = value[prime.id]*gap(vtree.left(), prime)*value[sub.id]*gap(vtree.right(), sub)
+                    if cur.id not in best or val > value[cur.id]:
+                        value[cur.id] = val
+                        best[cur.id] = (prime, sub)
+        if node.is_false():
+            return 0.0, set()
+        probability = value[node.id]*gap(self._sdd_manager.vtree(), node)
+
+        # trace the maximizing elements back from the root
+        literals = set()
+        stack = [ node ]
+        while len(stack) > 0:
+            cur = stack.pop()
+            if cur.is_literal():
+                literals.add(cur.literal)
+            elif cur.is_decision():
+                stack.extend(best[cur.id])
+        # the variables that do not occur take their more likely phase
+        for var in range(1, len(guesses) + 1):
+            if var not in literals and -var not in literals:
+                literals.add(var if lit_weights[var] >= lit_weights[-var] else -var)
+        return probability, literals
+
+    def _multi_query_evaluator(self, interventions, evidence, strategy):
+        """Gets the function that evaluates queries under the given interventions and evidence with the given strategy."""
+        if strategy in compilation.TOP_DOWN_STRATEGIES:
+            return lambda queries: self._multi_query_top_down(interventions, evidence, queries, strategy=strategy)
+        elif strategy == "pysdd":
+            return lambda queries: self._multi_query_bottom_up(interventions, evidence, queries, strategy=strategy)
+        else:
+            raise Exception(f"Unknown compilation strategy {strategy}.")
+
+    @staticmethod
+    def _conjunctions(queries):
+        """Turns a list of query atoms and conjunctions into a list of conjunctions."""
+        return [ { query : False } if isinstance(query, str) else query for query in queries ]
+
+    def set_result_cache_size(self, size):
+        """Sets how many query results are kept in the result cache.
+
+        The results of `single_query` and `multi_query` are cached for each combination of interventions, evidence and query atom.
+        If the cache is full, the results of the least recently used combination of interventions and evidence are evicted first.
+        Contradictory evidence is cached as well and counts as one result.
+
+        Args:
+            size (:obj:`int`): The maximal number of cached results. `0` disables the cache.
+        Returns:
+            None
+        """
+        if size < 0:
+            raise Exception(f"The size of the result cache must be non-negative but got {size}.")
+        self._result_cache_size = size
+        self._evict_results()
+
+    def clear_result_cache(self):
+        """Removes all the cached query results.
+
+        This happens automatically whenever the program is changed with `update_weights`, `add_rules` or `remove_rules`.
+
+        Returns:
+            None
+        """
+        self._result_cache.clear()
+        self._result_cache_entries = 0
+
+    @staticmethod
+    def _result_key(interventions, evidence):
+        """Gets the canonical form of a scenario that does not depend on the order of the dictionaries."""
+        return (frozenset((name, bool(phase)) for name, phase in interventions.items()),
+            frozenset((name, bool(phase)) for name, phase in evidence.items()))
+
+    def _cached_query(self, interventions, evidence, queries, evaluate):
+        """Answers the queries from the result cache and evaluates only the missing ones.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases.
+            evidence (dict): A dictionary mapping names to phases.
+            queries (list): The names of the query atoms. May contain duplicates.
+            evaluate (function): A function that takes a list of distinct query atoms 
+                and returns their results under the interventions and evidence.
+        Returns:
+            list: A list containing the results of the counterfactual queries in the order they were given in `queries`.
+        """
+        if self._result_cache_size == 0:
+            return evaluate(queries)
+        key = self._result_key(interventions, evidence)
+        cached = self._result_cache.pop(key, {})
+        self._result_cache_entries -= self._cached_entries(cached)
+        if isinstance(cached, ContradictoryEvidence):
+            self._store_results(key, cached)
+            raise ContradictoryEvidence(str(cached))
+
+        missing = list(dict.fromkeys(query for query in queries if query not in cached))
+        if len(missing) > 0:
+            try:
+                results = evaluate(missing)
+            except ContradictoryEvidence as e:
+                self._store_results(key, e)
+                raise
+            except:
+                # keep the results we already had, e.g. if the deadline passed
+                if len(cached) > 0:
+                    self._store_results(key, cached)
+                raise
+            cached.update(zip(missing, results))
+        self._store_results(key, cached)
+        return [ cached[query] for query in queries ]
+
+    @staticmethod
+    def _cached_entries(cached):
+        """Gets the number of results a cache entry counts as."""
+        if isinstance(cached, ContradictoryEvidence):
+            return 1
+        return len(cached)
+
+    def _store_results(self, key, cached):
+        """Stores the results for a scenario as the most recently used ones and evicts old results if necessary."""
+        self._result_cache[key] = cached
+        self._result_cache_entries += self._cached_entries(cached)
+        self._evict_results()
+
+    def _evict_results(self):
+        """Evicts the least recently used results until the cache is within its size bound."""
+        while self._result_cache_entries > self._result_cache_size and len(self._result_cache) > 0:
+            _, cached = self._result_cache.popitem(last = False)
+            self._result_cache_entries -= self._cached_entries(cached)
+
     def _multi_query_top_down(self, interventions, evidence, queries, strategy="sharpsat-td"):
         """Evaluates one of many single counterfactual queries using the given strategy.
 
@@ -450,64 +1516,181 @@ class CounterfactualProgram(ProblogProgram):
             evidence (dict): A dictionary mapping names to phases, 
                 indicating that the atom with name `name` must have been true (phase == False) or false.
             queries (list): A list of strings, indicating that we want to query the probabilities of the atoms
-                under the given interventions and evidence.
+                under the given interventions and evidence. Conjunctions may be given as in `conjunctive_query`.
             strategy (:obj:`string`, optional): The knowledge compiler to use. Possible values are 
                 * `c2d` for top down compilation to sd-DNNF with c2d,
                 * `miniC2D` for top down compilation to sd-DNNF with miniC2D,
                 * `d4` for top down compilation to sd-DNNF with d4,
-                * `sharpsat-td` for top down compilation to sd-DNNF with sharpsat-td.
+                * `sharpsat-td` for top down compilation to sd-DNNF with sharpsat-td,
+                * `td-dp` for dynamic programming over a tree decomposition of the CNF without an external knowledge compiler,
+                * `portfolio` for top down compilation to sd-DNNF with the first of several knowledge compilers that finishes
+                    (see `counterfactuals.compilation.portfolio_config`).
                 Defaults to `sharpsat-td`.
         Returns:
             list: A list containing the results of the counterfactual queries in the order they were given in `queries`.
         """
-        if self._nnf is None:
-            self._setup_multiquery_top_down(strategy=strategy)
+        model = self.compile(strategy=strategy)
+        if not model.can_intervene(interventions) and all(isinstance(query, str) for query in queries):
+            names = [ name for name in interventions if self._intervenable is not None and name not in self._intervenable ]
+            logger.warning(f"The atoms {names} were not declared intervenable. Falling back to a single query.")
+            return self._single_query(interventions, evidence, queries, strategy=strategy)
+        return model.conjunctive_query(interventions, evidence, self._conjunctions(queries), evaluator = self._evaluator, precision = self._precision)
+
+    def set_incremental_evaluation(self, enabled = True):
+        """Enables or disables incremental evaluation for the top down multi-query case.
+
+        If it is enabled, the values of the nodes of the circuit are kept between queries,
+        and only the nodes above literals whose weights changed are recomputed.
+        Consecutive queries that differ in a few evidence or intervention literals and have the same number of queries
+        then only take time proportional to the affected part of the circuit. 
+        See `counterfactuals.circuit.IncrementalEvaluator`.
+        The node values take as much memory as a full evaluation, and they are kept until this is disabled.
 
-        # prepare the weights for this query
-        actual_queries = [ "true" ] + [ self._external_name(self.intervention_atoms[query]) for query in queries ]
-        query_cnt = len(actual_queries)
-        varMap = { name : var for var, name in self._nameMap.items() }
-        weight_list = [ np.full(query_cnt, self.semiring.one(), dtype=self.semiring.dtype) for _ in range(self._max*2) ]
-        for name in self.weights:
-            weight_list[to_pos(varMap[name])] = np.full(query_cnt, self.weights[name], dtype=self.semiring.dtype)
-            weight_list[neg(to_pos(varMap[name]))] = np.full(query_cnt, self.semiring.negate(self.weights[name]), dtype=self.semiring.dtype)
-        for i, query in enumerate(actual_queries):
-            weight_list[neg(to_pos(varMap[query]))][i] = self.semiring.zero()
-        
-        for name, phase in interventions.items():
-            intervention_atom = self.intervention_atoms[name]
-            if phase:
-                conditioner_atom = self._intervention_conditioners[intervention_atom][1]
-            else:
-                conditioner_atom = self._intervention_conditioners[intervention_atom][0]
-            weight_list[to_pos(conditioner_atom)] = np.full(query_cnt, 1.0, dtype=self.semiring.dtype)
-            weight_list[neg(to_pos(conditioner_atom))] = np.full(query_cnt, 0.0, dtype=self.semiring.dtype)
+        Args:
+            enabled (:obj:`bool`, optional): Whether to evaluate incrementally. Defaults to `True`.
+        Returns:
+            None
+        """
+        if enabled:
+            if self._evaluator is None:
+                self._evaluator = IncrementalEvaluator()
+        else:
+            self._evaluator = None
 
-        for name, phase in evidence.items():
-            evidence_atom = self.evidence_atoms[name]
-            if phase:
-                weight_list[to_pos(evidence_atom)] = np.full(query_cnt, 0.0, dtype=self.semiring.dtype)
-            else:
-                weight_list[neg(to_pos(evidence_atom))] = np.full(query_cnt, 0.0, dtype=self.semiring.dtype)
+    def set_precision(self, precision = None):
+        """Sets the floating point type and space of batched evaluation.
 
-        for v in range(self._max*2):
-            self._cnf.weights[to_dimacs(v)] = weight_list[v]
-        self._cnf.semirings = [ self.semiring ]
-        self._cnf.quantified = [ list(range(1, self._max + 1)) ]
+        It is used for the top down multi-query case, for parameter sweeps and for the samples of queries that run out of time.
+        The accuracy of the last evaluation is in `precision.report`.
 
-        # perform the counting on the circuit
-        weights, zero, one, dtype = self._cnf.get_weights()
-        results = Circuit.parse_wmc(self._nnf, weights, zero = zero, one = one, dtype = dtype, solver = strategy, vtree = self._vtree)
-        
-        if results[0] <= 0.0:
-            raise Exception("Contradictory evidence! Probablity given evidence is zero.")
-        
-        final_results = [ result/results[0] for result in results[1:] ]
-        return final_results
-        
+        Args:
+            precision (:obj:`Precision`, optional): The precision, e.g. `Precision(np.float32)` for single precision
+                or `Precision(np.float64, log_space = True)` for tiny probabilities of the evidence.
+                See `counterfactuals.precision.Precision`. Defaults to `None`, which uses the type of the semiring.
+        Returns:
+            None
+        """
+        self._precision = precision
+        self.clear_result_cache()
+
+    def batch_query(self, scenarios, strategy="sharpsat-td", single = False, check = True):
+        """Evaluates a batch of counterfactual queries with possibly different interventions and evidence.
 
+        Scenarios with identical interventions and evidence are merged into a single call,
+        and the resulting groups are evaluated such that consecutive groups share as many interventions as possible.
+        This way the SDDs cached for `pysdd` and the pruned programs of `single_query` are reused as often as possible.
 
+        Args:
+            scenarios (list): A list of triples `(interventions, evidence, queries)`,
+                each of which is interpreted as in `multi_query`.
+            strategy (:obj:`string`, optional): The knowledge compiler to use. See `multi_query` for possible values.
+                Defaults to `sharpsat-td`.
+            single (:obj:`bool`, optional): Whether each group should be evaluated with `single_query` instead of `multi_query`.
+                Defaults to `False`.
+            check (:obj:`bool`, optional): Whether to raise an exception if the evidence of a scenario has probability zero.
+                Otherwise the results of the scenario are `nan`. Defaults to `True`.
+        Returns:
+            list: A list containing for each scenario the list of results of its queries, in the order the scenarios were given in.
+        """
+        groups = scheduler.schedule(scenarios)
+        logger.debug(f"Scheduled {len(scenarios)} scenarios in {len(groups)} groups")
+        results = [ None for _ in scenarios ]
+        for cur in groups:
+            try:
+                if single:
+                    group_results = self.single_query(cur.interventions, cur.evidence, cur.queries, strategy=strategy)
+                else:
+                    group_results = self.multi_query(cur.interventions, cur.evidence, cur.queries, strategy=strategy)
+            except ContradictoryEvidence:
+                if check:
+                    raise
+                group_results = [ float("nan") for _ in cur.queries ]
+            to_result = { query : result for query, result in zip(cur.queries, group_results) }
+            for index, queries in cur.members:
+                results[index] = [ to_result[query] for query in queries ]
+        return results
+
+    def parameter_sweep(self, interventions, evidence, queries, samples, facts = None, strategy="sharpsat-td", memory_budget = 2**30):
+        """Evaluates the same counterfactual query for many alternative probability assignments to the facts.
+
+        For the top down strategies all the samples are evaluated in batched passes over one compiled circuit, 
+        where the samples are split into chunks such that the memory needed for counting stays below `memory_budget`.
+        For `pysdd` the SDDs are built once and only the weighted model counting is repeated for each sample.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` should be intervened positively (phase == False) or negatively.
+            evidence (dict): A dictionary mapping names to phases, 
+                indicating that the atom with name `name` must have been true (phase == False) or false.
+            queries (list): A list of strings, indicating that we want to query the probabilities of the atoms
+                under the given interventions and evidence.
+            samples (:obj:`np.array`): A matrix of shape `(number of samples, len(facts))`. 
+                Row `s` contains the probabilities of the facts in sample `s`.
+            facts (:obj:`list`, optional): The names of the facts corresponding to the columns of `samples`.
+                Facts that are not mentioned keep their probability in `self.weights`. Defaults to `self.facts`.
+            strategy (:obj:`string`, optional): The knowledge compiler to use. See `multi_query` for possible values.
+                Defaults to `sharpsat-td`.
+            memory_budget (:obj:`int`, optional): The number of bytes the counting may use for the batch vectors. 
+                Defaults to `2**30`.
+        Returns:
+            :obj:`np.array`: A matrix of shape `(number of samples, len(queries))`, 
+                where entry `[s, i]` is the result of query `queries[i]` under sample `s`.
+                Rows for samples under which the evidence has probability zero are `nan`.
+        """
+        if facts is None:
+            facts = self.facts
+        samples = np.asarray(samples, dtype=self.semiring.dtype)
+        if samples.ndim != 2 or samples.shape[1] != len(facts):
+            raise Exception(f"Expected a matrix of samples with {len(facts)} columns but got shape {samples.shape}.")
+        # self.weights also contains the conditioners of the top down case, which are no facts
+        known = set(self.facts)
+        for name in facts:
+            if name not in known:
+                raise Exception(f"Unknown fact {name}.")
+        sample_cnt = samples.shape[0]
+
+        if strategy == "pysdd":
+            conjoined_evidence, query_sdds = self._bottom_up_sdds(interventions, evidence, queries)
+            results = np.empty((sample_cnt, len(queries)), dtype=self.semiring.dtype)
+            weights = dict(self.weights)
+            for s in range(sample_cnt):
+                for i, name in enumerate(facts):
+                    weights[name] = samples[s, i]
+                results[s] = self._bottom_up_count(conjoined_evidence, query_sdds, weights, check = False)
+        elif strategy in compilation.TOP_DOWN_STRATEGIES:
+            model = self.compile(strategy=strategy)
+            conjunctions = [ {} ] + self._conjunctions(queries)
+            query_cnt = len(conjunctions)
+            
+            # every node of the circuit holds one value per column of the batch
+            dtype = self.semiring.dtype if self._precision is None else self._precision.dtype
+            column_bytes = model.size()*np.dtype(dtype).itemsize
+            chunk_size = max(1, memory_budget//(column_bytes*query_cnt))
+            logger.debug(f"Parameter sweep over {sample_cnt} samples in chunks of {chunk_size}")
+            
+            results = np.empty((sample_cnt, len(queries)), dtype=self.semiring.dtype)
+            for start in range(0, sample_cnt, chunk_size):
+                chunk = samples[start:start + chunk_size]
+                weight_list = model.literal_weights(interventions, evidence, conjunctions, repeat = chunk.shape[0])
+                for i, name in enumerate(facts):
+                    var = model.fact_var(name)
+                    weight_list[to_pos(var)] = np.repeat(chunk[:,i], query_cnt)
+                    weight_list[neg(to_pos(var))] = np.repeat(self.semiring.negate(chunk[:,i]), query_cnt)
+                chunk_results = model.count(weight_list, interventions = interventions, precision = self._precision)
+                chunk_results = chunk_results.reshape((chunk.shape[0], query_cnt))
+                if self._precision is not None:
+                    results[start:start + chunk.shape[0]] = self._precision.ratio(chunk_results[:,1:], chunk_results[:,:1])
+                    continue
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    results[start:start + chunk.shape[0]] = chunk_results[:,1:]/chunk_results[:,:1]
+        else:
+            raise Exception(f"Unknown compilation strategy {strategy}.")
 
+        contradictory = np.isnan(results).any(axis = 1) | np.isinf(results).any(axis = 1)
+        if contradictory.any():
+            logger.warning(f"Contradictory evidence for {np.count_nonzero(contradictory)} of {sample_cnt} samples.")
+            results[contradictory] = np.nan
+        return results
 
     def _multi_query_bottom_up(self, interventions, evidence, queries, strategy="pysdd"):
         """Evaluates one of many single counterfactual queries using the given strategy.
@@ -518,119 +1701,219 @@ class CounterfactualProgram(ProblogProgram):
             evidence (dict): A dictionary mapping names to phases, 
                 indicating that the atom with name `name` must have been true (phase == False) or false.
             queries (list): A list of strings, indicating that we want to query the probabilities of the atoms
-                under the given interventions and evidence.
+                under the given interventions and evidence. Conjunctions may be given as in `conjunctive_query`.
             strategy (:obj:`string`, optional): The knowledge compiler to use. Possible values are 
                 * `pysdd` for bottom up compilation to SDDs,
                 Defaults to `pysdd`.
         Returns:
             list: A list containing the results of the counterfactual queries in the order they were given in `queries`.
         """
+        evidence_sdds, query_sdds, query_components = self._bottom_up_component_sdds(interventions, evidence, queries)
+        final_results = self._bottom_up_component_count(evidence_sdds, query_sdds, query_components, self.weights)
+        del evidence_sdds, query_sdds
+        self._manage_sdd_memory()
+        return final_results
+
+    def _bottom_up_atom_sdds(self, interventions, targets):
+        """Builds the SDDs of the given atoms under the given interventions.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `multi_query`.
+            targets (list): The atoms whose SDDs are needed.
+        Returns:
+            callable: A function that gets the SDD of an atom or rule, which is defined at least for the targets.
+        """
         # check if setup already happened, if not do it now
         if self._sdd_manager is None:
             self._setup_multiquery_bottom_up()
 
-        # perform the interventions 
-        # differently from the single query case we do not remove atoms that are intervened on
-        # but only the rules that derive them
-        # this is to enable the use of the same topological ordering for different queries
-        # but should not decrease performance, since the intervened atoms are always either true or false
-        tmp_program = [ ]
-        atom_interventions = { self.intervention_atoms[name] : phase for name, phase in interventions.items() }
-        for rule in self._program:
-            if len(rule.head) > 0:
-                if rule.head[0] in atom_interventions:
-                    continue
-            take = True
-            for atom in rule.body:
-                if abs(atom) in atom_interventions:
-                    if atom_interventions[abs(atom)] != (atom < 0):
-                        take = False
-                        break
-            if take:
-                tmp_program.append(rule)
+        if self._sdd_index is None:
+            self._setup_sdd_index()
+        rules_of, _, position, _, _ = self._sdd_index
 
-        # additional rules to ensure that atoms positively intervened upon are derived
-        intervention_rules = []
+        # atoms that are intervened on are constants, and everything that depends on them is local to this query
+        # all other SDDs are the same for every query, so they are memoized across queries
+        local = {}
         for name, phase in interventions.items():
-            if not phase:
-                atom = self.intervention_atoms[name]
-                intervention_rule = Rule([ atom ], [])
-                tmp_program.append(intervention_rule)
-                intervention_rules.append(intervention_rule)
-
-        # perform bottom up compilation using pysdd
-        vars = list(self._sdd_manager.vars)
-        guesses = list(self._guess)
-        vertex_to_sdd = { v : vars[i] for i,v in enumerate(guesses) }
+            atom = self.intervention_atoms[name]
+            local[atom] = self._sdd_manager.false() if phase else self._sdd_manager.true()
+        cone = self._intervention_cone(frozenset(local.keys()))
+
+        def known(node):
+            return node in local or node in self._sdd_vars or (node not in cone and node in self._sdd_memo)
+
+        def sdd(node):
+            if node in local:
+                return local[node]
+            if node in self._sdd_vars:
+                return self._sdd_vars[node]
+            return self._sdd_memo[node]
+
+        # find the SDDs we need to build by going back from the targets to the known SDDs
+        needed = set()
+        stack = [ v for v in targets if not known(v) ]
+        while len(stack) > 0:
+            cur = stack.pop()
+            if cur in needed:
+                continue
+            needed.add(cur)
+            if isinstance(cur, Rule):
+                predecessors = [ abs(atom) for atom in cur.body ]
+            else:
+                predecessors = rules_of.get(cur, [])
+            stack.extend(v for v in predecessors if v not in needed and not known(v))
 
-        # set up the and/or graph
-        graph = nx.DiGraph()
-        for r in tmp_program:
-            for atom in r.head:
-                graph.add_edge(r, atom)
-            for atom in r.body:
-                graph.add_edge(abs(atom), r)
-        
-        # reduce to relevant part by using only the ancestors of evidence and or queries
-        relevant = set()
-        for query in queries:
-            relevant.add(self.intervention_atoms[query])
-            relevant.update(nx.ancestors(graph, self.intervention_atoms[query]))
-        for atom in evidence:
-            relevant.add(self.evidence_atoms[atom])
-            relevant.update(nx.ancestors(graph, self.evidence_atoms[atom]))
-
-        graph = nx.subgraph(graph, relevant)
-
-        # build the relevant sdds by traversing the graph in topological order
-        # for better reuse we always take the same topological order 
-        # however, we need to make sure that we only have things in there that are relevant
-        # additionally, we now have new rules for the atoms that were intervened on
-        ts = intervention_rules + [ v for v in self._topological_ordering if v in relevant ]
-        for cur in ts:
+        # build them in the topological ordering, which fixes the order of the applies such that the apply cache is reused
+        for cur in sorted(needed, key = lambda v: position.get(v, -1)):
+            deadline.check()
             if isinstance(cur, Rule):
                 new_sdd = self._sdd_manager.true()
                 for b in cur.body:
+                    body_sdd = sdd(abs(b))
                     if b < 0:
-                        vertex_to_sdd[b] = self._cached_apply(vertex_to_sdd[-b], None, SDDOperation.NEGATE)
-                    new_sdd = self._cached_apply(new_sdd, vertex_to_sdd[b], SDDOperation.AND)
-                vertex_to_sdd[cur] = new_sdd
-            elif cur not in self._guess:
-                ins = list(graph.in_edges(nbunch=cur))
+                        body_sdd = self._cached_apply(body_sdd, None, SDDOperation.NEGATE)
+                    new_sdd = self._cached_apply(new_sdd, body_sdd, SDDOperation.AND)
+            else:
                 new_sdd = self._sdd_manager.false()
-                for r in ins:
-                    new_sdd = self._cached_apply(new_sdd, vertex_to_sdd[r[0]], SDDOperation.OR)
-                vertex_to_sdd[cur] = new_sdd
+                for r in rules_of.get(cur, []):
+                    new_sdd = self._cached_apply(new_sdd, sdd(r), SDDOperation.OR)
+            if cur in cone:
+                local[cur] = new_sdd
+            else:
+                self._sdd_memo[cur] = new_sdd
+        return sdd
+
+    def _bottom_up_literal(self, sdd, atom, phase):
+        """Gets the SDD of an atom or of its negation if `phase` is `True`."""
+        if phase:
+            return self._cached_apply(sdd(atom), None, SDDOperation.NEGATE)
+        return sdd(atom)
+
+    def _bottom_up_sdds(self, interventions, evidence, queries):
+        """Builds the SDDs for the evidence and the queries under the given interventions.
+
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `multi_query`.
+            evidence (dict): A dictionary mapping names to phases as in `multi_query`.
+            queries (list): A list of strings, indicating the atoms that should be queried, 
+                or dictionaries mapping names to phases for conjunctions as in `conjunctive_query`.
+        Returns:
+            tuple: The SDD of the conjoined evidence and the list of SDDs for the queries conjoined with the evidence.
+        """
+        conjunctions = self._conjunctions(queries)
+        targets = [ self.evidence_atoms[name] for name in evidence ]
+        targets += [ self.intervention_atoms[name] for conjunction in conjunctions for name in conjunction ]
+        sdd = self._bottom_up_atom_sdds(interventions, targets)
         
         # conjoin all the evidence atoms
         conjoined_evidence = self._sdd_manager.true()
         for name, phase in evidence.items():
-            if phase:
-                evidence_atom = self._cached_apply(vertex_to_sdd[self.evidence_atoms[name]], None, SDDOperation.NEGATE)
-            else:
-                evidence_atom = vertex_to_sdd[self.evidence_atoms[name]]
+            evidence_atom = self._bottom_up_literal(sdd, self.evidence_atoms[name], phase)
             conjoined_evidence = self._cached_apply(conjoined_evidence, evidence_atom, SDDOperation.AND)
 
         # get all the query sdds and conjoin them with the evidence
-        query_sdds = [ vertex_to_sdd[self.intervention_atoms[query]] for query in queries ]
-        query_sdds = [ self._cached_apply(query_sdd, conjoined_evidence, SDDOperation.AND) for query_sdd in query_sdds ]
+        query_sdds = []
+        for conjunction in conjunctions:
+            query_sdd = conjoined_evidence
+            for name, phase in conjunction.items():
+                query_atom = self._bottom_up_literal(sdd, self.intervention_atoms[name], phase)
+                query_sdd = self._cached_apply(query_sdd, query_atom, SDDOperation.AND)
+            query_sdds.append(query_sdd)
+        return conjoined_evidence, query_sdds
+
+    def _bottom_up_component_sdds(self, interventions, evidence, queries):
+        """Builds the SDDs for the evidence of each independent component and the queries under the given interventions.
+
+        Each query is only conjoined with the evidence of the components of its atoms, 
+        since the evidence of the other components does not change its probability.
+        This keeps the SDDs of the queries small if the evidence is spread over several components.
 
-        # compute the actual probabilities
-        # first the probability of the evidence
-        evidence_manager = WmcManager(conjoined_evidence, log_mode = False)
-        weights = [ 1.0 for _ in range(2*len(self._guess)) ]
+        Args:
+            interventions (dict): A dictionary mapping names to phases as in `multi_query`.
+            evidence (dict): A dictionary mapping names to phases as in `multi_query`.
+            queries (list): A list of strings, indicating the atoms that should be queried, 
+                or dictionaries mapping names to phases for conjunctions as in `conjunctive_query`.
+        Returns:
+            tuple: The list of SDDs of the conjoined evidence of each component, 
+                the list of SDDs for the queries conjoined with the evidence of their components
+                and the list of the indices of these components for each query.
+        """
+        conjunctions = self._conjunctions(queries)
+        targets = [ self.evidence_atoms[name] for name in evidence ]
+        targets += [ self.intervention_atoms[name] for conjunction in conjunctions for name in conjunction ]
+        sdd = self._bottom_up_atom_sdds(interventions, targets)
+        components = self._intervention_components(frozenset(self.intervention_atoms[name] for name in interventions))
+
+        # conjoin the evidence atoms of each component
+        indices = OrderedDict()
+        evidence_sdds = []
+        for name, phase in evidence.items():
+            atom = self.evidence_atoms[name]
+            component = components.get(atom, atom)
+            if component not in indices:
+                indices[component] = len(evidence_sdds)
+                evidence_sdds.append(self._sdd_manager.true())
+            evidence_atom = self._bottom_up_literal(sdd, atom, phase)
+            evidence_sdds[indices[component]] = self._cached_apply(evidence_sdds[indices[component]], evidence_atom, SDDOperation.AND)
+
+        # get all the query sdds and conjoin them with the evidence of their components
+        query_sdds = []
+        query_components = []
+        for conjunction in conjunctions:
+            atoms = [ self.intervention_atoms[name] for name in conjunction ]
+            used = sorted(set(indices[components.get(atom, atom)] for atom in atoms if components.get(atom, atom) in indices))
+            query_sdd = self._sdd_manager.true()
+            for idx in used:
+                query_sdd = self._cached_apply(query_sdd, evidence_sdds[idx], SDDOperation.AND)
+            for name, phase in conjunction.items():
+                query_atom = self._bottom_up_literal(sdd, self.intervention_atoms[name], phase)
+                query_sdd = self._cached_apply(query_sdd, query_atom, SDDOperation.AND)
+            query_sdds.append(query_sdd)
+            query_components.append(used)
+        return evidence_sdds, query_sdds, query_components
+
+    def _sdd_weights(self, weights):
+        """Gets the literal weights of the SDD variables for the given probabilities of the facts.
+
+        Args:
+            weights (dict): The dictionary from fact names to their probability.
+        Returns:
+            :obj:`array`: The weights in the layout of `WmcManager.set_literal_weights_from_array`.
+        """
+        guesses = list(self._guess)
+        c_weights = [ 1.0 for _ in range(2*len(self._guess)) ]
         varMap = { name : var for var, name in self._nameMap.items() }
         rev_mapping = { guesses[i] : i + 1 for i in range(len(self._guess)) }
-        for name in self.weights:
+        for name in weights:
             sdd_var = rev_mapping[varMap[name]]
-            weights[len(self._guess) + sdd_var - 1] = self.weights[name]
-            weights[len(self._guess) - sdd_var] = 1 - self.weights[name]
-        python_array = np.array(weights)
-        c_weights = array('d', python_array.astype('float'))
+            c_weights[len(self._guess) + sdd_var - 1] = weights[name]
+            c_weights[len(self._guess) - sdd_var] = 1 - weights[name]
+        python_array = np.array(c_weights)
+        return array('d', python_array.astype('float'))
+
+    def _bottom_up_count(self, conjoined_evidence, query_sdds, weights, check = True):
+        """Computes the counterfactual probabilities from the SDDs built by `_bottom_up_sdds`.
+
+        Args:
+            conjoined_evidence (:obj:`SddNode`): The SDD of the conjoined evidence.
+            query_sdds (list): The SDDs of the queries conjoined with the evidence.
+            weights (dict): The dictionary from fact names to their probability.
+            check (:obj:`bool`, optional): Whether to raise an exception if the evidence has probability zero.
+                Otherwise the results are `nan`. Defaults to `True`.
+        Returns:
+            list: A list containing the results of the counterfactual queries in the order of `query_sdds`.
+        """
+        # compute the actual probabilities
+        # first the probability of the evidence
+        evidence_manager = WmcManager(conjoined_evidence, log_mode = False)
+        c_weights = self._sdd_weights(weights)
         evidence_manager.set_literal_weights_from_array(c_weights)
         evidence_weight = evidence_manager.propagate()
         if evidence_weight <= 0.0:
-            raise Exception("Contradictory evidence! Probablity given evidence is zero.")
+            self._sdd_manager.set_prevent_transformation(prevent = False)
+            if check:
+                raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
+            return [ float("nan") for _ in query_sdds ]
         
         # then the probabilities of the queries given the evidence
         final_results = []
@@ -640,9 +1923,48 @@ class CounterfactualProgram(ProblogProgram):
             query_weight = query_manager.propagate()
             final_results.append(query_weight/evidence_weight)
 
+        # the wmc managers forbid further transformations, which we need for the next query
+        self._sdd_manager.set_prevent_transformation(prevent = False)
         return final_results
 
-    def setup_sdd_manager(self, program):
+    def _bottom_up_component_count(self, evidence_sdds, query_sdds, query_components, weights):
+        """Computes the counterfactual probabilities from the SDDs built by `_bottom_up_component_sdds`.
+
+        Args:
+            evidence_sdds (list): The SDDs of the conjoined evidence of each component.
+            query_sdds (list): The SDDs of the queries conjoined with the evidence of their components.
+            query_components (list): The indices of the components of each query.
+            weights (dict): The dictionary from fact names to their probability.
+        Returns:
+            list: A list containing the results of the counterfactual queries in the order of `query_sdds`.
+        """
+        # first the probability of the evidence of each component
+        c_weights = self._sdd_weights(weights)
+        evidence_weights = []
+        for evidence_sdd in evidence_sdds:
+            evidence_manager = WmcManager(evidence_sdd, log_mode = False)
+            evidence_manager.set_literal_weights_from_array(c_weights)
+            evidence_weights.append(evidence_manager.propagate())
+            if evidence_weights[-1] <= 0.0:
+                self._sdd_manager.set_prevent_transformation(prevent = False)
+                raise ContradictoryEvidence("Contradictory evidence! Probablity given evidence is zero.")
+
+        # then the probabilities of the queries given the evidence of their components
+        final_results = []
+        for query_sdd, used in zip(query_sdds, query_components):
+            query_manager = WmcManager(query_sdd, log_mode = False)
+            query_manager.set_literal_weights_from_array(c_weights)
+            query_weight = query_manager.propagate()
+            final_results.append(query_weight/np.prod([ evidence_weights[idx] for idx in used ]))
+
+        # the wmc managers forbid further transformations, which we need for the next query
+        self._sdd_manager.set_prevent_transformation(prevent = False)
+        return final_results
+
+    def setup_sdd_manager(self, program, guesses = None):
+        # the guesses get the sdd variables 1, 2, ... in the given order
+        if guesses is None:
+            guesses = list(self._guess)
         # first generate a vtree for the program that is probably good
         OR = 0
         AND = 1
@@ -656,7 +1978,7 @@ class CounterfactualProgram(ProblogProgram):
             cur_max += 1
             nodes[cur_max] = (GUESS, set(abs(v) for v in a))
 
-        for atom in self._guess:
+        for atom in guesses:
             nodes[atom] = (INPUT, set())
 
         for r in program:
@@ -670,20 +1992,22 @@ class CounterfactualProgram(ProblogProgram):
         for a, inputs in nodes.items():
             graph.add_edges_from([ (a, v) for v in inputs[1] ])
             
-        td = treedecomposition.from_graph(graph, solver = config["decos"], timeout = str(float(config["decot"])))
-        td.remove(set(range(1, cur_max + 1)).difference(self._guess))
+        with deadline.decomposition_timeout():
+            td = treedecomposition.from_graph(graph, solver = config["decos"], timeout = str(float(config["decot"])))
+        td.remove(set(range(1, cur_max + 1)).difference(guesses))
         my_vtree = TD_to_vtree(td)
-        guesses = list(self._guess)
-        rev_mapping = { guesses[i] : i + 1 for i in range(len(self._guess)) }
+        rev_mapping = { guesses[i] : i + 1 for i in range(len(guesses)) }
         for node in my_vtree:
             if node.val != None:
-                assert(node.val in self._guess)
+                assert(node.val in rev_mapping)
                 node.val = rev_mapping[node.val]
 
-        (_, vtree_tmp) = tempfile.mkstemp()
+        (vtree_fd, vtree_tmp) = compilation.mkstemp()
+        os.close(vtree_fd)
         my_vtree.write(vtree_tmp)
         vtree = Vtree(filename=vtree_tmp)
         os.remove(vtree_tmp)
+        my_signals.tempfiles.discard(vtree_tmp)
         sdd = SddManager.from_vtree(vtree)
         
         return sdd
@@ -0,0 +1,124 @@
+"""
+Deadline module providing per-call deadlines that are checked cooperatively during decomposition, compilation and counting.
+
+A deadline is set for the current thread with `limit`.
+The long running parts of query evaluation call `check`, which raises `DeadlineExceeded` once the deadline has passed,
+and the knowledge compilers are killed when it passes while they are running.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from aspmc.config import config
+
+from counterfactuals.exceptions import DeadlineExceeded
+
+fallback_config = {
+    "method" : "sampling",
+    "samples" : 10000,
+}
+"""The configuration of what happens if a query with a deadline runs out of time.
+
+* `method`: `sampling` to estimate the results by forward sampling of the facts,
+    or `None` to raise `DeadlineExceeded`. Results that are in the result cache are always used as they are.
+* `samples`: the number of samples for `sampling`.
+"""
+
+_local = threading.local()
+
+class ApproximateResults(list):
+    """The results of a query that ran out of time and were computed by a cheaper method.
+
+    Args:
+        results (list): The results of the queries.
+        method (:obj:`string`): The method that computed the results.
+        samples (:obj:`int`, optional): The number of samples that were consistent with the evidence,
+            if the results were estimated by sampling. Defaults to `None`.
+
+    Attributes:
+        approximate (bool): Always `True`.
+        method (:obj:`string`): The method that computed the results.
+        samples (:obj:`int`): The number of samples that were consistent with the evidence or `None`.
+    """
+    approximate = True
+
+    def __init__(self, results, method, samples = None):
+        list.__init__(self, results)
+        self.method = method
+        self.samples = samples
+
+class Deadline(object):
+    """A point in time after which the current computation should be given up.
+
+    Args:
+        seconds (:obj:`float`): The number of seconds from now.
+    """
+    def __init__(self, seconds):
+        self.end = time.time() + seconds
+
+    def remaining(self):
+        """Gets the number of seconds that are left, which is never negative."""
+        return max(self.end - time.time(), 0.0)
+
+    def expired(self):
+        """Checks whether the deadline has passed."""
+        return time.time() >= self.end
+
+@contextmanager
+def limit(seconds):
+    """Sets a deadline for the current thread while the context is active.
+
+    Nested deadlines can only make the deadline earlier.
+
+    Args:
+        seconds (:obj:`float`): The number of seconds from now. `None` keeps the current deadline.
+    """
+    outer = current()
+    deadline = outer
+    if seconds is not None:
+        deadline = Deadline(seconds)
+        if outer is not None and outer.end < deadline.end:
+            deadline = outer
+    _local.deadline = deadline
+    try:
+        yield deadline
+    finally:
+        _local.deadline = outer
+
+def current():
+    """Gets the deadline of the current thread or `None` if there is none."""
+    return getattr(_local, "deadline", None)
+
+def remaining():
+    """Gets the number of seconds until the deadline of the current thread or `None` if there is none."""
+    deadline = current()
+    if deadline is None:
+        return None
+    return deadline.remaining()
+
+def check():
+    """Raises `DeadlineExceeded` if the deadline of the current thread has passed."""
+    deadline = current()
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded("The deadline of the query has passed.")
+
+@contextmanager
+def decomposition_timeout():
+    """Lowers the timeout of the tree decomposer to the time that is left while the context is active.
+
+    Tree decompositions are computed by anytime solvers, so this only makes the decomposition worse.
+    Since the timeout is part of the global configuration of aspmc, this is not safe if other threads decompose at the same time.
+    """
+    left = remaining()
+    if left is None:
+        yield
+        return
+    check()
+    decot = config["decot"]
+    config["decot"] = str(min(float(decot), max(left, 0.1)))
+    try:
+        yield
+    finally:
+        config["decot"] = decot
+    check()
@@ -0,0 +1,209 @@
+"""
+Decomposition module that splits ground programs into independent components and counts them in parallel.
+"""
+
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from aspmc.programs.problogprogram import ProblogProgram
+from aspmc.config import config
+
+import counterfactuals.compilation as compilation
+import counterfactuals.deadline as deadline
+from counterfactuals.exceptions import DeadlineExceeded
+
+logger = logging.getLogger("WhatIf")
+
+decomposition_config = {
+    "processes" : None,
+    "min_parallel_rules" : 256,
+    "cache_max_rules" : 64,
+    "cache_size" : 1024,
+}
+"""The configuration of the decomposition of single queries into independent components.
+
+* `processes`: how many worker processes count the components. `None` means one per CPU, `0` or `1` counts them in this process.
+    The worker processes are started with `spawn`, so scripts that use them must guard their main code with `if __name__ == "__main__":`.
+    Call `shutdown_pool` for a changed value to take effect.
+* `min_parallel_rules`: the number of rules from which a component is counted by a worker process.
+    Smaller components are counted in this process, since shipping them costs more than counting them.
+* `cache_max_rules`: the number of rules up to which the counts of a component are cached.
+* `cache_size`: how many components are cached per program.
+"""
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def independent_components(program, stop = frozenset()):
+    """Partitions the atoms of a ground program into components such that no rule contains atoms of different components.
+
+    The facts of different components are disjoint, so the probabilities of events in different components multiply.
+
+    Args:
+        program (list): The rules of the program.
+        stop (:obj:`set`, optional): Atoms whose truth is fixed, e.g. by an intervention.
+            Their rules are ignored and they do not connect the rules they occur in. Defaults to no atoms.
+    Returns:
+        dict: A dictionary from the atoms of the program to the representative atom of their component.
+            Atoms that do not occur in it are their own component.
+    """
+    parent = {}
+
+    def find(atom):
+        root = parent.setdefault(atom, atom)
+        while parent[root] != root:
+            parent[root] = parent[parent[root]]
+            root = parent[root]
+        return root
+
+    for rule in program:
+        if len(rule.head) > 0 and rule.head[0] in stop:
+            continue
+        atoms = [ abs(atom) for atom in rule.head + rule.body if abs(atom) not in stop ]
+        if len(atoms) == 0:
+            continue
+        root = find(atoms[0])
+        for atom in atoms[1:]:
+            other = find(atom)
+            if other != root:
+                parent[other] = root
+    return { atom : find(atom) for atom in parent }
+
+def count_program(program_string, query_names, strategy, settings = None, seconds = None):
+    """Counts the queries of a probabilistic program by top down knowledge compilation of its Clark completion.
+
+    This is what the worker processes run for each component.
+
+    Args:
+        program_string (:obj:`string`): The program in ProbLog syntax with its queries.
+        query_names (list): The names of the atoms whose probabilities are returned.
+            Those that are not queried in the program get count zero.
+        strategy (:obj:`string`): The knowledge compiler to use, see `counterfactuals.compilation.TOP_DOWN_STRATEGIES`.
+        settings (dict, optional): The configurations of aspmc and of `counterfactuals.compilation` to use, see `_settings`.
+            Defaults to `None`, meaning the ones of this process.
+        seconds (:obj:`float`, optional): The number of seconds until the deadline. Defaults to `None`, meaning the one of this thread.
+    Returns:
+        list: The weighted model counts of the queries in the order of `query_names`.
+    """
+    if settings is not None:
+        config.update(settings["aspmc"])
+        compilation.io_config.update(settings["io"])
+        compilation.portfolio_config.update(settings["portfolio"])
+    with deadline.limit(seconds):
+        inference_program = ProblogProgram(program_string, [])
+        # perform CNF conversion, followed by top down knowledge compilation
+        with deadline.decomposition_timeout():
+            inference_program.td_guided_both_clark_completion(adaptive = False, latest = True)
+        cnf = inference_program.get_cnf()
+        if len(inference_program.weights) == 0 and strategy in compilation.KNOWLEDGE_COMPILERS + [ "portfolio" ]:
+            # without probabilistic facts the knowledge compilers may not write a proper circuit, 
+            # since unit propagation decides the CNF, so its single model is counted without them
+            strategy = "td-dp"
+        result = _evaluate_cnf(cnf, strategy)
+        # reorder the query results
+        to_idx = { query : idx for idx, query in enumerate(inference_program.get_queries()) }
+        return [ result[to_idx[query]] if query in to_idx else 0.0 for query in query_names ]
+
+def count_programs(tasks, strategy):
+    """Counts several programs that share no atoms.
+
+    If there are several programs with at least `min_parallel_rules` rules, they are counted by the worker processes.
+    All the other programs are counted together as one program in this process in the meantime,
+    since most of the time for a small program goes into the tree decomposition of its CNF.
+
+    Args:
+        tasks (list): A list of triples `(program_string, query_names, size)` with the arguments of `count_program`
+            and the number of rules of the program.
+        strategy (:obj:`string`): The knowledge compiler to use.
+    Returns:
+        list: The results of `count_program` for each task.
+    """
+    results = [ None for _ in tasks ]
+    futures = {}
+    large = [ idx for idx, (_, _, size) in enumerate(tasks) if size >= decomposition_config["min_parallel_rules"] ]
+    if len(large) > 1 and _processes() > 1:
+        pool = _get_pool()
+        settings = _settings()
+        left = deadline.remaining()
+        for idx in large:
+            futures[idx] = pool.submit(count_program, tasks[idx][0], tasks[idx][1], strategy, settings, left)
+        logger.debug(f"Counting {len(futures)} of {len(tasks)} programs in worker processes")
+    try:
+        rest = [ idx for idx in range(len(tasks)) if idx not in futures ]
+        if len(rest) > 0:
+            counts = count_program("".join(tasks[idx][0] for idx in rest), [ query for idx in rest for query in tasks[idx][1] ], strategy)
+            for idx in rest:
+                results[idx], counts = counts[:len(tasks[idx][1])], counts[len(tasks[idx][1]):]
+        for idx, future in futures.items():
+            try:
+                results[idx] = future.result(timeout = deadline.remaining())
+            except TimeoutError:
+                raise DeadlineExceeded("The deadline of the query has passed.")
+            except BrokenProcessPool:
+                # a worker died, e.g. because it ran out of memory, so the pool is started again for the next query
+                logger.warning("A worker process for counting components died, counting the component in this process.")
+                shutdown_pool()
+                results[idx] = count_program(tasks[idx][0], tasks[idx][1], strategy)
+    finally:
+        for future in futures.values():
+            future.cancel()
+    return results
+
+def shutdown_pool():
+    """Stops the worker processes. They are started again when they are needed next.
+
+    Returns:
+        None
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait = False, cancel_futures = True)
+            _pool = None
+
+def _processes():
+    processes = decomposition_config["processes"]
+    if processes is None:
+        return os.cpu_count() or 1
+    return processes
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers = _processes(), mp_context = multiprocessing.get_context("spawn"))
+        return _pool
+
+def _settings():
+    """Gets the configurations that the worker processes need, since they do not share the globals of this process."""
+    return { "aspmc" : dict(config), "io" : dict(compilation.io_config), "portfolio" : dict(compilation.portfolio_config) }
+
+def _evaluate_cnf(cnf, strategy):
+    """Evaluates a CNF by compiling it top down.
+
+    Args:
+        cnf (:obj:`aspmc.compile.cnf.CNF`): The CNF with its weights.
+        strategy (:obj:`string`): The knowledge compiler to use, `td-dp` or `portfolio`.
+    Returns:
+        :obj:`np.array`: The weighted model counts of the CNF.
+    """
+    results = cnf.evaluate_trivial()
+    if results is not None:
+        return results
+    start = time.time()
+    if strategy == "portfolio":
+        _, circuit = compilation.compile_portfolio(cnf)
+    else:
+        circuit = compilation.compile_cnf(cnf, strategy)
+    logger.info(f"Compilation time:         {time.time() - start}")
+    start = time.time()
+    weights, zero, one, dtype = cnf.get_weights()
+    results = circuit.evaluate(weights, zero = zero, one = one, dtype = dtype)
+    logger.info(f"Counting time:            {time.time() - start}")
+    circuit.close()
+    return results
@@ -0,0 +1,253 @@
+"""
+Distributed module providing a coordinator that shards batches of scenarios over worker processes.
+
+The coordinator and the workers communicate over `multiprocessing.connection`,
+so the workers may run on the same host or connect from other hosts over TCP.
+"""
+
+import os
+import logging
+import threading
+import queue
+import time
+import multiprocessing
+from multiprocessing.connection import Listener, Client, wait
+
+logger = logging.getLogger("WhatIf")
+
+def run_worker(address, authkey):
+    """Runs a worker that evaluates the shards of a coordinator until it is told to stop.
+
+    The worker receives the program once, builds it, and then answers each shard with `batch_query`.
+    Scenarios with contradictory evidence get `nan` results instead of failing the whole shard.
+
+    Args:
+        address (tuple): The address of the coordinator, e.g. `("localhost", 6000)`.
+        authkey (:obj:`bytes`): The key that authenticates the worker at the coordinator.
+    Returns:
+        None
+    """
+    # imported here, such that the coordinator does not need to import the solver stack
+    from counterfactuals.counterfactualprogram import CounterfactualProgram
+
+    conn = Client(address, authkey = authkey)
+    try:
+        program = None
+        strategy = None
+        while True:
+            message = conn.recv()
+            if message[0] == "setup":
+                _, program_str, weights, strategy, intervenable = message
+                program = CounterfactualProgram(program_str, [], intervenable = intervenable)
+                if weights:
+                    program.update_weights(weights)
+            elif message[0] == "shard":
+                _, shard_id, scenarios = message
+                try:
+                    results = program.batch_query(scenarios, strategy=strategy, check = False)
+                except Exception as e:
+                    # errors in the scenarios are not fixed by retrying, so we report them
+                    conn.send(("error", shard_id, str(e)))
+                    continue
+                conn.send(("result", shard_id, results))
+            elif message[0] == "stop":
+                return
+    except EOFError:
+        # the coordinator went away
+        return
+    finally:
+        conn.close()
+
+class Coordinator(object):
+    """A coordinator that ships a program to its workers once and shards batches of scenarios over them.
+
+    Workers can be started on the local host with `start_local_workers` or connect from anywhere with `run_worker`.
+    If a worker fails while evaluating a shard, the shard is given to another worker,
+    up to `retries` times before the batch is given up.
+
+    Args:
+        program_str (:obj:`string`): The program in ProbLog syntax.
+        weights (:obj:`dict`, optional): Probabilities of facts that differ from the ones in `program_str`,
+            as for `CounterfactualProgram.update_weights`. Defaults to `None`.
+        strategy (:obj:`string`, optional): The knowledge compiler the workers use.
+            See `CounterfactualProgram.multi_query` for possible values. Defaults to `sharpsat-td`.
+        address (:obj:`tuple`, optional): The address the coordinator listens on.
+            Port `0` chooses a free port. Defaults to `("localhost", 0)`.
+        authkey (:obj:`bytes`, optional): The key that workers need to connect. 
+            Defaults to `None`, meaning a random key, which workers on other hosts get from `authkey`.
+        shard_size (:obj:`int`, optional): How many scenarios are sent to a worker at once. Defaults to `1000`.
+        retries (:obj:`int`, optional): How often a shard is retried after a worker failed on it. Defaults to `2`.
+        intervenable (:obj:`list`, optional): The names of the atoms that may be intervened on,
+            as for `CounterfactualProgram`. Defaults to `None`, meaning all derived atoms.
+
+    Attributes:
+        address (tuple): The address the coordinator listens on.
+    """
+    def __init__(self, program_str, weights = None, strategy = "sharpsat-td", address = ("localhost", 0), authkey = None, shard_size = 1000, retries = 2, intervenable = None):
+        self._setup = ("setup", program_str, weights, strategy, intervenable)
+        # the connections carry pickled messages, so the key must not be guessable
+        if authkey is None:
+            authkey = os.urandom(32)
+        self._authkey = authkey
+        self._shard_size = shard_size
+        self._retries = retries
+        self._listener = Listener(address, authkey = authkey)
+        self.address = self._listener.address
+        self._new_connections = queue.Queue()
+        self._workers = []
+        self._processes = []
+        self._dropped = 0
+        self._closed = False
+        self._run_id = 0
+        self._acceptor = threading.Thread(target = self._accept, daemon = True)
+        self._acceptor.start()
+
+    @property
+    def authkey(self):
+        """bytes: The key that workers need to connect, e.g. to pass to `run_worker` on other hosts."""
+        return self._authkey
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                if self._closed:
+                    return
+                logger.warning("A worker failed to connect.")
+                continue
+            self._new_connections.put(conn)
+
+    def _add_new_workers(self):
+        while True:
+            try:
+                conn = self._new_connections.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                conn.send(self._setup)
+                self._workers.append(conn)
+            except (OSError, EOFError):
+                conn.close()
+
+    def start_local_workers(self, count):
+        """Starts worker processes on the local host that connect to this coordinator.
+
+        Args:
+            count (:obj:`int`): The number of worker processes.
+        Returns:
+            None
+        """
+        context = multiprocessing.get_context("spawn")
+        for _ in range(count):
+            process = context.Process(target = run_worker, args = (self.address, self.authkey), daemon = True)
+            process.start()
+            self._processes.append(process)
+
+    def run(self, scenarios, timeout = None):
+        """Evaluates a batch of scenarios on the workers.
+
+        If no worker is connected, the coordinator waits for one to connect.
+        It gives up with an exception if all the workers failed during the run, 
+        if all the workers started by `start_local_workers` exited without another worker connecting,
+        or if no worker connected within `timeout` seconds.
+
+        Args:
+            scenarios (list): A list of triples `(interventions, evidence, queries)` as for `CounterfactualProgram.batch_query`.
+            timeout (:obj:`float`, optional): The number of seconds to wait for the first worker to connect.
+                Defaults to `None`, meaning that the coordinator waits as long as local workers are still starting or a remote one may connect.
+        Returns:
+            list: A list containing for each scenario the list of results of its queries, in the order the scenarios were given in.
+                The results of scenarios with contradictory evidence are `nan`.
+        """
+        scenarios = list(scenarios)
+        # results of shards from earlier runs that failed may still arrive and are ignored
+        self._run_id += 1
+        pending = [ (start, 0) for start in range(0, len(scenarios), self._shard_size) ]
+        pending.reverse()
+        in_flight = {}
+        results = [ None for _ in scenarios ]
+        start_time = time.time()
+        dropped = self._dropped
+
+        while len(pending) > 0 or len(in_flight) > 0:
+            self._add_new_workers()
+            if len(self._workers) == 0:
+                if self._dropped > dropped:
+                    raise Exception("All the workers of the coordinator failed.")
+                if len(self._processes) > 0 and not any(process.is_alive() for process in self._processes) \
+                        and self._new_connections.empty():
+                    raise Exception("All the local workers of the coordinator exited.")
+                if timeout is not None and time.time() - start_time > timeout:
+                    raise Exception("No worker connected to the coordinator.")
+                time.sleep(0.01)
+                continue
+
+            # hand out shards to idle workers
+            busy = set(in_flight.keys())
+            for conn in list(self._workers):
+                if len(pending) == 0:
+                    break
+                if conn in busy:
+                    continue
+                start, attempt = pending.pop()
+                try:
+                    conn.send(("shard", (self._run_id, start), scenarios[start:start + self._shard_size]))
+                    in_flight[conn] = (start, attempt)
+                except (OSError, EOFError):
+                    pending.append((start, attempt))
+                    self._drop(conn)
+
+            # collect the results that are ready
+            for conn in wait(list(in_flight.keys()), timeout = 0.1):
+                start, attempt = in_flight.pop(conn)
+                try:
+                    kind, shard_id, shard_results = conn.recv()
+                except (OSError, EOFError):
+                    self._drop(conn)
+                    if attempt >= self._retries:
+                        raise Exception(f"Giving up on the scenarios starting at {start} after {attempt + 1} failed attempts.")
+                    logger.warning(f"A worker failed on the scenarios starting at {start}, retrying.")
+                    pending.append((start, attempt + 1))
+                    continue
+                if shard_id != (self._run_id, start):
+                    in_flight[conn] = (start, attempt)
+                    continue
+                if kind == "error":
+                    raise Exception(f"Evaluating the scenarios starting at {start} failed: {shard_results}")
+                results[start:start + len(shard_results)] = shard_results
+        return results
+
+    def _drop(self, conn):
+        if conn in self._workers:
+            self._workers.remove(conn)
+            self._dropped += 1
+        conn.close()
+
+    def close(self):
+        """Stops the workers and the coordinator.
+
+        Returns:
+            None
+        """
+        self._closed = True
+        self._add_new_workers()
+        for conn in self._workers:
+            try:
+                conn.send(("stop", ))
+            except (OSError, EOFError):
+                pass
+            conn.close()
+        self._workers = []
+        self._listener.close()
+        for process in self._processes:
+            process.join(timeout = 5)
+            if process.is_alive():
+                process.kill()
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,11 @@
+"""
+Exceptions module providing the errors that are raised when counterfactual queries can not be answered.
+"""
+
+class ContradictoryEvidence(Exception):
+    """Raised when the evidence of a query has probability zero."""
+    pass
+
+class DeadlineExceeded(Exception):
+    """Raised when a query runs out of time. See `counterfactuals.deadline`."""
+    pass
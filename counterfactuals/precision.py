@@ -0,0 +1,129 @@
+"""
+Precision module providing reduced precision and log space evaluation of batched circuits.
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger("WhatIf")
+
+class Precision(object):
+    """How batched circuits of the probabilistic semiring are evaluated.
+
+    With `float32` the batch vectors take half the memory of `float64`, which pays off if memory bandwidth is the bottleneck.
+    In log space the logarithms of the weights are evaluated instead, products become sums and sums become `logaddexp`,
+    such that tiny probabilities of the evidence do not underflow.
+
+    After each evaluation `report` tells how accurate it was.
+    For the linear space there is an upper bound on the relative rounding error of the counts, see `CompiledCircuit.rounding_error`.
+    Additionally, `check_samples` columns of the batch can be evaluated again in `float64` to measure the deviation.
+    Since the report changes with every evaluation, every thread needs its own object.
+
+    Args:
+        dtype (:obj:`type`, optional): The floating point type of the evaluation. Defaults to `np.float32`.
+        log_space (:obj:`bool`, optional): Whether to evaluate in log space. Defaults to `False`.
+        check_samples (:obj:`int`, optional): How many columns of each batch are evaluated again in `float64`. Defaults to `0`.
+        tolerance (:obj:`float`, optional): The relative error above which a warning is logged. Defaults to `1e-4`.
+
+    Attributes:
+        dtype (:obj:`np.dtype`): The floating point type of the evaluation.
+        log_space (:obj:`bool`): Whether to evaluate in log space.
+        check_samples (:obj:`int`): How many columns of each batch are evaluated again in `float64`.
+        tolerance (:obj:`float`): The relative error above which a warning is logged.
+        report (dict): The accuracy of the last evaluation. It has the `error_bound` on the relative error of the counts,
+            which is `None` if it is not known, the number of `checked` columns
+            and the `max_deviation`, that is, the largest relative difference of a checked column to `float64`,
+            which is `None` if no column was checked.
+    """
+    def __init__(self, dtype = np.float32, log_space = False, check_samples = 0, tolerance = 1e-4):
+        self.dtype = np.dtype(dtype)
+        if self.dtype.kind != "f":
+            raise Exception(f"Evaluation is only supported for floating point types but got {self.dtype}.")
+        self.log_space = log_space
+        self.check_samples = check_samples
+        self.tolerance = tolerance
+        self.report = {}
+
+    def unit_roundoff(self):
+        """Gets the largest relative error of rounding a real number to `dtype`."""
+        return float(np.finfo(self.dtype).eps)/2
+
+    def zero(self):
+        """Gets the neutral element of addition in the representation of the evaluation."""
+        return self.dtype.type(-np.inf) if self.log_space else self.dtype.type(0.0)
+
+    def one(self):
+        """Gets the neutral element of multiplication in the representation of the evaluation."""
+        return self.dtype.type(0.0) if self.log_space else self.dtype.type(1.0)
+
+    def convert(self, weight):
+        """Converts a weight or a vector of weights to the representation of the evaluation.
+
+        Args:
+            weight (:obj:`object`): The weight.
+        Returns:
+            :obj:`np.array`: The converted weight.
+        """
+        if self.log_space:
+            with np.errstate(divide = "ignore"):
+                return np.log(np.asarray(weight, dtype = np.float64)).astype(self.dtype)
+        return np.asarray(weight, dtype = self.dtype)
+
+    def ratio(self, counts, evidence_count):
+        """Divides counts by the count of the evidence in the representation of the evaluation.
+
+        Args:
+            counts (:obj:`np.array`): The counts.
+            evidence_count (:obj:`object`): The count of the evidence, or counts that broadcast with `counts`.
+        Returns:
+            :obj:`np.array`: The ratios as probabilities in `float64`.
+        """
+        counts = np.asarray(counts, dtype = np.float64)
+        evidence_count = np.asarray(evidence_count, dtype = np.float64)
+        with np.errstate(divide = "ignore", invalid = "ignore"):
+            if self.log_space:
+                return np.exp(counts - evidence_count)
+            return counts/evidence_count
+
+    def is_zero(self, count):
+        """Checks whether a count is zero in the representation of the evaluation."""
+        return count == -np.inf if self.log_space else count <= 0.0
+
+    def deviation(self, counts, exact):
+        """Gets the largest relative difference of counts to exact counts in `float64`.
+
+        Args:
+            counts (:obj:`np.array`): The counts in the representation of the evaluation.
+            exact (:obj:`np.array`): The exact counts in the same representation, but in `float64`.
+        Returns:
+            :obj:`float`: The largest relative difference, ignoring counts that are zero in both.
+        """
+        counts = np.asarray(counts, dtype = np.float64)
+        exact = np.asarray(exact, dtype = np.float64)
+        with np.errstate(invalid = "ignore"):
+            if self.log_space:
+                # the difference of logarithms is the relative difference to first order
+                differences = np.abs(np.expm1(counts - exact))
+                differences[(counts == -np.inf) & (exact == -np.inf)] = 0.0
+            else:
+                differences = np.abs(counts - exact)/np.where(exact != 0.0, np.abs(exact), 1.0)
+        if differences.size == 0:
+            return 0.0
+        return float(np.max(np.where(np.isnan(differences), np.inf, differences)))
+
+    def record(self, error_bound, checked, max_deviation):
+        """Stores the report of an evaluation and warns if it exceeds the tolerance.
+
+        Args:
+            error_bound (:obj:`float`): The bound on the relative error of the counts or `None`.
+            checked (:obj:`int`): The number of columns that were checked in `float64`.
+            max_deviation (:obj:`float`): The largest relative difference of the checked columns or `None`.
+        Returns:
+            None
+        """
+        self.report = { "error_bound" : error_bound, "checked" : checked, "max_deviation" : max_deviation }
+        if max_deviation is not None and max_deviation > self.tolerance:
+            logger.warning(f"Evaluation in {self.dtype}{' log space' if self.log_space else ''} deviates by {max_deviation} from float64.")
+        elif error_bound is not None and error_bound > self.tolerance and max_deviation is None:
+            logger.warning(f"Evaluation in {self.dtype} has a relative error bound of {error_bound}.")
@@ -0,0 +1,167 @@
+"""
+Registry module that keeps many counterfactual programs by key within a memory budget.
+"""
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from counterfactuals.compiledmodel import CompiledModel
+
+logger = logging.getLogger("WhatIf")
+
+class ModelRegistry(object):
+    """Keeps counterfactual programs by key and evicts the least recently used ones to stay within a memory budget.
+
+    Programs are built by the loader when they are requested for the first time or after they were evicted.
+    If a snapshot directory is given, the compiled model of a program is saved there when the program is evicted,
+    and a rebuilt program uses it instead of compiling its circuit again.
+    Snapshots are named after the key, so they are also found by registries that are created later on the same directory.
+
+    The memory of a program is estimated with `CounterfactualProgram.memory_usage` whenever it is requested,
+    so programs that grew since their last request are accounted for at their next one.
+    The program that is requested is never evicted, even if it exceeds the budget on its own.
+
+    All methods may be called from several threads. Programs are built while holding the lock of the registry.
+
+    Args:
+        loader (callable): A function that builds the `CounterfactualProgram` for a key.
+        memory_budget (:obj:`int`, optional): The number of bytes all the programs may use together. Defaults to `2**30`.
+        snapshot_dir (:obj:`string`, optional): The directory for the snapshots of the compiled models.
+            Defaults to `None`, which means that evicted programs are compiled again.
+
+    Attributes:
+        stats (dict): The number of `hits` of resident programs, of `loads` by the loader,
+            of `restores` of compiled models from snapshots and of `evictions`.
+    """
+    def __init__(self, loader, memory_budget = 2**30, snapshot_dir = None):
+        if memory_budget < 0:
+            raise Exception(f"The memory budget must be non-negative but got {memory_budget}.")
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.snapshot_dir = snapshot_dir
+        if snapshot_dir is not None:
+            os.makedirs(snapshot_dir, exist_ok = True)
+        self.stats = { "hits" : 0, "loads" : 0, "restores" : 0, "evictions" : 0 }
+        self._programs = OrderedDict()
+        self._memory = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._programs
+
+    def __len__(self):
+        with self._lock:
+            return len(self._programs)
+
+    def keys(self):
+        """Gets the keys of the resident programs from the least to the most recently used.
+
+        Returns:
+            list: The keys.
+        """
+        with self._lock:
+            return list(self._programs.keys())
+
+    def get(self, key):
+        """Gets the program for a key, building it if it is not resident.
+
+        Afterwards the least recently used programs are evicted until the budget is met.
+
+        Args:
+            key (:obj:`object`): The key of the program. It must be hashable and its `repr` must identify it.
+        Returns:
+            :obj:`CounterfactualProgram`: The program.
+        """
+        with self._lock:
+            if key in self._programs:
+                self._programs.move_to_end(key)
+                self.stats["hits"] += 1
+            else:
+                self._programs[key] = self._load(key)
+            self._memory[key] = self._programs[key].memory_usage()["total"]
+            self._enforce_budget(key)
+            return self._programs[key]
+
+    def put(self, key, program):
+        """Adds a program that was built elsewhere, replacing the resident program for the key.
+
+        Args:
+            key (:obj:`object`): The key of the program as for `get`.
+            program (:obj:`CounterfactualProgram`): The program.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._programs[key] = program
+            self._programs.move_to_end(key)
+            self._memory[key] = program.memory_usage()["total"]
+            self._enforce_budget(key)
+
+    def memory_usage(self):
+        """Gets the estimated memory of all the resident programs as of their last request.
+
+        Returns:
+            int: The approximate number of bytes.
+        """
+        with self._lock:
+            return sum(self._memory.values())
+
+    def evict(self, key):
+        """Evicts the program for a key, saving a snapshot of its compiled model if there is a snapshot directory.
+
+        Args:
+            key (:obj:`object`): The key of the program.
+        Returns:
+            None
+        """
+        with self._lock:
+            if key not in self._programs:
+                return
+            program = self._programs.pop(key)
+            memory = self._memory.pop(key)
+            self.stats["evictions"] += 1
+            if self.snapshot_dir is not None and program._model is not None:
+                program._model.save(self._snapshot_path(key))
+            logger.debug(f"Evicted the program for {key!r} with about {memory} bytes")
+
+    def remove(self, key):
+        """Removes the program for a key and its snapshot, such that it is built from scratch when it is requested again.
+
+        Args:
+            key (:obj:`object`): The key of the program.
+        Returns:
+            None
+        """
+        with self._lock:
+            self._programs.pop(key, None)
+            self._memory.pop(key, None)
+            if self.snapshot_dir is not None and os.path.isfile(self._snapshot_path(key)):
+                os.remove(self._snapshot_path(key))
+
+    def _snapshot_path(self, key):
+        name = hashlib.sha256(repr(key).encode()).hexdigest()
+        return os.path.join(self.snapshot_dir, f"{name}.model")
+
+    def _load(self, key):
+        program = self.loader(key)
+        self.stats["loads"] += 1
+        if self.snapshot_dir is not None and os.path.isfile(self._snapshot_path(key)):
+            try:
+                program.use_model(CompiledModel.load(self._snapshot_path(key)))
+                self.stats["restores"] += 1
+            except Exception as e:
+                # the snapshot may be from an older version of the program, which is compiled again instead
+                logger.warning(f"Could not restore the snapshot of {key!r}: {e}")
+                os.remove(self._snapshot_path(key))
+        return program
+
+    def _enforce_budget(self, keep):
+        while sum(self._memory.values()) > self.memory_budget and len(self._programs) > 1:
+            oldest = next(iter(self._programs))
+            if oldest == keep:
+                break
+            self.evict(oldest)
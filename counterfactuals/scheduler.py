@@ -0,0 +1,148 @@
+"""
+Scheduler module that orders batches of counterfactual scenarios to maximize the reuse of cached results.
+"""
+
+from collections import Counter
+
+class Scenario(object):
+    """A group of scenarios that share the same interventions and evidence.
+
+    Args:
+        interventions (dict): A dictionary mapping names to phases.
+        evidence (dict): A dictionary mapping names to phases.
+
+    Attributes:
+        interventions (dict): A dictionary mapping names to phases.
+        evidence (dict): A dictionary mapping names to phases.
+        queries (list): The union of the queries of all the scenarios in the group in the order they were first seen.
+        members (list): A list of pairs `(index, queries)` of the scenarios in the group,
+            where `index` is the position of the scenario in the batch.
+    """
+    def __init__(self, interventions, evidence):
+        self.interventions = interventions
+        self.evidence = evidence
+        self.queries = []
+        self.members = []
+        self._query_set = set()
+        self._intervention_set = frozenset(interventions.items())
+        self._evidence_set = frozenset(evidence.items())
+
+    def add(self, index, queries):
+        """Adds a scenario to the group.
+
+        Args:
+            index (:obj:`int`): The position of the scenario in the batch.
+            queries (list): The queries of the scenario.
+        Returns:
+            None
+        """
+        for query in queries:
+            if query not in self._query_set:
+                self._query_set.add(query)
+                self.queries.append(query)
+        self.members.append((index, queries))
+
+    def intervention_set(self):
+        """Returns the interventions as a frozenset of `(name, phase)` pairs."""
+        return self._intervention_set
+
+    def evidence_set(self):
+        """Returns the evidence as a frozenset of `(name, phase)` pairs."""
+        return self._evidence_set
+
+def group(scenarios):
+    """Groups the scenarios with identical interventions and evidence.
+
+    Args:
+        scenarios (list): A list of triples `(interventions, evidence, queries)` as they are passed to `multi_query`.
+    Returns:
+        list: The list of `Scenario` groups in the order they were first seen.
+    """
+    groups = {}
+    for index, (interventions, evidence, queries) in enumerate(scenarios):
+        key = (frozenset(interventions.items()), frozenset(evidence.items()))
+        if key not in groups:
+            groups[key] = Scenario(interventions, evidence)
+        groups[key].add(index, queries)
+    return list(groups.values())
+
+def order(groups):
+    """Orders the groups such that consecutive groups overlap as much as possible.
+
+    Starting from the group with the fewest interventions, the next group is always the nearest neighbour of the current one,
+    where the distance is the size of the symmetric difference of the interventions and ties are broken by the evidence
+    and then by the order of the groups.
+
+    Only the groups that share an intervention or evidence with the current group are compared with it.
+    All other groups are at least as far away as the smallest of them.
+
+    Args:
+        groups (list): A list of `Scenario` groups.
+    Returns:
+        list: The same groups in the order they should be evaluated in.
+    """
+    if len(groups) == 0:
+        return []
+    # index the remaining groups by the interventions and the evidence they contain
+    by_intervention = {}
+    by_evidence = {}
+    for idx, g in enumerate(groups):
+        for item in g.intervention_set():
+            by_intervention.setdefault(item, set()).add(idx)
+        for item in g.evidence_set():
+            by_evidence.setdefault(item, set()).add(idx)
+    sizes = [ (len(g.intervention_set()), len(g.evidence_set())) for g in groups ]
+    by_size = sorted(range(len(groups)), key = lambda idx: sizes[idx])
+    first_left = 0
+    done = [ False for _ in groups ]
+
+    def take(idx):
+        done[idx] = True
+        for item in groups[idx].intervention_set():
+            by_intervention[item].discard(idx)
+        for item in groups[idx].evidence_set():
+            by_evidence[item].discard(idx)
+        ordered.append(groups[idx])
+
+    ordered = []
+    cur = by_size[0]
+    take(cur)
+    while len(ordered) < len(groups):
+        n_interventions, n_evidence = sizes[cur]
+        shared_interventions = Counter()
+        for item in groups[cur].intervention_set():
+            shared_interventions.update(by_intervention[item])
+        shared_evidence = Counter()
+        for item in groups[cur].evidence_set():
+            shared_evidence.update(by_evidence[item])
+
+        # the nearest of the groups that overlap with the current one
+        best = None
+        for idx in shared_interventions.keys() | shared_evidence.keys():
+            key = (n_interventions + sizes[idx][0] - 2*shared_interventions[idx], 
+                n_evidence + sizes[idx][1] - 2*shared_evidence[idx], idx)
+            if best is None or key < best:
+                best = key
+        # the nearest of the groups that do not overlap with it is the smallest one
+        while done[by_size[first_left]]:
+            first_left += 1
+        for idx in by_size[first_left:]:
+            if done[idx] or idx in shared_interventions or idx in shared_evidence:
+                continue
+            key = (n_interventions + sizes[idx][0], n_evidence + sizes[idx][1], idx)
+            if best is None or key < best:
+                best = key
+            break
+        cur = best[2]
+        take(cur)
+    return ordered
+
+def schedule(scenarios):
+    """Groups and orders a batch of scenarios.
+
+    Args:
+        scenarios (list): A list of triples `(interventions, evidence, queries)` as they are passed to `multi_query`.
+    Returns:
+        list: The list of `Scenario` groups in the order they should be evaluated in.
+    """
+    return order(group(scenarios))
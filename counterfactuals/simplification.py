@@ -0,0 +1,144 @@
+"""
+Simplification module that shrinks ground programs before they are translated to CNF.
+"""
+
+import logging
+
+from aspmc.programs.program import Rule
+
+logger = logging.getLogger("WhatIf")
+
+def simplify_program(program, guess, true_atoms, false_atoms, protected):
+    """Simplifies a ground normal program without changing the truth of the protected atoms in any of its models.
+
+    The simplification
+    * propagates the atoms that are known to be true or false, which drops the rules whose bodies are falsified,
+        the rules of atoms that are true and the literals that are satisfied,
+    * makes atoms false that are not guessed and have no rules left and atoms true that have a rule with an empty body,
+    * collapses chains `a :- b.`, where the only rule of `a` has a single positive body literal,
+        by replacing `a` with `b` everywhere,
+    * removes duplicate literals and duplicate rules.
+
+    Only atoms that are derived by a rule with an empty body are made true, and only atoms without rules are made false,
+    so this is also correct for programs with positive cycles.
+
+    Args:
+        program (list): The rules of the program.
+        guess (set): The atoms that are guessed, which are neither derived nor made false.
+        true_atoms (iterable): Atoms that are known to be true, such as facts with probability one.
+        false_atoms (iterable): Atoms that are known to be false, such as facts with probability zero.
+        protected (set): Atoms that must stay in the program, such as queries and evidence.
+            If they are true, they are derived by a rule with an empty body, otherwise they keep their name.
+    Returns:
+        tuple: The simplified list of rules and a dictionary with the number of `rules` before the simplification,
+            the number of `remaining` rules, of `fixed` atoms, of `falsified` and `satisfied` rules
+            that were dropped, of `collapsed` chains and of `duplicates` that were removed.
+    """
+    heads = [ rule.head[0] if len(rule.head) > 0 else None for rule in program ]
+    bodies = [ list(rule.body) for rule in program ]
+    alive = [ True for _ in program ]
+    rules_of = {}
+    occurrences = {}
+    for idx, (head, body) in enumerate(zip(heads, bodies)):
+        if head is not None:
+            rules_of.setdefault(head, set()).add(idx)
+        for atom in body:
+            occurrences.setdefault(abs(atom), set()).add(idx)
+
+    stats = { "rules" : len(program), "fixed" : 0, "falsified" : 0, "satisfied" : 0, "collapsed" : 0, "duplicates" : 0 }
+    value = {}
+    queue = []
+
+    def assign(atom, phase):
+        if atom not in value:
+            value[atom] = phase
+            queue.append(atom)
+
+    def kill(idx):
+        alive[idx] = False
+        head = heads[idx]
+        if head is not None:
+            rules_of[head].discard(idx)
+            if len(rules_of[head]) == 0 and head not in guess:
+                assign(head, False)
+        for atom in bodies[idx]:
+            occurrences[abs(atom)].discard(idx)
+
+    for atom in true_atoms:
+        assign(atom, True)
+    for atom in false_atoms:
+        assign(atom, False)
+    for atom in occurrences:
+        if atom not in rules_of and atom not in guess:
+            assign(atom, False)
+    for idx, head in enumerate(heads):
+        if head is not None and len(bodies[idx]) == 0:
+            assign(head, True)
+
+    # propagate the atoms whose truth is known
+    while len(queue) > 0:
+        atom = queue.pop()
+        if value[atom]:
+            for idx in list(rules_of.get(atom, [])):
+                stats["satisfied"] += 1
+                kill(idx)
+        for idx in list(occurrences.get(atom, [])):
+            if not alive[idx]:
+                continue
+            if atom in bodies[idx] and -atom in bodies[idx]:
+                stats["falsified"] += 1
+                kill(idx)
+                continue
+            literal = atom if atom in bodies[idx] else -atom
+            if (literal > 0) != value[atom]:
+                stats["falsified"] += 1
+                kill(idx)
+                continue
+            bodies[idx] = [ b for b in bodies[idx] if b != literal ]
+            occurrences[atom].discard(idx)
+            # a constraint whose body is satisfied stays with an empty body, which keeps the program inconsistent,
+            # since the rules of its body atoms may already have been dropped
+            if len(bodies[idx]) == 0 and heads[idx] is not None:
+                assign(heads[idx], True)
+    stats["fixed"] = len(value)
+
+    # collapse the chains of atoms with a single positive rule
+    for atom in list(rules_of.keys()):
+        if atom in protected or atom in guess or atom in value or len(rules_of[atom]) != 1:
+            continue
+        idx = next(iter(rules_of[atom]))
+        if len(bodies[idx]) != 1 or bodies[idx][0] <= 0 or bodies[idx][0] == atom:
+            continue
+        target = bodies[idx][0]
+        alive[idx] = False
+        rules_of[atom].discard(idx)
+        occurrences[target].discard(idx)
+        for other in list(occurrences.get(atom, [])):
+            bodies[other] = [ (target if b > 0 else -target) if abs(b) == atom else b for b in bodies[other] ]
+            occurrences[target].add(other)
+        occurrences[atom] = set()
+        stats["collapsed"] += 1
+
+    # remove duplicates and rules that can never be applied
+    result = []
+    seen = set()
+    for idx in range(len(program)):
+        if not alive[idx]:
+            continue
+        body = list(dict.fromkeys(bodies[idx]))
+        head = [] if heads[idx] is None else [ heads[idx] ]
+        if any(-b in body for b in body) or (heads[idx] is not None and heads[idx] in body):
+            stats["falsified"] += 1
+            continue
+        key = (heads[idx], frozenset(body))
+        if key in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(key)
+        result.append(Rule(head, body))
+    for atom in protected:
+        if value.get(atom, False):
+            result.append(Rule([ atom ], []))
+    stats["remaining"] = len(result)
+    logger.debug(f"Simplification: {stats}")
+    return result, stats
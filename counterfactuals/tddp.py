@@ -0,0 +1,185 @@
+"""
+Tree decomposition module providing a counter that performs dynamic programming over a tree decomposition of a CNF.
+"""
+
+import logging
+
+import numpy as np
+
+import aspmc.graph.treedecomposition as treedecomposition
+from aspmc.config import config
+from aspmc.util import *
+
+import counterfactuals.deadline as deadline
+from counterfactuals.circuit import batch_size
+
+logger = logging.getLogger("WhatIf")
+
+MAX_WIDTH = 20
+"""The largest width of a tree decomposition for which the tables of the dynamic programming are built."""
+
+class _Node(object):
+    """A bag of the tree decomposition together with what is needed to compute its table."""
+    def __init__(self, vertices, separator, children):
+        self.vertices = vertices
+        self.separator = separator
+        self.children = children
+        self.axes = { v : i + 1 for i, v in enumerate(vertices) }
+        self.clauses = np.ones((2, )*len(vertices))
+        self.weighted = []
+
+class TDCounter(object):
+    """Counts the models of a CNF by dynamic programming over a tree decomposition of its primal graph.
+
+    Every bag has a table with one axis per variable in the bag, where index `1` means that the variable is true,
+    and an axis for the columns of the batch.
+    The table of a bag is the product of the clauses and literal weights assigned to it and the tables of its children,
+    summed over the variables that do not occur in its parent.
+    Each table is computed with a single `np.einsum`, so the whole batch is counted in one pass without any external knowledge compiler.
+
+    It can be used everywhere a compiled circuit is used, but it does not support maximization.
+
+    Args:
+        cnf (:obj:`aspmc.compile.cnf.CNF`): The CNF to count.
+        td (:obj:`aspmc.graph.treedecomposition.TreeDecomposition`): A tree decomposition of the primal graph of the CNF.
+    """
+    def __init__(self, cnf, td):
+        if td.width > MAX_WIDTH:
+            raise Exception(f"The tree decomposition has width {td.width}, but td-dp only supports widths up to {MAX_WIDTH}.")
+        self.width = td.width
+
+        # order the bags such that the children come before their parents
+        order = []
+        stack = [ (td.get_root(), None) ]
+        while len(stack) > 0:
+            bag, parent = stack.pop()
+            order.append((bag, parent))
+            stack.extend((child, bag) for child in bag.children)
+        order.reverse()
+
+        nodes = {}
+        for bag, parent in order:
+            vertices = sorted(bag.vertices)
+            separator = [] if parent is None else [ v for v in vertices if v in parent.vertices ]
+            nodes[bag.idx] = _Node(vertices, separator, [ nodes[child.idx] for child in bag.children ])
+        self._nodes = [ nodes[bag.idx] for bag, _ in order ]
+
+        # every clause and every weight is assigned to the lowest bag that contains its variables
+        bags_of = {}
+        for node in self._nodes:
+            for v in node.vertices:
+                bags_of.setdefault(v, []).append(node)
+        for v in range(1, cnf.nr_vars + 1):
+            bags_of[v][0].weighted.append(v)
+        for clause in cnf.clauses:
+            clause = set(clause)
+            if any(-l in clause for l in clause):
+                continue
+            variables = set(abs(l) for l in clause)
+            node = next(node for node in bags_of[abs(next(iter(clause)))] if variables.issubset(node.axes))
+            # the clause is only falsified if all its literals are false
+            index = [ slice(None) for _ in node.vertices ]
+            for l in clause:
+                index[node.axes[abs(l)] - 1] = 0 if l > 0 else 1
+            node.clauses[tuple(index)] = 0.0
+
+    @staticmethod
+    def from_cnf(cnf):
+        """Builds a counter for a CNF by decomposing its primal graph with the configured tree decomposer.
+
+        Args:
+            cnf (:obj:`aspmc.compile.cnf.CNF`): The CNF to count.
+        Returns:
+            :obj:`TDCounter`: The counter.
+        """
+        with deadline.decomposition_timeout():
+            td = treedecomposition.from_graph(cnf.primal_graph(), solver = config["decos"], timeout = config["decot"])
+        logger.info(f"Tree decomposition for td-dp #bags: {td.bags} width: {td.width}")
+        return TDCounter(cnf, td)
+
+    def size(self):
+        """Gets the number of table entries per column of the batch.
+
+        Returns:
+            int: The sum of the sizes of the tables of all bags.
+        """
+        return sum(2**len(node.vertices) for node in self._nodes)
+
+    def memory(self):
+        """Estimates the memory of the counter.
+
+        Returns:
+            int: The number of bytes of the clause tables of all bags.
+        """
+        return sum(node.clauses.nbytes for node in self._nodes)
+
+    def close(self):
+        """Releases the resources of the counter. Nothing needs to be done.
+
+        Returns:
+            None
+        """
+        pass
+
+    def simplify(self, constants = None):
+        """Not supported, since the tables only depend on the decomposition. Returns the counter itself."""
+        return self
+
+    def evaluate(self, weights, zero = 0.0, one = 1.0, dtype = float, log_space = False):
+        """Performs weighted model counting by dynamic programming over the tree decomposition.
+
+        Only the probabilistic semiring is supported.
+
+        Args:
+            weights (list): The weights of the literals. The weight for literal `v` is in `weights[2*(v-1)]`,
+                the one for `-v` is in `weights[2*(v-1)+1]`. Either a `LiteralWeights` or a list of arrays of the same length.
+            zero (:obj:`object`, optional): The neutral element of addition. Defaults to `0.0`.
+            one (:obj:`object`, optional): The neutral element of multiplication. Defaults to `1.0`.
+            dtype (:obj:`type`, optional): Which type the numpy arrays used to store the weights should have. Defaults to `float`.
+            log_space (:obj:`bool`, optional): Not supported, must be `False`.
+        Returns:
+            (:obj:`object`): The weighted model count for each column of the batch.
+        """
+        if log_space:
+            raise Exception("Evaluation in log space is not supported for td-dp.")
+        batch = batch_size(weights)
+        tables = {}
+        for node in self._nodes:
+            deadline.check()
+            operands = [ np.ones(batch, dtype = dtype), [ 0 ], node.clauses, list(range(1, len(node.vertices) + 1)) ]
+            for v in node.weighted:
+                if np.ndim(weights[neg(to_pos(v))]) == 0 and np.ndim(weights[to_pos(v)]) == 0:
+                    # the weights are shared by the whole batch
+                    literal_weights = np.array([ weights[neg(to_pos(v))], weights[to_pos(v)] ], dtype = dtype)
+                    operands += [ literal_weights, [ node.axes[v] ] ]
+                    continue
+                literal_weights = np.empty((batch, 2), dtype = dtype)
+                literal_weights[:,0] = weights[neg(to_pos(v))]
+                literal_weights[:,1] = weights[to_pos(v)]
+                operands += [ literal_weights, [ 0, node.axes[v] ] ]
+            for child in node.children:
+                operands += [ tables.pop(id(child)), [ 0 ] + [ node.axes[v] for v in child.separator ] ]
+            tables[id(node)] = np.einsum(*operands, [ 0 ] + [ node.axes[v] for v in node.separator ], optimize = "greedy")
+        return tables[id(self._nodes[-1])]
+
+    def rounding_error(self, unit):
+        """Bounds the relative rounding error of counting with nonnegative weights to first order.
+
+        The errors of the children of a bag add up as in a product, and the table of a bag adds one rounding
+        per factor and per summand of the variables that are summed out, which is what the contraction costs at most.
+
+        Args:
+            unit (:obj:`float`): The unit roundoff of the floating point type.
+        Returns:
+            :obj:`float`: The bound on the relative error of the count.
+        """
+        errors = {}
+        for node in self._nodes:
+            factors = len(node.weighted) + len(node.children) + 1
+            summands = 2**(len(node.vertices) - len(node.separator))
+            errors[id(node)] = sum(errors[id(child)] for child in node.children) + (factors + summands)*unit
+        return errors[id(self._nodes[-1])]
+
+    def max_product(self, weights):
+        """Not supported, since the tables only keep sums."""
+        raise Exception("Maximization is not supported for td-dp.")
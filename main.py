@@ -9,6 +9,7 @@ import sys
 import logging
 
 from counterfactuals.counterfactualprogram import CounterfactualProgram
+import counterfactuals.compilation as compilation
 
 import aspmc.config as config
 
@@ -23,13 +24,15 @@ help_string = """
 WhatIf: A solver for counterfactual inference.
 WhatIf version 1.0.2, Feb 5, 2024
 
-WhatIf [-e .] [-ds .] [-dt .] [-k .] [-v .] [-h] [<INPUT-FILES>]
+WhatIf [-e .] [-ds .] [-dt .] [-t .] [-k .] [-v .] [-h] [<INPUT-FILES>]
     --knowlege          -k  COMPILER    set the knowledge compiler to COMPILER:
                                         * sharpsat-td       : uses a compilation version of sharpsat-td (default)
                                         * d4                : uses the (slightly modified) d4 compiler. 
                                         * c2d               : uses the c2d compiler. 
                                         * miniC2D           : uses the miniC2D compiler. 
                                         * pysdd             : uses the PySDD compiler. 
+                                        * td-dp             : counts by dynamic programming over a tree decomposition, without a compiler.
+                                        * portfolio         : races sharpsat-td, d4, c2d and miniC2D and uses the first result.
     --evidence          -e  NAME,VALUE  add evidence NAME:
                                         * the evidence is not negated if VALUE is `True`.
                                         * the evidence is negated if VALUE is `False`.
@@ -40,6 +43,7 @@ WhatIf [-e .] [-ds .] [-dt .] [-k .] [-v .] [-h] [<INPUT-FILES>]
     --decos             -ds SOLVER      set the solver that computes tree decompositions to SOLVER:
                                         * flow-cutter       : uses flow_cutter_pace17 (default)
     --decot             -dt SECONDS     set the timeout for computing tree decompositions to SECONDS (default: 1)
+    --tmpdir            -t  DIR         write the temporary files of the knowledge compilers to DIR, e.g. a tmpfs mount
     --verbosity         -v  VERBOSITY   set the logging level to VERBOSITY:
                                         * debug             : print everything
                                         * info              : print as usual
@@ -80,9 +84,12 @@ def main():
             elif sys.argv[1] == "-dt" or sys.argv[1] == "--decot":
                 config.config["decot"] = sys.argv[2]
                 del sys.argv[1:3]            
+            elif sys.argv[1] == "-t" or sys.argv[1] == "--tmpdir":
+                compilation.io_config["tmpdir"] = sys.argv[2]
+                del sys.argv[1:3]
             elif sys.argv[1] == "-k" or sys.argv[1] == "--knowledge_compiler":
                 config.config["knowledge_compiler"] = sys.argv[2]
-                if sys.argv[2] != "c2d" and sys.argv[2] != "miniC2D" and sys.argv[2] != "sharpsat-td" and sys.argv[2] != "d4" and sys.argv[2] != "pysdd":
+                if sys.argv[2] != "c2d" and sys.argv[2] != "miniC2D" and sys.argv[2] != "sharpsat-td" and sys.argv[2] != "d4" and sys.argv[2] != "pysdd" and sys.argv[2] != "portfolio" and sys.argv[2] != "td-dp":
                     logger.error("  Unknown knowledge compiler: " + sys.argv[2])
                     exit(-1)
                 del sys.argv[1:3]
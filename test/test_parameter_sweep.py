@@ -0,0 +1,25 @@
+import os
+
+import numpy as np
+import pytest
+
+from counterfactuals.counterfactualprogram import CounterfactualProgram
+
+SPRINKLER = os.path.join(os.path.dirname(__file__), "test_sprinkler.lp")
+
+def test_conditioners_are_no_facts():
+    program = CounterfactualProgram("", [ SPRINKLER ])
+    # the top down setup adds the conditioners do(x) and dont(x) to the weights
+    program.multi_query({ "rain" : False }, {}, [ "wet" ], strategy = "sharpsat-td")
+    assert "do(rain)" in program.weights
+    with pytest.raises(Exception, match = "Unknown fact"):
+        program.parameter_sweep({}, {}, [ "wet" ], np.array([ [ 1.0 ], [ 0.0 ] ]), facts = [ "do(rain)" ], strategy = "sharpsat-td")
+
+def test_sweep_matches_single_queries():
+    program = CounterfactualProgram("", [ SPRINKLER ])
+    samples = np.array([ [ 0.2 ], [ 0.9 ] ])
+    results = program.parameter_sweep({ "sprinkler" : True }, { "wet" : False }, [ "rain" ], samples, facts = [ "u3" ], strategy = "sharpsat-td")
+    for sample, result in zip(samples, results):
+        expected = CounterfactualProgram("", [ SPRINKLER ])
+        expected.update_weights({ "u3" : float(sample[0]) })
+        assert result == pytest.approx(expected.single_query({ "sprinkler" : True }, { "wet" : False }, [ "rain" ], strategy = "sharpsat-td"))
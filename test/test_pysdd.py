@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from counterfactuals.counterfactualprogram import CounterfactualProgram
+
+SPRINKLER = os.path.join(os.path.dirname(__file__), "test_sprinkler.lp")
+
+DETERMINISTIC = """
+1.0::always.
+0.0::never.
+dry :- \\+wet, always.
+dry :- never.
+"""
+
+def make_program():
+    return CounterfactualProgram(DETERMINISTIC, [ SPRINKLER ])
+
+def test_single_query_with_deterministic_facts():
+    # the simplification removes the facts with probability 0 and 1 before the sdd manager is set up
+    interventions = { "sprinkler" : False }
+    evidence = { "slippery" : False }
+    queries = [ "dry", "wet", "rain" ]
+    expected = make_program().single_query(interventions, evidence, queries, strategy = "sharpsat-td")
+    results = make_program().single_query(interventions, evidence, queries, strategy = "pysdd")
+    assert results == pytest.approx(expected)
+    assert results[0] == pytest.approx(0.0)
+    assert results[1] == pytest.approx(1.0)
+
+def test_rule_update_keeps_memoized_sdds_outside_the_cone():
+    program = CounterfactualProgram("", [ SPRINKLER ])
+    program.multi_query({}, { "slippery" : False }, [ "wet", "slippery" ], strategy = "pysdd")
+    unchanged = [ program.intervention_atoms["wet"], program.evidence_atoms["rain"], program.evidence_atoms["sprinkler"] ]
+    changed = [ program.intervention_atoms["slippery"], program.evidence_atoms["slippery"] ]
+    memoized = { atom : program._sdd_memo[atom] for atom in unchanged }
+    assert all(atom in program._sdd_memo for atom in changed)
+
+    program.add_rules("slippery :- u4.")
+    assert all(program._sdd_memo.get(atom) is sdd for atom, sdd in memoized.items())
+    assert not any(atom in program._sdd_memo for atom in changed)
+
+    results = program.multi_query({ "rain" : True }, { "slippery" : False }, [ "wet", "slippery" ], strategy = "pysdd")
+    expected = CounterfactualProgram("slippery :- u4.", [ SPRINKLER ]).single_query(
+        { "rain" : True }, { "slippery" : False }, [ "wet", "slippery" ], strategy = "pysdd")
+    assert results == pytest.approx(expected)
+
+    program.remove_rules("slippery :- u4.")
+    assert all(program._sdd_memo.get(atom) is sdd for atom, sdd in memoized.items())
+    results = program.multi_query({}, { "slippery" : False }, [ "wet" ], strategy = "pysdd")
+    expected = CounterfactualProgram("", [ SPRINKLER ]).single_query({}, { "slippery" : False }, [ "wet" ], strategy = "pysdd")
+    assert results == pytest.approx(expected)
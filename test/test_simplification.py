@@ -0,0 +1,11 @@
+from aspmc.programs.program import Rule
+
+from counterfactuals.simplification import simplify_program
+
+def test_satisfied_constraint_stays_inconsistent():
+    f, u, a, c, q = 1, 2, 3, 4, 5
+    program = [ Rule([ a ], [ f ]), Rule([ c ], [ f ]), Rule([], [ a, c ]), Rule([ q ], [ u ]) ]
+    rules, stats = simplify_program(program, { f, u }, [ f ], [], { q })
+    assert any(len(rule.head) == 0 and len(rule.body) == 0 for rule in rules)
+    assert not any(len(rule.head) == 0 and len(rule.body) > 0 for rule in rules)
+    assert stats["remaining"] == len(rules)